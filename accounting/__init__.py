@@ -1,11 +1,94 @@
-#You will need to pip install flask and the sqlalchemy extension for flask.
+# You will need to pip install flask and the sqlalchemy extension for flask.
+import atexit
+import os
+
 from flask import Flask
-from flask.ext.sqlalchemy import SQLAlchemy
 
-# Initialize the application.
-app = Flask(__name__)
-app.config.from_pyfile('config.py')
-db = SQLAlchemy(app)
+import config
+import database
+import logs
+
+# Settings of this process: config.py with the overrides of one of its
+# PROFILES. Importing accounting only reads them; configure() applies them.
+settings = {}
+
+
+def load_settings(profile=None, **overrides):
+    """
+     The settings of config.py for profile (web, batch or test, the
+     ACCOUNTING_CONFIG environment variable by default), with overrides
+     on top.
+    """
+    profile = profile or os.environ.get('ACCOUNTING_CONFIG', 'web')
+    if profile not in config.PROFILES:
+        raise ValueError("Unknown settings profile %r, pick one of %s" % (
+            profile, ', '.join(sorted(config.PROFILES))))
+    values = dict((name, value) for name, value in vars(config).items()
+                  if name.isupper() and name != 'PROFILES')
+    values.update(config.PROFILES[profile])
+    values.update(overrides, PROFILE=profile)
+    return values
+
+
+settings.update(load_settings())
+
+
+
+def _make_app():
+    """
+     A Flask app with the process's settings, bound to db.
+    """
+    app = Flask(__name__)
+    app.config.update(settings)
+    db.init_app(app)
+    return app
+
+
+# Pooled SQLite connections with the pragmas from config.py. Outside requests
+# db works with the app configure() or create_app() made last, or with one
+# made from the settings when first used.
+db = database.AccountingSQLAlchemy(make_app=_make_app)
+# closing the last connection folds the WAL back into the database file
+atexit.register(database.close_connections, db)
+
+_profile = None
+
+
+def configure(profile=None, **overrides):
+    """
+     Switches the process to profile's settings and sets up what they
+     describe: logging, the response cache and the app db works with,
+     closing the connections of the previous one. Entry points call it
+     once, before the first query.
+    """
+    global _profile
+    import cache
+
+    settings.clear()
+    settings.update(load_settings(profile, **overrides))
+    logs.configure_logging(settings)
+    cache.configure(settings)
+    db.bind_app(_make_app())
+    _profile = settings['PROFILE']
+    return settings
+
+
+def create_app(profile=None, **overrides):
+    """
+     Builds the Flask app serving the views, configuring the process first
+     unless that was done already and no profile is given. Raises
+     RuntimeError when the database needs ./manage.py migrate.
+    """
+    import metrics
+    import views
+    from migrations import check_db
 
-# Import the views file for routing.
-import views
+    if profile or overrides or _profile is None:
+        configure(profile, **overrides)
+    check_db()
+    app = _make_app()
+    db.bind_app(app)
+    # Request and SQL instrumentation, served on /metrics.
+    metrics.init_app(app, db)
+    views.init_app(app)
+    return app
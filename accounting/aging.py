@@ -0,0 +1,227 @@
+#!/user/bin/env python2.7
+
+import csv
+import logging
+import random
+from datetime import datetime, timedelta
+from StringIO import StringIO
+
+from sqlalchemy import and_, case, func, select
+
+from accounting import db
+from archive import archived_whole_ids, full_history
+from chunking import chunked
+from models import Contact, Invoice, Payment, PaymentAllocation, Policy
+from utils import PolicyReader
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Receivables aging.
+
+What each policy still owes as of a date, split by how far
+past the due date it is: current (not yet due), 1-30, 31-60
+and 61+ days. An invoice's unpaid part is whatever of it
+the payments made by then were not applied to, as
+accounting.allocation applied them, so a payment made for a
+later invoice leaves the earlier ones past due. What was
+paid but not applied to an invoice billed by then shows up
+as a credit, which keeps
+
+    current + 1-30 + 31-60 + 61+ - credit == balance
+
+for every policy, the same balance return_account_balance
+gives.
+
+The buckets come out of one grouped statement over invoices,
+payment allocations and payments for the whole book; the
+agent roll-up adds up its rows. Policies archived whole keep
+no allocations, so theirs are aged from their live and
+archived rows by _aged_history() instead.
+#######################################################
+"""
+
+BUCKETS = ['current', 'days_1_30', 'days_31_60', 'days_61_plus']
+AMOUNTS = BUCKETS + ['credit', 'balance']
+
+
+def _aging_query(date_cursor, policy_ids=None):
+    """
+     One row per policy: id, agent id and name, the four buckets, and
+     what was billed, applied to those invoices and paid as of
+     date_cursor.
+    """
+    policies = Policy.__table__
+    contacts = Contact.__table__
+    payments = Payment.__table__
+    invoices = Invoice.__table__
+    allocations = PaymentAllocation.__table__
+
+    where = [payments.c.transaction_date <= date_cursor]
+    if policy_ids is not None:
+        where.append(payments.c.policy_id.in_(policy_ids))
+    paid = select([payments.c.policy_id, func.sum(payments.c.amount_paid).label('paid')], and_(*where)) \
+        .group_by(payments.c.policy_id) \
+        .alias('paid')
+
+    where = [allocations.c.transaction_date <= date_cursor]
+    if policy_ids is not None:
+        where.append(allocations.c.policy_id.in_(policy_ids))
+    applied = select([allocations.c.invoice_id, func.sum(allocations.c.amount).label('applied')], and_(*where)) \
+        .group_by(allocations.c.invoice_id) \
+        .alias('applied')
+
+    # each live invoice with what the payments made by date_cursor paid of it
+    where = [invoices.c.deleted == False, invoices.c.bill_date <= date_cursor]
+    if policy_ids is not None:
+        where.append(invoices.c.policy_id.in_(policy_ids))
+    invoice = select([invoices.c.policy_id, invoices.c.due_date, invoices.c.amount_due,
+                      func.coalesce(applied.c.applied, 0).label('applied')], and_(*where),
+                     from_obj=[invoices.outerjoin(applied, applied.c.invoice_id == invoices.c.id)]) \
+        .alias('invoice')
+    unpaid = invoice.c.amount_due - invoice.c.applied
+    limits = [date_cursor, date_cursor - timedelta(days=30), date_cursor - timedelta(days=60)]
+
+    columns = [invoice.c.policy_id]
+    for name, (newest, oldest) in zip(BUCKETS, zip([None] + limits, limits + [None])):
+        # each bucket takes the due dates in [oldest, newest), so an
+        # invoice due on date_cursor itself is still current
+        criteria = []
+        if newest is not None:
+            criteria.append(invoice.c.due_date < newest)
+        if oldest is not None:
+            criteria.append(invoice.c.due_date >= oldest)
+        columns.append(func.sum(case([(and_(*criteria), unpaid)], else_=0)).label(name))
+    columns.append(func.sum(invoice.c.amount_due).label('billed'))
+    columns.append(func.sum(invoice.c.applied).label('applied'))
+
+    aged = select(columns).group_by(invoice.c.policy_id).alias('aged')
+
+    joined = policies.outerjoin(aged, aged.c.policy_id == policies.c.id) \
+        .outerjoin(paid, paid.c.policy_id == policies.c.id) \
+        .outerjoin(contacts, contacts.c.id == policies.c.agent)
+    query = select([policies.c.id, policies.c.agent, contacts.c.name] +
+                   [func.coalesce(aged.c[name], 0) for name in BUCKETS + ['billed', 'applied']] +
+                   [func.coalesce(paid.c.paid, 0)],
+                   from_obj=[joined]).order_by(policies.c.id)
+    if policy_ids is not None:
+        query = query.where(policies.c.id.in_(policy_ids))
+    return query
+
+
+def _bucket(due_date, date_cursor):
+    # the index in BUCKETS _aging_query puts an invoice due then in
+    days = (date_cursor - due_date).days
+    if days <= 0:
+        return 0
+    if days <= 30:
+        return 1
+    if days <= 60:
+        return 2
+    return 3
+
+
+def _aged_history(history, date_cursor):
+    """
+     The four buckets and what was billed, applied and paid as of
+     date_cursor, as _aging_query has them, for a policy's
+     archive.full_history().
+    """
+    applied = {}
+    for (_, invoice_id), (transaction_date, amount) in history['applied'].items():
+        if transaction_date <= date_cursor:
+            applied[invoice_id] = applied.get(invoice_id, 0) + amount
+    buckets = [0] * len(BUCKETS)
+    billed = total_applied = 0
+    for invoice in history['invoices']:
+        if invoice.deleted or invoice.bill_date > date_cursor:
+            continue
+        billed += invoice.amount_due
+        total_applied += applied.get(invoice.id, 0)
+        buckets[_bucket(invoice.due_date, date_cursor)] += invoice.amount_due - applied.get(invoice.id, 0)
+    paid = sum(payment.amount_paid for payment in history['payments'] if payment.transaction_date <= date_cursor)
+    return buckets, billed, total_applied, paid
+
+
+def aging_report(date_cursor=None, policy_ids=None):
+    """
+     Aging as of date_cursor for every policy (or the ones in policy_ids)
+     that owes something or is in credit, rolled up by agent. Returns a
+     JSON-able dict with 'policies', 'agents' and 'totals'.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+
+    policies = []
+    agents = {}
+    totals = dict.fromkeys(AMOUNTS, 0)
+    for ids in ([None] if policy_ids is None else chunked(sorted(set(policy_ids)))):
+        history = full_history(archived_whole_ids(ids))
+        for row in db.session.execute(_aging_query(date_cursor, ids)):
+            policy_id, agent_id, agent_name = row[:3]
+            buckets = list(row[3:7])
+            billed, applied, paid = row[7:10]
+            if policy_id in history:
+                buckets, billed, applied, paid = _aged_history(history[policy_id], date_cursor)
+            line = dict(zip(BUCKETS, buckets))
+            line['credit'] = paid - applied
+            line['balance'] = billed - paid
+            if not any(line[name] for name in AMOUNTS):
+                continue
+            line.update(policy_id=policy_id, agent_id=agent_id)
+            policies.append(line)
+
+            agent = agents.get(agent_id)
+            if agent is None:
+                agent = agents[agent_id] = dict(dict.fromkeys(AMOUNTS, 0), agent_id=agent_id,
+                                                agent=agent_name, policies=0)
+            agent['policies'] += 1
+            for name in AMOUNTS:
+                agent[name] += line[name]
+                totals[name] += line[name]
+
+    logger.info("Aging report as of %s: %d policies, %d agents", date_cursor, len(policies), len(agents))
+    return {
+        'date': date_cursor.strftime('%Y-%m-%d'),
+        'policies': policies,
+        'agents': [agents[agent_id] for agent_id in sorted(agents, key=lambda agent_id: (agent_id is None,
+                                                                                          agent_id))],
+        'totals': totals,
+    }
+
+
+def report_csv(report, by='agent'):
+    """
+     The agents (or policies) of an aging report as CSV text.
+    """
+    if by == 'agent':
+        header = ['agent_id', 'agent', 'policies'] + AMOUNTS
+        rows = report['agents']
+    else:
+        header = ['policy_id', 'agent_id'] + AMOUNTS
+        rows = report['policies']
+    stream = StringIO()
+    writer = csv.writer(stream)
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow([u'' if row[name] is None else unicode(row[name]).encode('utf-8') for name in header])
+    return stream.getvalue()
+
+
+def check_aging(report, sample=100, seed=0):
+    """
+     Compares the aging of up to sample policies of report, picked with
+     seed, with return_account_balance. Returns a list of (policy_id,
+     aged, balance) for every policy where the two disagree.
+    """
+    date_cursor = datetime.strptime(report['date'], '%Y-%m-%d').date()
+    lines = report['policies']
+    lines = random.Random(seed).sample(lines, min(sample, len(lines)))
+    mismatches = []
+    for line in lines:
+        aged = sum(line[name] for name in BUCKETS) - line['credit']
+        balance = PolicyReader(line['policy_id']).return_account_balance(date_cursor)
+        if aged != balance:
+            mismatches.append((line['policy_id'], aged, balance))
+    return mismatches
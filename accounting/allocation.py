@@ -0,0 +1,443 @@
+#!/user/bin/env python2.7
+
+import logging
+import weakref
+from collections import namedtuple
+from datetime import date, datetime
+
+from sqlalchemy import and_, bindparam, event, func, or_, select
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.orm.attributes import get_history
+
+from accounting import db
+from chunking import chunked
+from models import Invoice, Payment, PaymentAllocation, Policy
+# imported as a module: it and models import each other through here
+import ledger
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Payment allocation.
+
+Every payment is applied to specific invoices, one row of
+payment_allocations per (payment, invoice). Payments are
+applied in (transaction_date, id) order. A payment goes to
+the invoice it was made for (Payment.invoice_id) first, if
+that one is live and still open, then to the oldest open
+live invoices by bill date, ahead of their bill date when
+it covers more than what was billed so far. What is left
+after the last invoice is an unapplied credit.
+
+Each invoice carries the outcome: amount_paid, and
+paid_in_full_on, the date of the payment that settled it.
+A policy is behind on a date exactly when one of its live
+invoices billed by then wasn't paid in full by then. As long
+as no payment names an invoice, that is the same as what was
+billed by then exceeding what was paid, so evaluate_cancel
+can look at the invoices themselves instead of adding up
+the policy's history.
+
+Allocations are worked out again per policy, from all of its
+invoices and payments, whenever one of them is written: after
+every ORM flush for the policies it touched, and from the
+bulk paths through reallocate(). A back-dated payment or an
+invoice voided by change_policy simply moves the money to
+where it belongs. Only the rows that come out differently
+are written. A new payment dated on or after the policy's
+others, flushed with nothing else on the policy, is just
+applied to the invoices still open, without reading the
+rest of the history.
+#######################################################
+"""
+
+allocations = PaymentAllocation.__table__
+invoices = Invoice.__table__
+payments = Payment.__table__
+
+InvoiceRow = namedtuple('InvoiceRow', ['id', 'bill_date', 'cancel_date', 'amount_due', 'deleted'])
+PaymentRow = namedtuple('PaymentRow', ['id', 'transaction_date', 'amount_paid', 'invoice_id'])
+
+
+def allocate(invoice_rows, payment_rows):
+    """
+     Applies a policy's payments to its invoices. invoice_rows are
+     InvoiceRows in (bill_date, id) order and payment_rows PaymentRows in
+     (transaction_date, id) order. Returns the allocations as
+     {(payment_id, invoice_id): (transaction_date, amount)}, each
+     invoice's (amount_paid, paid_in_full_on) and the credit left over.
+    """
+    live = [invoice for invoice in invoice_rows if not invoice.deleted]
+    owed = dict((invoice.id, invoice.amount_due) for invoice in live)
+    paid = dict((invoice.id, [0, None]) for invoice in invoice_rows)
+    for invoice in live:
+        # nothing to pay: settled the day it is billed
+        if invoice.amount_due <= 0:
+            paid[invoice.id][1] = invoice.bill_date
+
+    applied = {}
+    credit = 0
+    oldest = 0
+    for payment in payment_rows:
+        left = payment.amount_paid
+        target = payment.invoice_id if owed.get(payment.invoice_id) > 0 else None
+        while oldest < len(live) and owed[live[oldest].id] <= 0:
+            oldest += 1
+        position = oldest
+        while left > 0:
+            if target is not None:
+                invoice_id, target = target, None
+            else:
+                while position < len(live) and owed[live[position].id] <= 0:
+                    position += 1
+                if position == len(live):
+                    break
+                invoice_id = live[position].id
+            amount = min(left, owed[invoice_id])
+            left -= amount
+            owed[invoice_id] -= amount
+            applied[(payment.id, invoice_id)] = (payment.transaction_date, amount)
+            paid[invoice_id][0] += amount
+            if owed[invoice_id] == 0:
+                paid[invoice_id][1] = payment.transaction_date
+        credit += left
+    return applied, dict((invoice_id, tuple(value)) for invoice_id, value in paid.items()), credit
+
+
+def _policy_rows(bind, policy_ids):
+    """
+     {policy_id: {'invoices': [InvoiceRow], 'payments': [PaymentRow],
+     'paid': {invoice_id: (amount_paid, paid_in_full_on)},
+     'stored': {(payment_id, invoice_id): (id, transaction_date, amount)}}}
+     as they are in the database.
+    """
+    book = dict((policy_id, {'invoices': [], 'payments': [], 'paid': {}, 'stored': {}})
+                for policy_id in policy_ids)
+    for row in bind.execute(select([invoices.c.policy_id, invoices.c.id, invoices.c.bill_date,
+                                    invoices.c.cancel_date, invoices.c.amount_due, invoices.c.deleted,
+                                    invoices.c.amount_paid, invoices.c.paid_in_full_on],
+                                   invoices.c.policy_id.in_(policy_ids))
+                            .order_by(invoices.c.policy_id, invoices.c.bill_date, invoices.c.id)):
+        policy = book[row.policy_id]
+        policy['invoices'].append(InvoiceRow(row.id, row.bill_date, row.cancel_date, row.amount_due, row.deleted))
+        policy['paid'][row.id] = (row.amount_paid, row.paid_in_full_on)
+    for row in bind.execute(select([payments.c.policy_id, payments.c.id, payments.c.transaction_date,
+                                    payments.c.amount_paid, payments.c.invoice_id],
+                                   payments.c.policy_id.in_(policy_ids))
+                            .order_by(payments.c.policy_id, payments.c.transaction_date, payments.c.id)):
+        book[row.policy_id]['payments'].append(
+            PaymentRow(row.id, row.transaction_date, row.amount_paid, row.invoice_id))
+    for row in bind.execute(select([allocations], allocations.c.policy_id.in_(policy_ids))):
+        book[row.policy_id]['stored'][(row.payment_id, row.invoice_id)] = (row.id, row.transaction_date, row.amount)
+    return book
+
+
+def _sync(bind, policy_ids):
+    """
+     Brings the allocations and paid columns of policy_ids in line with
+     their invoices and payments. Returns the rows it changed.
+    """
+    counts = {'inserted': 0, 'deleted': 0, 'invoices': 0}
+    for ids in chunked(sorted(set(policy_ids))):
+        inserts, deletes, updates = [], [], []
+        for policy_id, rows in _policy_rows(bind, ids).items():
+            applied, paid, _ = allocate(rows['invoices'], rows['payments'])
+            for key, stored in rows['stored'].items():
+                if applied.get(key) != stored[1:]:
+                    deletes.append(stored[0])
+            for (payment_id, invoice_id), (transaction_date, amount) in applied.items():
+                stored = rows['stored'].get((payment_id, invoice_id))
+                if stored is None or stored[1:] != (transaction_date, amount):
+                    inserts.append({'policy_id': policy_id, 'payment_id': payment_id, 'invoice_id': invoice_id,
+                                    'transaction_date': transaction_date, 'amount': amount})
+            for invoice_id, (amount_paid, paid_in_full_on) in paid.items():
+                if rows['paid'][invoice_id] != (amount_paid, paid_in_full_on):
+                    updates.append({'invoice': invoice_id, 'paid': amount_paid, 'paid_on': paid_in_full_on})
+
+        _write(bind, inserts, deletes, updates)
+        counts['inserted'] += len(inserts)
+        counts['deleted'] += len(deletes)
+        counts['invoices'] += len(updates)
+    return counts
+
+
+def _write(bind, inserts, deletes, updates):
+    for part in chunked(deletes):
+        bind.execute(allocations.delete().where(allocations.c.id.in_(part)))
+    if inserts:
+        bind.execute(allocations.insert(), inserts)
+    if updates:
+        bind.execute(invoices.update()
+                     .where(invoices.c.id == bindparam('invoice'))
+                     .values(amount_paid=bindparam('paid'), paid_in_full_on=bindparam('paid_on')),
+                     updates)
+
+
+def _append(bind, policy_id, added):
+    """
+     Applies PaymentRows just inserted for a policy on top of what its
+     other payments were applied to, which gives what _sync would when
+     none of those is dated after them. Returns False, having written
+     nothing, when one is.
+    """
+    added = sorted(added, key=lambda payment: (payment.transaction_date, payment.id))
+    latest = select([func.max(payments.c.transaction_date)],
+                    and_(payments.c.policy_id == policy_id,
+                         ~payments.c.id.in_([payment.id for payment in added]))).as_scalar()
+    # read along with the open invoices, or on its own when there are none
+    open_rows = bind.execute(select([invoices.c.id, invoices.c.amount_due, invoices.c.amount_paid,
+                                     latest.label('latest')],
+                                    and_(invoices.c.policy_id == policy_id, invoices.c.deleted == False,
+                                         invoices.c.paid_in_full_on == None))
+                             .order_by(invoices.c.bill_date, invoices.c.id)).fetchall()
+    latest = open_rows[0].latest if open_rows else bind.execute(select([latest])).scalar()
+    if latest is not None and latest > added[0].transaction_date:
+        return False
+
+    owed = dict((row.id, row.amount_due - row.amount_paid) for row in open_rows)
+    paid = dict((row.id, [row.amount_paid, None]) for row in open_rows)
+    inserts = []
+    for payment in added:
+        left = payment.amount_paid
+        targets = [payment.invoice_id] if owed.get(payment.invoice_id) > 0 else []
+        for invoice_id in targets + [row.id for row in open_rows]:
+            amount = min(left, owed[invoice_id])
+            if amount <= 0:
+                continue
+            left -= amount
+            owed[invoice_id] -= amount
+            paid[invoice_id][0] += amount
+            if owed[invoice_id] == 0:
+                paid[invoice_id][1] = payment.transaction_date
+            inserts.append({'policy_id': policy_id, 'payment_id': payment.id, 'invoice_id': invoice_id,
+                            'transaction_date': payment.transaction_date, 'amount': amount})
+    updates = [{'invoice': row.id, 'paid': paid[row.id][0], 'paid_on': paid[row.id][1]}
+               for row in open_rows if paid[row.id][0] != row.amount_paid]
+    _write(bind, inserts, [], updates)
+    return True
+
+
+def reallocate(policy_ids=None, bind=None, commit=True):
+    """
+     Works out the allocations of the given policies (all of them by
+     default) again and writes what changed. Returns the number of
+     allocations inserted and deleted and of invoices updated.
+    """
+    bind = bind or db.session
+    if policy_ids is None:
+        policies = Policy.__table__
+        policy_ids = [row[0] for row in bind.execute(select([policies.c.id]).order_by(policies.c.id))]
+    counts = _sync(bind, policy_ids)
+    if commit and bind is db.session:
+        db.session.commit()
+    logger.info("Reallocated payments of %d policies: %d allocations written, %d removed, %d invoices updated",
+                len(set(policy_ids)), counts['inserted'], counts['deleted'], counts['invoices'])
+    return counts
+
+
+################################
+# Lookups
+################################
+def open_invoices(policy_id, date_cursor):
+    """
+     (invoice, amount still owed) of every live invoice billed by
+     date_cursor that wasn't paid in full by then, oldest first.
+    """
+    paid = select([func.coalesce(func.sum(allocations.c.amount), 0)],
+                  and_(allocations.c.invoice_id == Invoice.id,
+                       allocations.c.transaction_date <= date_cursor)).as_scalar()
+    rows = db.session.query(Invoice, paid) \
+        .filter(Invoice.policy_id == policy_id) \
+        .filter(Invoice.deleted == False) \
+        .filter(Invoice.bill_date <= date_cursor) \
+        .filter(or_(Invoice.paid_in_full_on == None, Invoice.paid_in_full_on > date_cursor)) \
+        .order_by(Invoice.bill_date, Invoice.id) \
+        .all()
+    return [(invoice, invoice.amount_due - paid) for invoice, paid in rows]
+
+
+def _first_overdue(live, paid_on, date_cursor):
+    """
+     The first of live, invoices in (bill_date, id) order, by cancel
+     date, whose cancel date came by date_cursor while one of the
+     invoices billed by then was still open. paid_on(invoice) is its
+     paid in full date.
+    """
+    due = sorted((invoice for invoice in live if invoice.cancel_date <= date_cursor),
+                 key=lambda invoice: (invoice.cancel_date, invoice.bill_date, invoice.id))
+    # latest paid in full date of the invoices billed so far, None once one of them is open for good
+    latest = date.min
+    billed = 0
+    for invoice in due:
+        while billed < len(live) and live[billed].bill_date <= invoice.cancel_date:
+            day = paid_on(live[billed])
+            latest = None if latest is None or day is None else max(latest, day)
+            billed += 1
+        if latest is None or latest > invoice.cancel_date:
+            return invoice
+    return None
+
+
+def overdue_invoice(policy_id, date_cursor):
+    """
+     The first live invoice, by cancel date, whose cancel date came by
+     date_cursor while some invoice billed by then was still open, or
+     None. One indexed read of the policy's invoices.
+    """
+    live = Invoice.query.filter_by(policy_id=policy_id) \
+        .filter(Invoice.deleted == False) \
+        .filter(Invoice.bill_date <= date_cursor) \
+        .order_by(Invoice.bill_date, Invoice.id) \
+        .all()
+    return _first_overdue(live, lambda invoice: invoice.paid_in_full_on, date_cursor)
+
+
+################################
+# Verify
+################################
+def _behind_by_balance(rows, date_cursor):
+    # evaluate_cancel's original rule: billed by the cancel date exceeds paid by then
+    live = [invoice for invoice in rows['invoices'] if not invoice.deleted]
+    for invoice in sorted(live, key=lambda invoice: (invoice.cancel_date, invoice.bill_date, invoice.id)):
+        if invoice.cancel_date > date_cursor:
+            break
+        billed = sum(other.amount_due for other in live if other.bill_date <= invoice.cancel_date)
+        paid = sum(payment.amount_paid for payment in rows['payments']
+                   if payment.transaction_date <= invoice.cancel_date)
+        if billed > paid:
+            return invoice.id
+    return None
+
+
+def _behind_by_allocations(rows, date_cursor):
+    live = [invoice for invoice in rows['invoices'] if not invoice.deleted]
+    invoice = _first_overdue(live, lambda invoice: rows['paid'][invoice.id][1], date_cursor)
+    return invoice.id if invoice is not None else None
+
+
+def verify_allocations(policy_ids=None, date_cursor=None, bind=None):
+    """
+     Checks the stored allocations and paid columns against the ones
+     worked out from scratch, what they leave owing against the ledger
+     balance, and, for policies without targeted payments, the invoice
+     they cancel on by date_cursor against the one the balance gives.
+     Returns a list of (policy_id, message) for every mismatch.
+    """
+    bind = bind or db.session
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    if policy_ids is None:
+        policies = Policy.__table__
+        policy_ids = [row[0] for row in bind.execute(select([policies.c.id]).order_by(policies.c.id))]
+
+    differences = []
+    for ids in chunked(sorted(set(policy_ids))):
+        book = _policy_rows(bind, ids)
+        balances = ledger.balances_as_of(ids, date.max, bind)
+        for policy_id in ids:
+            rows = book[policy_id]
+            applied, paid, _ = allocate(rows['invoices'], rows['payments'])
+            for key in sorted(set(applied) | set(rows['stored'])):
+                expected = applied.get(key)
+                found = rows['stored'].get(key)
+                if expected != (found[1:] if found else None):
+                    differences.append((policy_id, "payment %s on invoice %s: expected %s, found %s" % (
+                        key[0], key[1], expected, found[1:] if found else None)))
+            for invoice_id in sorted(paid):
+                if paid[invoice_id] != rows['paid'][invoice_id]:
+                    differences.append((policy_id, "invoice %s paid (amount, in full on): expected %s, found %s" % (
+                        invoice_id, paid[invoice_id], rows['paid'][invoice_id])))
+
+            owing = sum(invoice.amount_due - rows['paid'][invoice.id][0]
+                        for invoice in rows['invoices'] if not invoice.deleted)
+            credit = sum(payment.amount_paid for payment in rows['payments']) - \
+                sum(amount for _, _, amount in rows['stored'].values())
+            if owing - credit != balances.get(policy_id, 0):
+                differences.append((policy_id, "open invoices less unapplied credit come to %d, balance is %d" % (
+                    owing - credit, balances.get(policy_id, 0))))
+
+            if not any(payment.invoice_id for payment in rows['payments']):
+                expected = _behind_by_balance(rows, date_cursor)
+                found = _behind_by_allocations(rows, date_cursor)
+                if expected != found:
+                    differences.append((policy_id, "cancels as of %s on invoice %s by balance, %s by allocations" % (
+                        date_cursor, expected, found)))
+
+    for policy_id, message in differences:
+        logger.warning("Allocation mismatch on policy %s: %s", policy_id, message)
+    return differences
+
+
+################################
+# ORM flush events
+################################
+# per session: the policies whose invoices or payments it flushed, and the
+# payments it inserted, by policy
+_pending = weakref.WeakKeyDictionary()
+
+
+def _pending_for(session):
+    pending = _pending.get(session)
+    if pending is None:
+        pending = _pending[session] = {'policies': set(), 'payments': {}}
+    return pending
+
+
+def _row_listeners(*attributes):
+    """
+     after_delete and after_update listeners noting the policy of an
+     invoice or payment whose write can move money around.
+    """
+    def written(mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            _pending_for(session)['policies'].update(
+                policy_id for policy_id in get_history(target, 'policy_id').sum() if policy_id is not None)
+
+    def updated(mapper, connection, target):
+        if any(get_history(target, attribute).has_changes() for attribute in ('policy_id',) + attributes):
+            written(mapper, connection, target)
+
+    return written, updated
+
+
+def _payment_inserted(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        _pending_for(session)['payments'].setdefault(target.policy_id, []).append(
+            PaymentRow(target.id, target.transaction_date, target.amount_paid, target.invoice_id))
+
+
+def _flushed(session, flush_context):
+    pending = _pending.pop(session, None)
+    if pending is None:
+        return
+    policy_ids = pending['policies']
+    for policy_id, added in pending['payments'].items():
+        # the usual new payment: only it has to be applied
+        if policy_id not in policy_ids and not _append(session, policy_id, added):
+            policy_ids.add(policy_id)
+    if policy_ids:
+        _sync(session, policy_ids)
+    # written behind the ORM's back: invoices already loaded read them again
+    touched = policy_ids | set(pending['payments'])
+    for instance in session.identity_map.values():
+        if isinstance(instance, Invoice) and instance.__dict__.get('policy_id') in touched:
+            session.expire(instance, ['amount_paid', 'paid_in_full_on'])
+
+
+def _discarded(session):
+    _pending.pop(session, None)
+
+
+invoice_written, invoice_updated = _row_listeners('bill_date', 'amount_due', 'deleted')
+payment_written, payment_updated = _row_listeners('transaction_date', 'amount_paid', 'invoice_id')
+event.listen(Invoice, 'after_insert', invoice_written)
+event.listen(Invoice, 'after_update', invoice_updated)
+event.listen(Invoice, 'after_delete', invoice_written)
+event.listen(Payment, 'after_insert', _payment_inserted)
+event.listen(Payment, 'after_update', payment_updated)
+event.listen(Payment, 'after_delete', payment_written)
+event.listen(Session, 'after_flush_postexec', _flushed)
+event.listen(Session, 'after_rollback', _discarded)
@@ -0,0 +1,366 @@
+#!/user/bin/env python2.7
+
+import logging
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, case, exc, func, or_, select, text
+
+from accounting import db, settings
+from allocation import InvoiceRow, PaymentRow, allocate
+from chunking import chunked
+from ledger import rebuild_ledger
+from models import (ArchivedInvoice, ArchivedPayment, BalanceCheckpoint, Invoice, LedgerEntry, Payment,
+                    PaymentAllocation, Policy)
+# imported as a module: it and models import each other through here
+import cache
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Hot/cold archival.
+
+archive_rows() moves rows nothing live reads any more out of
+invoices and payments, into archived_invoices and
+archived_payments in the same file, ARCHIVE_BATCH_SIZE at a
+time, each batch in its own transaction:
+
+    invoices voided (deleted) on any policy
+    every invoice and payment of Canceled or Expired
+    policies that are fully paid up and have had no
+    activity since the cut-off date
+
+Their ledger rows, checkpoints and payment allocations go
+too. The policy row itself stays where it is, stamped with
+archived_on, and that is what the read side looks at:
+PolicyReader and policy_summaries only go to the archive
+tables for a policy with archived_on set, so lookups of
+every other policy run exactly as before. get_invoices
+lists archived invoices along with the live ones; balances
+and cancellation checks of a policy archived whole are
+summed from both.
+
+The set-based readers do the same for the policies archived
+whole, which are few: the aging report and the columnar
+book read them through full_history(), with their payments
+applied again the way allocation.allocate() does, and the
+cancellation sweep asks PolicyReader. The columnar book
+also loads the voided invoices archived from live policies,
+and full extracts of invoices and payments include every
+archived row.
+
+The newest row of invoices and of payments is never moved,
+so SQLite doesn't hand its id out again to a new row.
+#######################################################
+"""
+
+CLOSED_STATUSES = (u'Canceled', u'Expired')
+
+invoices = Invoice.__table__
+payments = Payment.__table__
+archived_invoices = ArchivedInvoice.__table__
+archived_payments = ArchivedPayment.__table__
+
+INVOICE_COLUMNS = ['id', 'policy_id', 'bill_date', 'due_date', 'cancel_date', 'amount_due', 'deleted']
+PAYMENT_COLUMNS = ['id', 'policy_id', 'contact_id', 'amount_paid', 'transaction_date']
+
+SIZED_TABLES = ['invoices', 'payments', 'ledger', 'balance_checkpoints', 'payment_allocations',
+                'archived_invoices', 'archived_payments']
+
+
+################################
+# Reading
+################################
+def has_archived_invoices(policy):
+    """
+     Whether some of the policy's invoices (voided ones at least) are in
+     archived_invoices.
+    """
+    return policy.archived_on is not None
+
+
+def has_archived_totals(policy):
+    """
+     Whether invoices or payments that count towards the policy's balance
+     were archived, so the ledger and checkpoints no longer cover it.
+     Only closed policies are archived whole.
+    """
+    return policy.archived_on is not None and policy.status in CLOSED_STATUSES
+
+
+def totals_as_of(policy_id, date_cursor, bind=None):
+    """
+     (billed, paid) on the policy as of date_cursor, over the live and
+     the archived rows.
+    """
+    bind = bind or db.session
+    billed = paid = 0
+    for table in (invoices, archived_invoices):
+        billed += bind.execute(select([func.coalesce(func.sum(table.c.amount_due), 0)],
+                                      and_(table.c.policy_id == policy_id, table.c.deleted == False,
+                                           table.c.bill_date <= date_cursor))).scalar()
+    for table in (payments, archived_payments):
+        paid += bind.execute(select([func.coalesce(func.sum(table.c.amount_paid), 0)],
+                                    and_(table.c.policy_id == policy_id,
+                                         table.c.transaction_date <= date_cursor))).scalar()
+    return billed, paid
+
+
+def balance_as_of(policy_id, date_cursor, bind=None):
+    billed, paid = totals_as_of(policy_id, date_cursor, bind)
+    return billed - paid
+
+
+def with_archived_invoices(policy_id, date_cursor, live, include_deleted=True):
+    """
+     The live invoices of the policy billed up to date_cursor plus the
+     archived ones, in bill date order.
+    """
+    query = ArchivedInvoice.query.filter(ArchivedInvoice.policy_id == policy_id) \
+        .filter(ArchivedInvoice.bill_date <= date_cursor)
+    if not include_deleted:
+        query = query.filter(ArchivedInvoice.deleted == False)
+    return sorted(list(live) + query.all(), key=lambda invoice: (invoice.bill_date, invoice.id))
+
+
+def with_archived_payments(policy_id, date_cursor, live):
+    """
+     (transaction_date, amount_paid) rows of the policy's live payments
+     made up to date_cursor plus the archived ones, in date order.
+    """
+    archived = db.session.query(ArchivedPayment.transaction_date, ArchivedPayment.amount_paid) \
+        .filter(ArchivedPayment.policy_id == policy_id) \
+        .filter(ArchivedPayment.transaction_date <= date_cursor) \
+        .all()
+    return sorted(list(live) + archived, key=lambda payment: payment.transaction_date)
+
+
+def archived_policy_ids(policy_ids, bind=None):
+    """
+     Those of policy_ids that have rows in the archive tables.
+    """
+    bind = bind or db.session
+    policies = Policy.__table__
+    found = set()
+    for ids in chunked(sorted(set(policy_ids))):
+        found.update(row[0] for row in bind.execute(
+            select([policies.c.id], and_(policies.c.id.in_(ids), policies.c.archived_on != None))))
+    return found
+
+
+def archived_whole_ids(policy_ids=None, statuses=None, bind=None):
+    """
+     Ids of the policies (of policy_ids, or all, with one of statuses when
+     given) archived whole, the ones has_archived_totals() is true of.
+    """
+    bind = bind or db.session
+    policies = Policy.__table__
+    where = [policies.c.archived_on != None, policies.c.status.in_(CLOSED_STATUSES)]
+    if statuses:
+        where.append(policies.c.status.in_(statuses))
+    found = []
+    for ids in ([None] if policy_ids is None else chunked(sorted(set(policy_ids)))):
+        criteria = where if ids is None else where + [policies.c.id.in_(ids)]
+        found.extend(row[0] for row in bind.execute(select([policies.c.id], and_(*criteria))))
+    return sorted(found)
+
+
+def full_history(policy_ids, bind=None):
+    """
+     {policy_id: {'invoices': [row], 'payments': [row], 'applied': {...},
+     'paid': {...}}} for policies archived whole, over their live and
+     archived rows: invoices in (bill_date, id) order, payments in
+     (transaction_date, id) order, and applied and paid as
+     allocation.allocate() returns them, which the archive keeps no
+     allocations for. Payments go to the oldest open invoices whatever
+     invoice they were made for, as PolicyReader reads these policies.
+    """
+    bind = bind or db.session
+    history = dict((policy_id, {'invoices': [], 'payments': []}) for policy_id in policy_ids)
+    for ids in chunked(sorted(history)):
+        for table in (invoices, archived_invoices):
+            for row in bind.execute(select([table.c[name] for name in INVOICE_COLUMNS], table.c.policy_id.in_(ids))):
+                history[row.policy_id]['invoices'].append(row)
+        for table in (payments, archived_payments):
+            for row in bind.execute(select([table.c[name] for name in PAYMENT_COLUMNS], table.c.policy_id.in_(ids))):
+                history[row.policy_id]['payments'].append(row)
+    for rows in history.values():
+        rows['invoices'].sort(key=lambda row: (row.bill_date, row.id))
+        rows['payments'].sort(key=lambda row: (row.transaction_date, row.id))
+        rows['applied'], rows['paid'], _ = allocate(
+            [InvoiceRow(row.id, row.bill_date, row.cancel_date, row.amount_due, row.deleted)
+             for row in rows['invoices']],
+            [PaymentRow(row.id, row.transaction_date, row.amount_paid, None) for row in rows['payments']])
+    return history
+
+
+################################
+# Archiving
+################################
+def table_sizes(bind=None):
+    """
+     Rows and bytes (tables plus their indexes, when SQLite was built with
+     the dbstat table) of the tables archival moves rows between.
+    """
+    bind = bind or db.session
+    sizes = dict((name, {'rows': bind.execute("SELECT COUNT(*) FROM %s" % name).scalar(), 'bytes': None})
+                 for name in SIZED_TABLES)
+    try:
+        rows = bind.execute("SELECT m.tbl_name, SUM(s.pgsize) FROM dbstat s JOIN sqlite_master m "
+                            "ON m.name = s.name GROUP BY m.tbl_name").fetchall()
+    except exc.OperationalError:
+        return sizes
+    for name, size in rows:
+        if name in sizes:
+            sizes[name]['bytes'] = size
+    return sizes
+
+
+def _newest_ids(bind):
+    return (bind.execute(select([func.max(invoices.c.id)])).scalar() or 0,
+            bind.execute(select([func.max(payments.c.id)])).scalar() or 0)
+
+
+def _move(bind, source, target, columns, where, archived_on):
+    """
+     Copies the rows of source matching where (SQL text) to target and
+     deletes them. Returns the number of rows moved.
+    """
+    listed = ', '.join(columns)
+    bind.execute(text("INSERT INTO %s (%s, archived_on) SELECT %s, :archived_on FROM %s WHERE %s" % (
+        target.name, listed, listed, source.name, where)), {'archived_on': archived_on.strftime('%Y-%m-%d')})
+    return bind.execute(text("DELETE FROM %s WHERE %s" % (source.name, where))).rowcount
+
+
+def _in(column, ids):
+    # ids come from the database and are integers, so they can be inlined
+    return "%s IN (%s)" % (column, ', '.join(str(int(value)) for value in ids))
+
+
+def _stamp(bind, policy_ids, archived_on):
+    policies = Policy.__table__
+    bind.execute(policies.update().where(policies.c.id.in_(policy_ids)).values(archived_on=archived_on))
+
+
+def _voided_invoices(bind, newest_invoice, policy_ids=None):
+    found = []
+    for ids in ([None] if policy_ids is None else chunked(sorted(set(policy_ids)))):
+        where = [invoices.c.deleted == True, invoices.c.id < newest_invoice]
+        if ids is not None:
+            where.append(invoices.c.policy_id.in_(ids))
+        found.extend(bind.execute(select([invoices.c.id, invoices.c.policy_id], and_(*where))
+                                  .order_by(invoices.c.id)).fetchall())
+    return sorted(found)
+
+
+def _closed_query(before, newest_invoice, newest_payment, ids):
+    policies = Policy.__table__
+    billed = select([invoices.c.policy_id,
+                     func.sum(case([(invoices.c.deleted == False, invoices.c.amount_due)], else_=0)).label('billed'),
+                     func.max(invoices.c.bill_date).label('last'),
+                     func.max(invoices.c.id).label('newest')])
+    paid = select([payments.c.policy_id,
+                   func.sum(payments.c.amount_paid).label('paid'),
+                   func.max(payments.c.transaction_date).label('last'),
+                   func.max(payments.c.id).label('newest')])
+    where = [policies.c.status.in_(CLOSED_STATUSES)]
+    if ids is not None:
+        billed = billed.where(invoices.c.policy_id.in_(ids))
+        paid = paid.where(payments.c.policy_id.in_(ids))
+        where.append(policies.c.id.in_(ids))
+    billed = billed.group_by(invoices.c.policy_id).alias('billed')
+    paid = paid.group_by(payments.c.policy_id).alias('paid')
+    where.extend([or_(billed.c.policy_id != None, paid.c.policy_id != None),
+                  func.coalesce(billed.c.billed, 0) == func.coalesce(paid.c.paid, 0),
+                  or_(billed.c.last == None, billed.c.last < before),
+                  or_(paid.c.last == None, paid.c.last < before),
+                  or_(billed.c.newest == None, billed.c.newest < newest_invoice),
+                  or_(paid.c.newest == None, paid.c.newest < newest_payment)])
+    return select([policies.c.id, policies.c.archived_on], and_(*where),
+                  from_obj=[policies.outerjoin(billed, billed.c.policy_id == policies.c.id)
+                                    .outerjoin(paid, paid.c.policy_id == policies.c.id)])
+
+
+def closed_policies(before, policy_ids=None, bind=None):
+    """
+     Ids of the Canceled and Expired policies (of policy_ids, or all)
+     with live invoices or payments, fully paid up, and with nothing
+     billed or paid on or after before.
+    """
+    bind = bind or db.session
+    newest_invoice, newest_payment = _newest_ids(bind)
+    found = []
+    for ids in ([None] if policy_ids is None else chunked(sorted(set(policy_ids)))):
+        for policy_id, archived_on in bind.execute(_closed_query(before, newest_invoice, newest_payment,
+                                                                 ids)).fetchall():
+            # archived before: what's live now may only settle what's archived
+            if archived_on is not None and balance_as_of(policy_id, datetime.max.date(), bind) != 0:
+                continue
+            found.append(policy_id)
+    return sorted(found)
+
+
+def archive_rows(before=None, batch_size=None, progress=None, policy_ids=None):
+    """
+     Moves voided invoices, and the invoices and payments of closed
+     policies settled with no activity since before (ARCHIVE_AFTER_DAYS
+     ago by default), to the archive tables, for the policies in
+     policy_ids or all of them. progress(done, total) is
+     called after every batch. Returns a summary with the table sizes
+     before and after.
+    """
+    if not before:
+        before = datetime.now().date() - timedelta(days=settings['ARCHIVE_AFTER_DAYS'])
+    batch_size = batch_size or settings['ARCHIVE_BATCH_SIZE']
+    archived_on = datetime.now().date()
+    session = db.session
+
+    started = time.time()
+    summary = {'before': before, 'voided_invoices': 0, 'policies': 0, 'invoices': 0, 'payments': 0,
+               'batches': 0, 'sizes': {'before': table_sizes(session)}}
+    newest_invoice, _ = _newest_ids(session)
+    voided = _voided_invoices(session, newest_invoice, policy_ids)
+    closed = closed_policies(before, policy_ids, session)
+    total = len(voided) + len(closed)
+    done = 0
+
+    try:
+        for batch in chunked(voided, batch_size):
+            policy_ids = sorted(set(policy_id for _, policy_id in batch))
+            summary['voided_invoices'] += _move(session, invoices, archived_invoices, INVOICE_COLUMNS,
+                                                _in('id', [invoice_id for invoice_id, _ in batch]), archived_on)
+            _stamp(session, policy_ids, archived_on)
+            # the Invoice and Void rows of each voided invoice cancel out
+            rebuild_ledger(policy_ids, bind=session, commit=False)
+            session.commit()
+            summary['batches'] += 1
+            done += len(batch)
+            if progress is not None:
+                progress(done, total)
+
+        for policy_ids in chunked(closed, batch_size):
+            where = _in('policy_id', policy_ids)
+            summary['invoices'] += _move(session, invoices, archived_invoices, INVOICE_COLUMNS, where, archived_on)
+            summary['payments'] += _move(session, payments, archived_payments, PAYMENT_COLUMNS, where,
+                                         archived_on)
+            for table in (LedgerEntry.__table__, BalanceCheckpoint.__table__, PaymentAllocation.__table__):
+                session.execute(table.delete().where(table.c.policy_id.in_(policy_ids)))
+            _stamp(session, policy_ids, archived_on)
+            cache.invalidate_policies(policy_ids)
+            session.commit()
+            summary['policies'] += len(policy_ids)
+            summary['batches'] += 1
+            done += len(policy_ids)
+            if progress is not None:
+                progress(done, total)
+    except:
+        session.rollback()
+        raise
+
+    summary['sizes']['after'] = table_sizes(session)
+    summary['seconds'] = time.time() - started
+    logger.info("Archived %d voided invoices and %d closed policies (%d invoices, %d payments) in %.3fs",
+                summary['voided_invoices'], summary['policies'], summary['invoices'], summary['payments'],
+                summary['seconds'])
+    return summary
@@ -0,0 +1,370 @@
+#!/user/bin/env python2.7
+
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import traceback
+from datetime import datetime
+from Queue import Empty
+
+from sqlalchemy import and_, select
+
+from accounting import db, settings
+from cache import response_cache
+from database import close_connections
+from logs import configure_logging
+from models import Policy
+from reschedule import reschedule_policies
+from utils import PolicyAccounting, PolicyReader
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Sharded batch runs over the whole book.
+
+run_batch() splits the policy ids into contiguous shards
+and runs one accounting operation over every policy of each
+shard in a pool of worker processes, BATCH_CHUNK_SIZE
+policies at a time. Each worker opens its own connections,
+as gunicorn workers do, and sends every chunk's rows back to
+the parent as soon as it is done. The parent merges them
+into one CSV in policy id order.
+
+With a checkpoint directory the rows of every finished chunk
+are kept in a file per shard, together with the last policy
+id it covered, so a run that stopped part way picks up where
+each shard left off when started again with the same
+directory. The writing operations are safe to repeat on a
+chunk: invoices are only generated for policies without any,
+and reschedule leaves alone the policies already on the new
+schedule.
+
+SQLite takes one writer at a time, so only the reading
+operations (balances, cancellations) scale with workers;
+the others mostly queue on the write lock.
+#######################################################
+"""
+
+
+def _balances(policy_ids, options):
+    date_cursor = options['date_cursor']
+    return [[policy_id, PolicyReader(policy_id).return_account_balance(date_cursor)] for policy_id in policy_ids]
+
+
+def _cancellations(policy_ids, options):
+    rows = []
+    for policy_id in policy_ids:
+        result = PolicyReader(policy_id).evaluate_cancel(options['date_cursor'])
+        if result:
+            rows.append([policy_id, str(result.cancel_date), result.invoice.id, result.outstanding])
+    return rows
+
+
+def _invoices(policy_ids, options):
+    return [[policy_id] for policy_id in policy_ids
+            if PolicyAccounting(policy_id, generate_invoices=False).ensure_invoices()]
+
+
+def _reschedule(policy_ids, options):
+    schedule = options['schedule']
+    policies = Policy.__table__
+    # moved already, by an earlier try at this chunk
+    pending = [row[0] for row in db.session.execute(
+        select([policies.c.id], and_(policies.c.id.in_(policy_ids), policies.c.billing_schedule != schedule)))]
+    if not pending:
+        return []
+    summary = reschedule_policies(pending, schedule, options['date_cursor'], chunk_size=len(pending))
+    skipped = dict(summary['skipped'])
+    return [[policy_id, skipped.get(policy_id, 'moved')] for policy_id in pending]
+
+
+# what a shard reports back as how far it got when it fails, with the
+# traceback in place of the rows
+FAILED = 'failed'
+
+# name: (function, CSV header). A function takes a chunk of policy ids
+# and the run's options and returns the rows of the chunk.
+OPERATIONS = {
+    'balances': (_balances, ['policy_id', 'balance']),
+    'cancellations': (_cancellations, ['policy_id', 'cancel_date', 'invoice_id', 'outstanding']),
+    'invoices': (_invoices, ['policy_id']),
+    'reschedule': (_reschedule, ['policy_id', 'result']),
+}
+
+
+def shard_ranges(policy_ids, shards):
+    """
+     Splits policy_ids into at most shards contiguous runs of about the
+     same size. Returns their (first id, last id) pairs.
+    """
+    policy_ids = sorted(set(policy_ids))
+    shards = max(min(shards, len(policy_ids)), 1)
+    ranges = []
+    for index in range(shards):
+        part = policy_ids[index * len(policy_ids) // shards:(index + 1) * len(policy_ids) // shards]
+        if part:
+            ranges.append((part[0], part[-1]))
+    return ranges
+
+
+def _shard_policies(low, high, after, policy_ids):
+    policies = Policy.__table__
+    query = select([policies.c.id], and_(policies.c.id >= max(low, after + 1), policies.c.id <= high)) \
+        .order_by(policies.c.id)
+    found = [row[0] for row in db.session.execute(query)]
+    if policy_ids is not None:
+        found = [policy_id for policy_id in found if policy_id in policy_ids]
+    return found
+
+
+def _run_shard(task, emit):
+    """
+     Runs the operation over the policies of one shard after the last one
+     done, calling emit(shard, through, policies, rows) after every chunk
+     and emit(shard, None, 0, None) at the end.
+    """
+    operation, options, shard, low, high, after, policy_ids = task
+    function = OPERATIONS[operation][0]
+    chunk_size = options['chunk_size']
+    try:
+        pending = _shard_policies(low, high, after, policy_ids)
+        for start in range(0, len(pending), chunk_size):
+            ids = pending[start:start + chunk_size]
+            rows = function(ids, options)
+            db.session.remove()
+            emit(shard, ids[-1], len(ids), rows)
+        emit(shard, None, 0, None)
+    except Exception:
+        db.session.rollback()
+        db.session.remove()
+        emit(shard, FAILED, 0, traceback.format_exc())
+
+
+################################
+# Worker processes
+################################
+_results = None
+
+
+def _init_worker(results):
+    # the same things a forked gunicorn worker drops, see accounting.server
+    global _results
+    _results = results
+    configure_logging(settings)
+    close_connections(db)
+    response_cache.clear()
+
+
+def _pool_shard(task):
+    _run_shard(task, lambda *message: _results.put(message))
+
+
+################################
+# Checkpoints
+################################
+class Checkpoints(object):
+    """
+     The job description and one file of finished chunks per shard, in
+     directory. Every line of a shard file is one chunk,
+     {"through": last policy id, "policies": count, "rows": [...]},
+     and a last {"done": true} once the shard is finished.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}
+
+    def _job_path(self):
+        return os.path.join(self.directory, 'job.json')
+
+    def shard_path(self, shard):
+        return os.path.join(self.directory, 'shard-%04d.jsonl' % shard)
+
+    def start(self, job):
+        """
+         Saves job, or checks it matches the one saved by an earlier run,
+         and returns the saved one.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if os.path.exists(self._job_path()):
+            saved = json.load(open(self._job_path()))
+            for key in ('operation', 'options'):
+                if saved[key] != job[key]:
+                    raise ValueError("Checkpoint directory %s holds a %s run with %s, not %s with %s" % (
+                        self.directory, saved['operation'], saved['options'], job['operation'], job['options']))
+            return saved
+        with open(self._job_path(), 'w') as stream:
+            json.dump(job, stream)
+        return job
+
+    def read(self, shard):
+        """
+         (last policy id done, policies done, finished) of the shard. A
+         chunk cut short by a crash is dropped.
+        """
+        through, policies, done = 0, 0, False
+        if not os.path.exists(self.shard_path(shard)):
+            return through, policies, done
+        kept = []
+        for line in open(self.shard_path(shard)):
+            try:
+                chunk = json.loads(line)
+            except ValueError:
+                break
+            kept.append(line)
+            if chunk.get('done'):
+                done = True
+            else:
+                through = chunk['through']
+                policies += chunk['policies']
+        with open(self.shard_path(shard), 'w') as stream:
+            stream.writelines(kept)
+        return through, policies, done
+
+    def record(self, shard, through, policies, rows):
+        stream = self.files.get(shard)
+        if stream is None:
+            stream = self.files[shard] = open(self.shard_path(shard), 'a')
+        line = {'done': True} if through is None else {'through': through, 'policies': policies, 'rows': rows}
+        stream.write(json.dumps(line) + '\n')
+        stream.flush()
+        os.fsync(stream.fileno())
+
+    def rows(self, shard):
+        for line in open(self.shard_path(shard)):
+            chunk = json.loads(line)
+            for row in chunk.get('rows', ()):
+                yield row
+
+    def close(self):
+        for stream in self.files.values():
+            stream.close()
+        self.files = {}
+
+
+def _write_rows(output, header, checkpoints, shards):
+    writer = csv.writer(output)
+    writer.writerow(header)
+    written = 0
+    for shard in range(shards):
+        if os.path.exists(checkpoints.shard_path(shard)):
+            for row in checkpoints.rows(shard):
+                writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else value for value in row])
+                written += 1
+    return written
+
+
+def run_batch(operation, output, date_cursor=None, workers=None, shards=None, chunk_size=None,
+              checkpoint_dir=None, policy_ids=None, schedule=None, progress=None):
+    """
+     Runs operation over every policy (or the ones in policy_ids) with
+     workers processes and writes the merged CSV to the output stream.
+     progress(done, total) is called as chunks come back. Returns a
+     summary of the run.
+    """
+    if operation not in OPERATIONS:
+        raise ValueError("Unknown operation %r, pick one of %s" % (operation, ', '.join(sorted(OPERATIONS))))
+    if operation == 'reschedule' and schedule not in PolicyAccounting.billing_schedules:
+        raise ValueError("reschedule needs a billing schedule, one of %s" %
+                         ', '.join(sorted(PolicyAccounting.billing_schedules)))
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    workers = workers or settings['BATCH_WORKERS']
+    chunk_size = chunk_size or settings['BATCH_CHUNK_SIZE']
+    options = {'date_cursor': date_cursor.strftime('%Y-%m-%d'), 'schedule': schedule}
+
+    started = time.time()
+    selected = set(policy_ids) if policy_ids is not None else None
+    if selected is None:
+        all_ids = [row[0] for row in db.session.execute(select([Policy.__table__.c.id]))]
+    else:
+        all_ids = list(selected)
+    db.session.remove()
+
+    temporary = checkpoint_dir is None
+    checkpoints = Checkpoints(tempfile.mkdtemp(prefix='batch-') if temporary else checkpoint_dir)
+    try:
+        job = checkpoints.start({'operation': operation, 'options': options,
+                                 'shards': shard_ranges(all_ids, shards or settings['BATCH_SHARDS'])})
+        ranges = job['shards']
+
+        tasks = []
+        counts = {'done': 0, 'resumed': 0}
+        for shard, (low, high) in enumerate(ranges):
+            through, policies, done = checkpoints.read(shard)
+            if through or done:
+                counts['resumed'] += 1
+            counts['done'] += policies
+            if not done:
+                tasks.append((operation, dict(options, date_cursor=date_cursor, chunk_size=chunk_size),
+                              shard, low, high, through, selected))
+        total = len(all_ids)
+
+        failures = []
+
+        def collect(shard, through, policies, rows):
+            if through == FAILED:
+                logger.error("Batch %s shard %d failed:\n%s", operation, shard, rows)
+                failures.append(shard)
+                return
+            checkpoints.record(shard, through, policies, rows)
+            counts['done'] += policies
+            if through is not None and progress is not None:
+                progress(counts['done'], total)
+
+        if workers == 1 or len(tasks) <= 1:
+            for task in tasks:
+                _run_shard(task, collect)
+        else:
+            _run_pool(tasks, workers, collect)
+        checkpoints.close()
+
+        if failures:
+            raise RuntimeError("Batch %s failed on shard(s) %s, see the log; run again with the same "
+                               "checkpoint directory to resume" % (operation, ', '.join(map(str, failures))))
+
+        rows = _write_rows(output, OPERATIONS[operation][1], checkpoints, len(ranges))
+    finally:
+        checkpoints.close()
+        if temporary:
+            shutil.rmtree(checkpoints.directory, ignore_errors=True)
+
+    seconds = time.time() - started
+    summary = {'operation': operation, 'policies': total, 'rows': rows, 'shards': len(ranges),
+               'resumed_shards': counts['resumed'], 'workers': workers, 'seconds': seconds,
+               'per_second': total / seconds if seconds else None}
+    logger.info("Batch %s over %d policies in %d shards with %d workers: %d rows in %.3fs",
+                operation, total, len(ranges), workers, rows, seconds)
+    return summary
+
+
+def _run_pool(tasks, workers, collect):
+    results = multiprocessing.Queue()
+    pool = multiprocessing.Pool(min(workers, len(tasks)), _init_worker, (results,))
+    try:
+        pending = [pool.apply_async(_pool_shard, (task,)) for task in tasks]
+        running = len(tasks)
+        while running:
+            try:
+                shard, through, policies, rows = results.get(timeout=1)
+            except Empty:
+                # a worker that died outright never reports back
+                if all(result.ready() for result in pending) and results.empty():
+                    raise RuntimeError("A batch worker exited without finishing its shard")
+                continue
+            collect(shard, through, policies, rows)
+            if through is None or through == FAILED:
+                running -= 1
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
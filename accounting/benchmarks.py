@@ -0,0 +1,414 @@
+#!/user/bin/env python2.7
+
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import event, func, select
+
+from accounting import create_app, db, settings
+from batch import run_batch
+from cache import response_cache
+from columnar import ColumnarBook
+from logs import configure_logging, flush as flush_logs
+from models import Contact, Invoice, Payment, Policy
+from utils import PolicyAccounting, PolicyReader
+from writequeue import WriteQueue
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Benchmarks for the accounting engine.
+
+run_benchmarks() times the main PolicyAccounting operations
+and the get_result view on a sample of policies, usually of
+a synthetic book made by accounting.synthetic, and reports
+latency percentiles and SQL statement counts. Results are
+plain JSON so runs can be compared across commits.
+#######################################################
+"""
+
+OPERATIONS = ['return_account_balance', 'evaluate_cancel', 'get_result', 'make_invoices', 'change_policy']
+
+
+class StatementCounter(object):
+    """
+     Context manager counting the SQL statements sent to the engine
+     while it is active:
+
+        with StatementCounter() as counter:
+            ...
+        print counter.statements
+    """
+    # SQLAlchemy 0.7 can't remove engine listeners, so a single listener
+    # feeds whichever counters are active. It is registered when this
+    # module is imported: connections checked out before that don't see it.
+    active = []
+
+    def __init__(self):
+        self.statements = 0
+
+    @classmethod
+    def _before_cursor_execute(cls, conn, cursor, statement, parameters, context, executemany):
+        for counter in cls.active:
+            counter.statements += 1
+
+    def __enter__(self):
+        StatementCounter.active.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        StatementCounter.active.remove(self)
+
+
+event.listen(db.engine, 'before_cursor_execute', StatementCounter._before_cursor_execute)
+
+
+def compare_balance_api(policy_ids=None, date_cursor=None):
+    """
+     Times looking up policy_ids (all policies by default) one get_result
+     request at a time against a single /api/balances request, counting
+     the SQL statements each way needs.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    if policy_ids is None:
+        policy_ids = [row[0] for row in db.session.execute(select([Policy.__table__.c.id]))]
+    policy_ids = policy_ids[:settings['BALANCE_API_MAX_POLICIES']]
+    supplied_date = date_cursor.strftime('%Y-%m-%d')
+    client = create_app().test_client()
+
+    with StatementCounter() as view_counter:
+        started = time.time()
+        for policy_id in policy_ids:
+            client.get('/%s/%s' % (policy_id, supplied_date))
+        view_seconds = time.time() - started
+
+    with StatementCounter() as api_counter:
+        started = time.time()
+        client.post('/api/balances', content_type='application/json',
+                    data=json.dumps({'policies': policy_ids, 'date': supplied_date}))
+        api_seconds = time.time() - started
+
+    return {
+        'policies': len(policy_ids),
+        'get_result': {'seconds': view_seconds, 'statements': view_counter.statements},
+        'api_balances': {'seconds': api_seconds, 'statements': api_counter.statements},
+    }
+
+
+def percentile(ordered, fraction):
+    """
+     Nearest-rank percentile of an already sorted list.
+    """
+    if not ordered:
+        return None
+    rank = int(math.ceil(fraction * len(ordered)))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+def summarize(latencies, statements):
+    """
+     Latency percentiles (in milliseconds) and the average number of SQL
+     statements of one operation.
+    """
+    ordered = sorted(seconds * 1000 for seconds in latencies)
+    return {
+        'count': len(ordered),
+        'mean_ms': sum(ordered) / len(ordered) if ordered else None,
+        'p50_ms': percentile(ordered, 0.50),
+        'p90_ms': percentile(ordered, 0.90),
+        'p99_ms': percentile(ordered, 0.99),
+        'max_ms': ordered[-1] if ordered else None,
+        'statements': float(sum(statements)) / len(statements) if statements else None,
+    }
+
+
+def measure(calls):
+    """
+     Runs every (setup, operation) pair, timing only the operation and
+     counting its SQL statements. setup's return value is passed on.
+    """
+    latencies = []
+    statements = []
+    for setup, operation in calls:
+        argument = setup()
+        with StatementCounter() as counter:
+            started = time.time()
+            operation(argument)
+            latencies.append(time.time() - started)
+        statements.append(counter.statements)
+    return summarize(latencies, statements)
+
+
+LOGGING_MODES = [('off', {'LOG_LEVEL': 'OFF'}),
+                 ('sync', {'LOG_LEVEL': 'DEBUG', 'LOG_ASYNC': False}),
+                 ('async', {'LOG_LEVEL': 'DEBUG', 'LOG_ASYNC': True})]
+
+
+def compare_logging(sample=200, seed=0, date_cursor=None, rounds=3):
+    """
+     Times get_result on sample policies with logging off, with every
+     DEBUG line written synchronously on the request thread and with the
+     queued writer of accounting.logs. The response cache is emptied
+     before every request so each one does the full lookup.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    supplied_date = date_cursor.strftime('%Y-%m-%d')
+    policy_ids = [row[0] for row in db.session.execute(select([Policy.__table__.c.id]))]
+    sampled = sorted(random.Random(seed).sample(policy_ids, min(sample, len(policy_ids))))
+    client = create_app().test_client()
+
+    def lookup(policy_id):
+        def setup():
+            response_cache.clear()
+            return '/%s/%s' % (policy_id, supplied_date)
+        return setup
+
+    handle, path = tempfile.mkstemp(suffix='.log')
+    os.close(handle)
+    results = {}
+    try:
+        for mode, overrides in LOGGING_MODES:
+            configure_logging(dict(settings, LOG_FILE=path, LOG_TO_CONSOLE=False, LOG_LEVELS={}, **overrides))
+            results[mode] = measure((lookup(policy_id), client.get) for policy_id in sampled * rounds)
+            started = time.time()
+            flush_logs()
+            results[mode]['drain_seconds'] = time.time() - started
+    finally:
+        configure_logging(settings)
+        os.remove(path)
+    return results
+
+
+def compare_write_paths(payments=2000, threads=8, date_cursor=None):
+    """
+     Makes payments on throwaway policies from several threads, first
+     with make_payment (one commit each), then through a WriteQueue
+     (group commits), and reports payments per second for both.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    agent_id, policy_ids = _throwaway_policies(threads, date_cursor - relativedelta(months=6))
+    queue = WriteQueue(settings['WRITE_QUEUE_MAX_BATCH'], settings['WRITE_QUEUE_MAX_DELAY_MS'] / 1000.0)
+
+    def per_call(policy_id, count):
+        for _ in range(count):
+            PolicyAccounting(policy_id, generate_invoices=False).make_payment(agent_id, date_cursor, 1)
+        db.session.remove()
+
+    def queued(policy_id, count):
+        for _ in range(count):
+            queue.submit_payment(policy_id, agent_id, date_cursor, 1).result()
+
+    results = {'payments': payments, 'threads': threads}
+    try:
+        for name, work in (('per_call', per_call), ('queued', queued)):
+            if name == 'queued':
+                queue.start()
+            workers = [threading.Thread(target=work, args=(policy_id, payments / threads)) for policy_id in policy_ids]
+            started = time.time()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            seconds = time.time() - started
+            results[name] = {'seconds': seconds, 'per_second': payments // threads * threads / seconds}
+        queue.stop()
+        results['queued']['batches'] = queue.batches
+    finally:
+        queue.stop()
+        _remove_throwaway_policies(agent_id, policy_ids)
+    return results
+
+
+def compare_batch_workers(operation='balances', workers=(1, 2, 4), date_cursor=None, sample=None, seed=0):
+    """
+     Runs a reading batch operation over the book (or sample policies of
+     it) with each number of workers and reports the speedup over the
+     first. The CSV is thrown away.
+    """
+    if operation not in ('balances', 'cancellations'):
+        raise ValueError("Only the reading operations can be timed, not %r" % operation)
+    policy_ids = None
+    if sample:
+        policy_ids = [row[0] for row in db.session.execute(select([Policy.__table__.c.id]))]
+        policy_ids = random.Random(seed).sample(policy_ids, min(sample, len(policy_ids)))
+        db.session.remove()
+
+    runs = []
+    for count in workers:
+        with open(os.devnull, 'wb') as output:
+            summary = run_batch(operation, output, date_cursor, workers=count, shards=count * 4,
+                                policy_ids=policy_ids)
+        runs.append({'workers': count, 'seconds': summary['seconds'], 'per_second': summary['per_second'],
+                     'speedup': runs[0]['seconds'] / summary['seconds'] if runs else 1.0})
+    return {'operation': operation, 'policies': summary['policies'], 'cpus': multiprocessing.cpu_count(),
+            'runs': runs}
+
+
+def _cancel_key(result):
+    return (result.should_cancel, result.invoice.id if result.invoice else None, result.outstanding)
+
+
+def compare_columnar(sample=200, seed=0, date_cursor=None):
+    """
+     Loads a ColumnarBook and times balance, evaluate_cancel and
+     get_invoices on sample policies against PolicyReader, checking
+     both give the same answers. Includes the book's memory report.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    policy_ids = [row[0] for row in db.session.execute(select([Policy.__table__.c.id]))]
+    sampled = sorted(random.Random(seed).sample(policy_ids, min(sample, len(policy_ids))))
+
+    book = ColumnarBook()
+    results = {'sample': len(sampled), 'load_seconds': book.load(), 'memory': book.memory_report(),
+               'mismatches': []}
+    calls = [('return_account_balance', lambda answer: answer),
+             ('evaluate_cancel', _cancel_key),
+             ('get_invoices', lambda answer: [invoice.id for invoice in answer])]
+    for name, key in calls:
+        started = time.time()
+        reader = [key(getattr(PolicyReader(policy_id), name)(date_cursor)) for policy_id in sampled]
+        reader_ms = (time.time() - started) * 1000 / max(len(sampled), 1)
+        db.session.remove()
+
+        started = time.time()
+        columnar = [key(getattr(book, name)(policy_id, date_cursor)) for policy_id in sampled]
+        columnar_ms = (time.time() - started) * 1000 / max(len(sampled), 1)
+
+        results[name] = {'policy_reader_ms': reader_ms, 'columnar_ms': columnar_ms}
+        results['mismatches'].extend((name, policy_id) for policy_id, expected, answer
+                                     in zip(sampled, reader, columnar) if expected != answer)
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.STDOUT,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _throwaway_policies(count, effective_date):
+    """
+     Quarterly policies without invoices for the write benchmarks.
+    """
+    agent = Contact(u'Benchmark Agent', u'Agent')
+    db.session.add(agent)
+    db.session.commit()
+    policies = []
+    for number in range(count):
+        policy = Policy(u'Benchmark %d' % number, effective_date, 1200)
+        policy.billing_schedule = u'Quarterly'
+        policy.agent = agent.id
+        db.session.add(policy)
+        policies.append(policy)
+    db.session.commit()
+    return agent.id, [policy.id for policy in policies]
+
+
+def _remove_throwaway_policies(agent_id, policy_ids):
+    for invoice in Invoice.query.filter(Invoice.policy_id.in_(policy_ids)).all():
+        db.session.delete(invoice)
+    for payment in Payment.query.filter(Payment.policy_id.in_(policy_ids)).all():
+        db.session.delete(payment)
+    for policy in Policy.query.filter(Policy.id.in_(policy_ids)).all():
+        db.session.delete(policy)
+    db.session.delete(Contact.query.get(agent_id))
+    db.session.commit()
+
+
+def run_benchmarks(sample=200, seed=0, date_cursor=None, operations=OPERATIONS):
+    """
+     Times each of the operations on sample policies picked with seed.
+     The write operations run on throwaway policies that are removed
+     afterwards. Returns a JSON-able dict of results.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    supplied_date = date_cursor.strftime('%Y-%m-%d')
+    # start from a fresh connection so the statement counter sees everything
+    db.session.remove()
+
+    policy_ids = [row[0] for row in db.session.execute(select([Policy.__table__.c.id]))]
+    sampled = sorted(random.Random(seed).sample(policy_ids, min(sample, len(policy_ids))))
+    results = {
+        'meta': {
+            'revision': _git_revision(),
+            'started': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'database': settings['SQLALCHEMY_DATABASE_URI'],
+            'policies': len(policy_ids),
+            'invoices': db.session.query(func.count(Invoice.id)).scalar(),
+            'payments': db.session.query(func.count(Payment.id)).scalar(),
+            'sample': len(sampled),
+            'seed': seed,
+            'date': supplied_date,
+        },
+        'operations': {},
+    }
+    reader = lambda policy_id: lambda: PolicyReader(policy_id)
+
+    if 'return_account_balance' in operations:
+        results['operations']['return_account_balance'] = measure(
+            (reader(policy_id), lambda pa: pa.return_account_balance(date_cursor)) for policy_id in sampled)
+
+    if 'evaluate_cancel' in operations:
+        results['operations']['evaluate_cancel'] = measure(
+            (reader(policy_id), lambda pa: pa.evaluate_cancel(date_cursor)) for policy_id in sampled)
+
+    if 'get_result' in operations:
+        client = create_app().test_client()
+        results['operations']['get_result'] = measure(
+            (lambda policy_id=policy_id: '/%s/%s' % (policy_id, supplied_date), client.get)
+            for policy_id in sampled)
+
+    if 'make_invoices' in operations or 'change_policy' in operations:
+        effective_date = date_cursor - relativedelta(months=6)
+        agent_id, throwaway = _throwaway_policies(len(sampled), effective_date)
+        try:
+            writer = lambda policy_id: lambda: PolicyAccounting(policy_id, generate_invoices=False)
+            results['operations']['make_invoices'] = measure(
+                (writer(policy_id), lambda pa: pa.make_invoices()) for policy_id in throwaway)
+            if 'change_policy' in operations:
+                change_date = effective_date + relativedelta(months=2)
+                results['operations']['change_policy'] = measure(
+                    (writer(policy_id), lambda pa: pa.change_policy('Monthly', change_date))
+                    for policy_id in throwaway)
+        finally:
+            _remove_throwaway_policies(agent_id, throwaway)
+        if 'make_invoices' not in operations:
+            del results['operations']['make_invoices']
+
+    results['meta']['finished'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    return results
+
+
+def compare_results(before, after):
+    """
+     Lines comparing two saved runs metric by metric.
+    """
+    lines = ["%s (%s) -> %s (%s)" % (before['meta']['revision'], before['meta']['started'],
+                                     after['meta']['revision'], after['meta']['started'])]
+    for operation in OPERATIONS:
+        if operation not in before['operations'] or operation not in after['operations']:
+            continue
+        for metric in ('p50_ms', 'p90_ms', 'p99_ms', 'statements'):
+            old = before['operations'][operation][metric]
+            new = after['operations'][operation][metric]
+            change = (new - old) / old * 100 if old else 0.0
+            lines.append("  %-24s %-10s %10.3f -> %10.3f  %+7.1f%%" % (operation, metric, old, new, change))
+    return lines
@@ -0,0 +1,262 @@
+#!/user/bin/env python2.7
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+import metrics
+from export import reading_bind
+from models import Invoice, Payment, Policy
+
+"""
+#######################################################
+Response cache for policy lookups.
+
+get_result is asked for the same (policy, date) pairs over
+and over. ResponseCache keeps what it computed for recent
+pairs, dropping the least recently used entry when full and
+any entry older than its time to live.
+
+The gunicorn workers, the batch jobs, ingest and the write
+queue write from other processes, so every key carries the
+policy's data_version(): the row_versions and row counts of
+the policy and its invoices and payments, read in one
+indexed statement. A write from anywhere changes it, and
+the entries of the old version are simply never asked for
+again. The ETag comes from the key too, so any worker can
+answer a repeat poll with a 304 before computing anything.
+
+Writes made in this process also drop the policy's entries
+right away: at flush time from ORM events, again when the
+transaction commits or rolls back so a lookup that raced the
+write can't keep what it read, and from the bulk paths that
+bypass the ORM through invalidate_policies().
+#######################################################
+"""
+
+COUNTERS = ('hits', 'misses', 'evictions', 'expirations', 'invalidations')
+
+CacheEntry = namedtuple('CacheEntry', ['policy_id', 'value', 'etag', 'expires'])
+
+
+def etag_for(key):
+    return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+
+# a few index entries per table; run on a pooled DB-API connection, as
+# get_result asks for it on every lookup
+DATA_VERSION = ("SELECT row_version, "
+                "(SELECT max(row_version) FROM invoices WHERE policy_id = :policy_id), "
+                "(SELECT count(*) FROM invoices WHERE policy_id = :policy_id), "
+                "(SELECT max(row_version) FROM payments WHERE policy_id = :policy_id), "
+                "(SELECT count(*) FROM payments WHERE policy_id = :policy_id) "
+                "FROM policies WHERE id = :policy_id")
+
+
+def data_version(policy_id):
+    """
+     The policy's row_version with the highest row_version and the number
+     of its invoices and of its payments, as a tuple, read from what
+     db.session reads; None for an unknown policy. Every insert, update
+     or delete changes it.
+    """
+    connection = reading_bind().raw_connection()
+    try:
+        row = metrics.execute(connection.cursor(), DATA_VERSION, {'policy_id': policy_id}).fetchone()
+    finally:
+        connection.close()
+    return tuple(row) if row is not None else None
+
+
+class ResponseCache(object):
+    """
+     Bounded LRU cache with a time to live, whose entries are indexed by
+     policy id so they can be invalidated a policy at a time. A max_entries
+     of 0 turns it off.
+    """
+
+    def __init__(self, max_entries=10000, ttl=60, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.by_policy = {}
+        # bumped on every invalidation, so a value computed while its
+        # policy was being written is never stored
+        self.versions = {}
+        self.generation = 0
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.lock = threading.Lock()
+
+    def configure(self, max_entries, ttl):
+        with self.lock:
+            self.max_entries = max_entries
+            self.ttl = ttl
+        self.clear()
+
+    def version(self, policy_id):
+        """
+         Token to hand back to put() for a value computed from now on.
+        """
+        with self.lock:
+            return self.generation, self.versions.get(policy_id, 0)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry.expires <= self.clock():
+                self._unindex(key, entry)
+                self.counts['expirations'] += 1
+                entry = None
+            if entry is None:
+                self.counts['misses'] += 1
+                return None
+            # re-inserted as the most recently used
+            self.entries[key] = entry
+            self.counts['hits'] += 1
+            return entry
+
+    def put(self, policy_id, key, value, version):
+        """
+         Stores value under key unless policy_id was invalidated since
+         version was taken. Returns the entry either way.
+        """
+        entry = CacheEntry(policy_id, value, etag_for(key), self.clock() + self.ttl)
+        with self.lock:
+            if self.max_entries <= 0 or version != (self.generation, self.versions.get(policy_id, 0)):
+                return entry
+            if self.entries.pop(key, None) is None:
+                self.by_policy.setdefault(policy_id, set()).add(key)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                oldest, evicted = self.entries.popitem(last=False)
+                self._unindex(oldest, evicted)
+                self.counts['evictions'] += 1
+        return entry
+
+    def invalidate(self, policy_ids):
+        with self.lock:
+            for policy_id in policy_ids:
+                self.versions[policy_id] = self.versions.get(policy_id, 0) + 1
+                for key in self.by_policy.pop(policy_id, ()):
+                    if self.entries.pop(key, None) is not None:
+                        self.counts['invalidations'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.counts['invalidations'] += len(self.entries)
+            self.entries.clear()
+            self.by_policy.clear()
+            self.versions.clear()
+            self.generation += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, entries=len(self.entries))
+
+    def reset_counts(self):
+        with self.lock:
+            self.counts = dict.fromkeys(COUNTERS, 0)
+
+    def _unindex(self, key, entry):
+        keys = self.by_policy.get(entry.policy_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_policy[entry.policy_id]
+
+
+response_cache = ResponseCache()
+
+
+class CacheMetrics(object):
+    """
+     Serves the cache counters on /metrics next to the request metrics.
+    """
+    name = 'accounting_response_cache'
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def exposition(self):
+        stats = self.cache.stats()
+        lines = ["# HELP %s_events_total Response cache lookups and removals." % self.name,
+                 "# TYPE %s_events_total counter" % self.name]
+        for counter in COUNTERS:
+            lines.append('%s_events_total{event="%s"} %d' % (self.name, counter, stats[counter]))
+        lines.extend(["# HELP %s_entries Entries held by the response cache." % self.name,
+                      "# TYPE %s_entries gauge" % self.name,
+                      "%s_entries %d" % (self.name, stats['entries'])])
+        return lines
+
+    def reset(self):
+        self.cache.reset_counts()
+
+
+metrics.REGISTRY.append(CacheMetrics(response_cache))
+
+
+def configure(config):
+    response_cache.configure(config.get('RESPONSE_CACHE_SIZE', 0),
+                             config.get('RESPONSE_CACHE_SECONDS', 60))
+
+
+################################
+# Invalidation
+################################
+_local = threading.local()
+
+
+def _pending():
+    pending = getattr(_local, 'pending', None)
+    if pending is None:
+        pending = _local.pending = set()
+    return pending
+
+
+def invalidate_policies(policy_ids=None):
+    """
+     Drops the cached lookups of policy_ids (of every policy by default)
+     now and again when the current transaction ends.
+    """
+    if policy_ids is None:
+        _pending().add(None)
+        response_cache.clear()
+        return
+    policy_ids = set(policy_ids)
+    _pending().update(policy_ids)
+    response_cache.invalidate(policy_ids)
+
+
+def _transaction_ended(session):
+    pending = _pending()
+    if None in pending:
+        response_cache.clear()
+    elif pending:
+        response_cache.invalidate(pending)
+    pending.clear()
+
+
+def _row_written(mapper, connection, target):
+    # an update may move an invoice or payment to another policy
+    invalidate_policies(policy_id for policy_id in get_history(target, 'policy_id').sum()
+                        if policy_id is not None)
+
+
+def _policy_written(mapper, connection, target):
+    invalidate_policies([target.id])
+
+
+for model in (Invoice, Payment):
+    for event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, event_name, _row_written)
+event.listen(Policy, 'after_update', _policy_written)
+event.listen(Policy, 'after_delete', _policy_written)
+event.listen(Session, 'after_commit', _transaction_ended)
+event.listen(Session, 'after_rollback', _transaction_ended)
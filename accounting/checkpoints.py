@@ -0,0 +1,206 @@
+#!/user/bin/env python2.7
+
+import calendar
+import logging
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import and_, event, func, select
+from sqlalchemy.orm.attributes import get_history
+
+from accounting import db
+from chunking import chunked
+from models import BalanceCheckpoint, Invoice, Payment, Policy
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Month-end balance checkpoints.
+
+For every month in which a policy had any activity,
+balance_checkpoints holds what was billed on live invoices
+and what was paid up to the end of that month. totals_as_of()
+starts from the nearest checkpoint on or before the date
+asked for and only adds up the rows after it, so an as-of
+query reads at most a month of invoices and payments however
+old the policy is.
+
+refresh_checkpoints() extends them from each policy's latest
+checkpoint and is meant to run from cron (./manage.py
+checkpoints refresh). A write dated on or before a checkpoint
+(a back-dated payment, an invoice voided or rebilled by
+change_policy) deletes the policy's checkpoints from that
+date on, and the next refresh writes them again.
+#######################################################
+"""
+
+checkpoints = BalanceCheckpoint.__table__
+invoices = Invoice.__table__
+payments = Payment.__table__
+
+# amount, date and filter of the rows that add up to billed and paid
+SOURCES = [('billed', invoices.c.amount_due, invoices.c.bill_date, invoices.c.deleted == False),
+           ('paid', payments.c.amount_paid, payments.c.transaction_date, None)]
+
+
+def month_end(day):
+    return day.replace(day=calendar.monthrange(day.year, day.month)[1])
+
+
+def last_month_end(day):
+    """
+     The latest month-end on or before day.
+    """
+    if month_end(day) == day:
+        return day
+    return day.replace(day=1) - timedelta(days=1)
+
+
+def totals_as_of(policy_id, date_cursor, bind=None):
+    """
+     (billed, paid) on the policy up to and including date_cursor.
+    """
+    bind = bind or db.session
+    checkpoint = bind.execute(
+        select([checkpoints.c.period_end, checkpoints.c.billed, checkpoints.c.paid])
+        .where(and_(checkpoints.c.policy_id == policy_id, checkpoints.c.period_end <= date_cursor))
+        .order_by(checkpoints.c.period_end.desc())
+        .limit(1)).first()
+    since, billed, paid = checkpoint if checkpoint is not None else (None, 0, 0)
+
+    totals = []
+    for _, amount, date_column, criterion in SOURCES:
+        where = [amount.table.c.policy_id == policy_id, date_column <= date_cursor]
+        if since is not None:
+            where.append(date_column > since)
+        if criterion is not None:
+            where.append(criterion)
+        totals.append(select([func.coalesce(func.sum(amount), 0)]).where(and_(*where)).as_scalar())
+    billed_after, paid_after = bind.execute(select(totals)).first()
+    return billed + billed_after, paid + paid_after
+
+
+def _latest_checkpoints(bind, policy_ids):
+    latest = select([checkpoints.c.policy_id, func.max(checkpoints.c.period_end).label('period_end')]) \
+        .where(checkpoints.c.policy_id.in_(policy_ids)) \
+        .group_by(checkpoints.c.policy_id) \
+        .alias('latest')
+    rows = bind.execute(select([checkpoints.c.policy_id, checkpoints.c.period_end,
+                                checkpoints.c.billed, checkpoints.c.paid],
+                               and_(checkpoints.c.policy_id == latest.c.policy_id,
+                                    checkpoints.c.period_end == latest.c.period_end)))
+    return dict((policy_id, (period_end, billed, paid)) for policy_id, period_end, billed, paid in rows)
+
+
+def _monthly_totals(bind, policy_ids, through):
+    """
+     {(policy_id, month-end): {'billed': .., 'paid': ..}} for the months
+     after each policy's latest checkpoint, up to through.
+    """
+    months = {}
+    for name, amount, date_column, criterion in SOURCES:
+        table = amount.table
+        since = select([func.max(checkpoints.c.period_end)]) \
+            .where(checkpoints.c.policy_id == table.c.policy_id) \
+            .as_scalar()
+        where = [table.c.policy_id.in_(policy_ids), date_column <= through,
+                 date_column > func.coalesce(since, date(1, 1, 1))]
+        if criterion is not None:
+            where.append(criterion)
+        month = func.strftime('%Y-%m', date_column)
+        rows = bind.execute(select([table.c.policy_id, month, func.sum(amount)], and_(*where))
+                            .group_by(table.c.policy_id, month))
+        for policy_id, year_month, total in rows:
+            period_end = month_end(datetime.strptime(year_month, '%Y-%m').date())
+            months.setdefault((policy_id, period_end), {'billed': 0, 'paid': 0})[name] = total
+    return months
+
+
+def refresh_checkpoints(policy_ids=None, through=None, bind=None, commit=True):
+    """
+     Writes the checkpoints missing after each policy's latest one, for
+     every month up to through (by default the last month-end before
+     today) that has invoices or payments. Returns the number written.
+    """
+    bind = bind or db.session
+    through = last_month_end(through or datetime.now().date())
+    if policy_ids is None:
+        policies = Policy.__table__
+        policy_ids = [row[0] for row in bind.execute(select([policies.c.id]).order_by(policies.c.id))]
+
+    written = 0
+    for ids in chunked(sorted(set(policy_ids))):
+        latest = _latest_checkpoints(bind, ids)
+        rows = []
+        running = {}
+        months = _monthly_totals(bind, ids, through)
+        for policy_id, period_end in sorted(months):
+            if policy_id not in running:
+                _, billed, paid = latest.get(policy_id, (None, 0, 0))
+                running[policy_id] = [billed, paid]
+            totals = running[policy_id]
+            totals[0] += months[(policy_id, period_end)]['billed']
+            totals[1] += months[(policy_id, period_end)]['paid']
+            rows.append({'policy_id': policy_id, 'period_end': period_end,
+                         'billed': totals[0], 'paid': totals[1]})
+        if rows:
+            bind.execute(checkpoints.insert(), rows)
+            written += len(rows)
+    if commit and bind is db.session:
+        db.session.commit()
+    logger.info("Wrote %d balance checkpoints through %s", written, through)
+    return written
+
+
+def invalidate_from(bind, earliest):
+    """
+     Deletes each policy's checkpoints on or after earliest[policy_id],
+     the date of the earliest row written for it.
+    """
+    for ids in chunked(sorted(earliest)):
+        latest = bind.execute(select([checkpoints.c.policy_id, func.max(checkpoints.c.period_end)])
+                              .where(checkpoints.c.policy_id.in_(ids))
+                              .group_by(checkpoints.c.policy_id)).fetchall()
+        for policy_id, period_end in latest:
+            if period_end >= earliest[policy_id]:
+                _delete_from(bind, policy_id, earliest[policy_id])
+
+
+def _delete_from(bind, policy_id, day):
+    bind.execute(checkpoints.delete().where(and_(checkpoints.c.policy_id == policy_id,
+                                                 checkpoints.c.period_end >= day)))
+
+
+################################
+# ORM flush events
+################################
+def _row_listeners(date_attribute, *attributes):
+    """
+     after_insert/after_delete and after_update listeners dropping the
+     checkpoints a write to an invoice or payment makes stale.
+    """
+    def written(mapper, connection, target):
+        days = [day for day in get_history(target, date_attribute).sum() if day is not None]
+        for policy_id in get_history(target, 'policy_id').sum():
+            if policy_id is not None and days:
+                _delete_from(connection, policy_id, min(days))
+
+    def updated(mapper, connection, target):
+        if any(get_history(target, attribute).has_changes()
+               for attribute in (date_attribute, 'policy_id') + attributes):
+            written(mapper, connection, target)
+
+    return written, updated
+
+
+def _policy_deleted(mapper, connection, target):
+    connection.execute(checkpoints.delete().where(checkpoints.c.policy_id == target.id))
+
+
+for model, listeners in ((Invoice, _row_listeners('bill_date', 'deleted', 'amount_due')),
+                         (Payment, _row_listeners('transaction_date', 'amount_paid'))):
+    written, updated = listeners
+    event.listen(model, 'after_insert', written)
+    event.listen(model, 'after_update', updated)
+    event.listen(model, 'after_delete', written)
+event.listen(Policy, 'after_delete', _policy_deleted)
@@ -0,0 +1,23 @@
+#!/user/bin/env python2.7
+
+"""
+#######################################################
+Splitting lists of ids for IN (...) clauses.
+
+Kept free of model imports so that every module can use
+it, models included.
+#######################################################
+"""
+
+# SQLite refuses statements with more than 999 bound parameters,
+# so IN (...) lists are always sent in chunks of this size.
+IN_CLAUSE_CHUNK = 500
+
+
+def chunked(values, size=IN_CLAUSE_CHUNK):
+    """
+     Splits a list of values into consecutive lists of at most size items.
+    """
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
@@ -0,0 +1,357 @@
+#!/user/bin/env python2.7
+
+import logging
+import sys
+import time
+from array import array
+from bisect import bisect_right
+from datetime import date, datetime
+
+from sqlalchemy import String, func, select, type_coerce
+
+from accounting import db, settings
+from archive import archived_whole_ids, full_history
+from chunking import chunked
+from models import ArchivedInvoice, Invoice, Payment
+from utils import CancellationResult
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+In-memory columnar book for batch jobs.
+
+ColumnarBook loads invoices and payments once and answers
+return_account_balance, evaluate_cancel and get_invoices for
+any policy and date without another query. Each policy is a
+PolicyColumns record holding a few flat arrays:
+
+    bill_dates, billed        live invoices by bill date, with
+                              the running total billed
+    payment_dates, paid       payments by date, with the
+                              running total paid
+    invoices                  every invoice, deleted ones too,
+                              INVOICE_FIELDS per row
+
+Dates are kept as ordinals, so a balance is two binary
+searches. evaluate_cancel only depends on the earliest cancel
+date by which an invoice billed then wasn't paid in full,
+going by the invoices' paid_in_full_on, which is worked out
+when the policy is loaded. Invoices voided and archived are
+loaded along with the live ones, and policies archived whole
+from all their rows (archive.full_history()), paid in full
+dates included.
+
+refresh() reloads the policies whose invoices or payments
+have a row_version above the watermark of the last load, as
+./manage.py export does. Rows deleted outright are only
+noticed by a full load().
+#######################################################
+"""
+
+INVOICE_FIELDS = ('id', 'bill_date', 'due_date', 'cancel_date', 'amount_due', 'deleted')
+STRIDE = len(INVOICE_FIELDS)
+
+EMPTY_DATES = array('i')
+EMPTY_TOTALS = array('l')
+
+
+class InvoiceRecord(object):
+    """
+     The columns of an invoice get_invoices hands back instead of an
+     Invoice: nothing is attached to a session.
+    """
+    __slots__ = ('id', 'policy_id', 'bill_date', 'due_date', 'cancel_date', 'amount_due', 'deleted')
+
+    def __init__(self, policy_id, row):
+        self.policy_id = policy_id
+        self.id, bill_date, due_date, cancel_date, self.amount_due, deleted = row
+        self.bill_date = date.fromordinal(bill_date)
+        self.due_date = date.fromordinal(due_date)
+        self.cancel_date = date.fromordinal(cancel_date)
+        self.deleted = bool(deleted)
+
+    def __repr__(self):
+        return "<InvoiceRecord %s policy %s billed %s %d%s>" % (
+            self.id, self.policy_id, self.bill_date, self.amount_due, " deleted" if self.deleted else "")
+
+
+class PolicyColumns(object):
+    __slots__ = ('policy_id', 'bill_dates', 'billed', 'payment_dates', 'paid', 'invoices', 'overdue')
+
+    def __init__(self, policy_id, invoices, payments):
+        """
+         invoices are (id, bill, due, cancel, amount, deleted, paid in full)
+         and payments (date, amount) tuples with ordinal dates, sorted by
+         date; the paid in full ordinal is 0 for an open invoice.
+        """
+        self.policy_id = policy_id
+        self.invoices = array('i')
+        self.bill_dates, self.billed = array('i'), array('l')
+        total = 0
+        for row in invoices:
+            self.invoices.extend(row[:STRIDE])
+            if not row[5]:
+                total += row[4]
+                self.bill_dates.append(row[1])
+                self.billed.append(total)
+        self.payment_dates, self.paid = EMPTY_DATES, EMPTY_TOTALS
+        if payments:
+            self.payment_dates, self.paid = array('i'), array('l')
+            total = 0
+            for day, amount in payments:
+                total += amount
+                self.payment_dates.append(day)
+                self.paid.append(total)
+        if not self.bill_dates:
+            self.bill_dates, self.billed = EMPTY_DATES, EMPTY_TOTALS
+        self.overdue = self._first_overdue(invoices)
+
+    def balance(self, ordinal):
+        billed = bisect_right(self.bill_dates, ordinal)
+        paid = bisect_right(self.payment_dates, ordinal)
+        return (self.billed[billed - 1] if billed else 0) - (self.paid[paid - 1] if paid else 0)
+
+    def _first_overdue(self, invoices):
+        """
+         (cancel date, invoice row, outstanding) of the first live invoice,
+         by cancel date, whose cancel date came while an invoice billed by
+         then wasn't paid in full, as allocation.overdue_invoice finds it.
+         Every invoice billed by then is billed on or before that date,
+         so the answer is the same for every date_cursor past it.
+        """
+        live = [row for row in invoices if not row[5]]
+        # latest paid in full date of the invoices billed so far, None once one of them is open for good
+        latest = 0
+        billed = 0
+        for row in sorted(live, key=lambda row: (row[3], row[1], row[0])):
+            while billed < len(live) and live[billed][1] <= row[3]:
+                day = live[billed][6]
+                latest = None if latest is None or not day else max(latest, day)
+                billed += 1
+            if latest is None or latest > row[3]:
+                return row[3], row[:STRIDE], self.balance(row[3])
+        return None
+
+    def invoices_through(self, ordinal):
+        """
+         Rows of every invoice, deleted ones too, billed on or before the
+         ordinal, in bill date order.
+        """
+        rows = self.invoices
+        low, high = 0, len(rows) // STRIDE
+        while low < high:
+            middle = (low + high) // 2
+            if rows[middle * STRIDE + 1] <= ordinal:
+                low = middle + 1
+            else:
+                high = middle
+        return [tuple(rows[start:start + STRIDE]) for start in range(0, low * STRIDE, STRIDE)]
+
+    def nbytes(self):
+        size = sys.getsizeof(self)
+        for name in ('bill_dates', 'billed', 'payment_dates', 'paid', 'invoices'):
+            column = getattr(self, name)
+            if column is not EMPTY_DATES and column is not EMPTY_TOTALS:
+                size += sys.getsizeof(column)
+        if self.overdue is not None:
+            size += sys.getsizeof(self.overdue) + sys.getsizeof(self.overdue[1])
+        return size
+
+
+class ColumnarBook(object):
+    """
+     Invoices and payments of every policy held in memory. Loads
+     everything on the first query unless load() was called already.
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or settings['EXPORT_BATCH_SIZE']
+        self.policies = {}
+        self.watermarks = None
+        self.invoice_count = self.payment_count = 0
+        self._ordinals = {}
+
+    ################################
+    # Loading
+    ################################
+    def _ordinal(self, value):
+        # dates come back as YYYY-MM-DD text; a book has a few thousand distinct ones
+        try:
+            return self._ordinals[value]
+        except KeyError:
+            ordinal = self._ordinals[value] = datetime.strptime(value, '%Y-%m-%d').date().toordinal()
+            return ordinal
+
+    def _rows(self, query):
+        result = db.session.execute(query)
+        while True:
+            rows = result.fetchmany(self.batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+        result.close()
+
+    def _read(self, policy_ids=None):
+        """
+         {policy_id: ([invoice rows], [payment rows])} for the given
+         policies, or all of them.
+        """
+        invoices = Invoice.__table__
+        payments = Payment.__table__
+        archived = ArchivedInvoice.__table__
+        text = lambda column: type_coerce(column, String)
+        ordinal = self._ordinal
+
+        read = {}
+        for ids in ([None] if policy_ids is None else chunked(sorted(policy_ids))):
+            query = select([invoices.c.policy_id, invoices.c.id, text(invoices.c.bill_date),
+                            text(invoices.c.due_date), text(invoices.c.cancel_date), invoices.c.amount_due,
+                            invoices.c.deleted, text(invoices.c.paid_in_full_on)]) \
+                .order_by(invoices.c.policy_id, invoices.c.bill_date, invoices.c.id)
+            if ids is not None:
+                query = query.where(invoices.c.policy_id.in_(ids))
+            for policy_id, invoice_id, bill_date, due_date, cancel_date, amount, deleted, paid_in_full_on \
+                    in self._rows(query):
+                read.setdefault(policy_id, ([], []))[0].append(
+                    (invoice_id, ordinal(bill_date), ordinal(due_date), ordinal(cancel_date), amount,
+                     1 if deleted else 0, ordinal(paid_in_full_on) if paid_in_full_on else 0))
+
+            query = select([payments.c.policy_id, text(payments.c.transaction_date), payments.c.amount_paid]) \
+                .order_by(payments.c.policy_id, payments.c.transaction_date)
+            if ids is not None:
+                query = query.where(payments.c.policy_id.in_(ids))
+            for policy_id, transaction_date, amount in self._rows(query):
+                read.setdefault(policy_id, ([], []))[1].append((ordinal(transaction_date), amount))
+
+            # the voided invoices archive.archive_rows() moved out of live policies
+            query = select([archived.c.policy_id, archived.c.id, text(archived.c.bill_date),
+                            text(archived.c.due_date), text(archived.c.cancel_date), archived.c.amount_due],
+                           archived.c.deleted == True)
+            if ids is not None:
+                query = query.where(archived.c.policy_id.in_(ids))
+            voided = set()
+            for policy_id, invoice_id, bill_date, due_date, cancel_date, amount in self._rows(query):
+                read.setdefault(policy_id, ([], []))[0].append(
+                    (invoice_id, ordinal(bill_date), ordinal(due_date), ordinal(cancel_date), amount, 1, 0))
+                voided.add(policy_id)
+            for policy_id in voided:
+                read[policy_id][0].sort(key=lambda row: (row[1], row[0]))
+
+            for policy_id, history in full_history(archived_whole_ids(ids)).items():
+                paid = history['paid']
+                read[policy_id] = (
+                    [(row.id, row.bill_date.toordinal(), row.due_date.toordinal(), row.cancel_date.toordinal(),
+                      row.amount_due, 1 if row.deleted else 0,
+                      paid[row.id][1].toordinal() if paid[row.id][1] else 0) for row in history['invoices']],
+                    [(row.transaction_date.toordinal(), row.amount_paid) for row in history['payments']])
+        return read
+
+    def _watermarks(self):
+        # read first: everything up to them is committed and will be loaded
+        return dict((table.name, db.session.execute(
+            select([func.coalesce(func.max(table.c.row_version), 0)])).scalar())
+            for table in (Invoice.__table__, Payment.__table__))
+
+    def _store(self, read):
+        for policy_id, (invoices, payments) in read.items():
+            old = self.policies.get(policy_id)
+            if old is not None:
+                self.invoice_count -= len(old.invoices) // STRIDE
+                self.payment_count -= len(old.paid)
+            self.policies[policy_id] = PolicyColumns(policy_id, invoices, payments)
+            self.invoice_count += len(invoices)
+            self.payment_count += len(payments)
+
+    def load(self):
+        """
+         Reads every invoice and payment. Returns the seconds it took.
+        """
+        started = time.time()
+        watermarks = self._watermarks()
+        self.policies = {}
+        self.invoice_count = self.payment_count = 0
+        self._store(self._read())
+        db.session.remove()
+        self.watermarks = watermarks
+        seconds = time.time() - started
+        logger.info("Loaded %d invoices and %d payments of %d policies in %.3fs",
+                    self.invoice_count, self.payment_count, len(self.policies), seconds)
+        return seconds
+
+    def refresh(self):
+        """
+         Reloads the policies with invoices or payments written since the
+         last load or refresh. Returns the ids reloaded.
+        """
+        if self.watermarks is None:
+            self.load()
+            return sorted(self.policies)
+        watermarks = self._watermarks()
+        changed = set()
+        for table in (Invoice.__table__, Payment.__table__):
+            changed.update(row[0] for row in db.session.execute(
+                select([table.c.policy_id], table.c.row_version > self.watermarks[table.name], distinct=True)))
+        read = self._read(changed)
+        for policy_id in changed:
+            # a policy whose rows all moved away or were deleted
+            read.setdefault(policy_id, ([], []))
+        self._store(read)
+        db.session.remove()
+        self.watermarks = watermarks
+        logger.info("Refreshed %d policies of the columnar book", len(changed))
+        return sorted(changed)
+
+    def _policy(self, policy_id):
+        if self.watermarks is None:
+            self.load()
+        return self.policies.get(int(policy_id))
+
+    ################################
+    # Queries
+    ################################
+    def return_account_balance(self, policy_id, date_cursor=None):
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+        policy = self._policy(policy_id)
+        return policy.balance(date_cursor.toordinal()) if policy is not None else 0
+
+    def evaluate_cancel(self, policy_id, date_cursor=None):
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+        policy = self._policy(policy_id)
+        if policy is None or policy.overdue is None or policy.overdue[0] > date_cursor.toordinal():
+            return CancellationResult(False, date_cursor)
+        _, row, outstanding = policy.overdue
+        return CancellationResult(True, date_cursor, InvoiceRecord(policy.policy_id, row), outstanding)
+
+    def get_invoices(self, policy_id, date_cursor=None):
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+        policy = self._policy(policy_id)
+        if policy is None:
+            return []
+        return [InvoiceRecord(policy.policy_id, row) for row in policy.invoices_through(date_cursor.toordinal())]
+
+    ################################
+    # Footprint
+    ################################
+    def memory_report(self):
+        """
+         Bytes held by the book: the policy records and their arrays, and
+         the dict indexing them. Per million invoices is what the book
+         would take, at the same mix of payments per invoice, for a book
+         of a million invoices.
+        """
+        columns = sum(policy.nbytes() for policy in self.policies.values())
+        index = sys.getsizeof(self.policies) + sum(sys.getsizeof(policy_id) for policy_id in self.policies)
+        total = columns + index
+        return {
+            'policies': len(self.policies),
+            'invoices': self.invoice_count,
+            'payments': self.payment_count,
+            'bytes': total,
+            'bytes_per_policy': total / len(self.policies) if self.policies else 0,
+            'mb_per_million_invoices': total * 1e6 / self.invoice_count / 2 ** 20 if self.invoice_count else 0,
+        }
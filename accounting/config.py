@@ -1,3 +1,89 @@
 import os
 
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.abspath("accounting.sqlite")
+# ACCOUNTING_DATABASE points a process at another SQLite file, e.g. a
+# scratch copy made by ./manage.py generate for benchmarks.
+SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.abspath(os.environ.get('ACCOUNTING_DATABASE', "accounting.sqlite"))
+
+# SQLite connections kept open per process, and the pragmas each one gets.
+# WAL lets lookups read while a payment is being committed; busy_timeout
+# makes a writer wait up to that long for another one to finish.
+SQLALCHEMY_POOL_SIZE = 5
+SQLALCHEMY_POOL_TIMEOUT = 10
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_SYNCHRONOUS = 'NORMAL'
+SQLITE_CACHE_SIZE_KB = 20000
+
+# ./manage.py serve: gunicorn workers (processes) and threads per worker.
+# Keep SQLALCHEMY_POOL_SIZE at least SERVER_THREADS.
+SERVER_BIND = '127.0.0.1:8000'
+SERVER_WORKERS = 4
+SERVER_THREADS = 1
+SERVER_TIMEOUT = 30
+
+# accounting.writequeue commits queued payments and cancellations in groups
+# of up to WRITE_QUEUE_MAX_BATCH, waiting at most WRITE_QUEUE_MAX_DELAY_MS.
+WRITE_QUEUE_MAX_BATCH = 100
+WRITE_QUEUE_MAX_DELAY_MS = 5
+
+# Most policies a single /api/balances request may ask for.
+BALANCE_API_MAX_POLICIES = 500
+
+# Logging, set up by accounting.logs. Records are queued and written to
+# LOG_FILE (and stderr with LOG_TO_CONSOLE) by a background thread.
+# LOG_LEVELS overrides LOG_LEVEL per module, e.g. {'accounting.views': 'DEBUG'}.
+LOG_FILE = 'accounting.log'
+LOG_TO_CONSOLE = False
+LOG_LEVEL = 'INFO'
+LOG_LEVELS = {}
+LOG_QUEUE_SIZE = 10000
+
+# Record per-request SQL and timing metrics (served on /metrics) and log
+# requests slower than SLOW_REQUEST_SECONDS with their queries.
+METRICS_ENABLED = False
+SLOW_REQUEST_SECONDS = 0.5
+
+# get_result keeps up to RESPONSE_CACHE_SIZE recent (policy, date) lookups
+# for RESPONSE_CACHE_SECONDS each; a size of 0 turns the cache off.
+RESPONSE_CACHE_SIZE = 10000
+RESPONSE_CACHE_SECONDS = 60
+
+# accounting.export reads and writes EXPORT_BATCH_SIZE rows at a time.
+EXPORT_BATCH_SIZE = 5000
+
+# ./manage.py batch: worker processes, shards the policy ids are split into
+# (more shards than workers evens out uneven ones) and policies per chunk,
+# the unit of work that is checkpointed.
+BATCH_WORKERS = 4
+BATCH_SHARDS = 16
+BATCH_CHUNK_SIZE = 500
+
+# ./manage.py archive moves voided invoices, and the rows of closed policies
+# settled with nothing billed or paid for ARCHIVE_AFTER_DAYS, to the archive
+# tables, ARCHIVE_BATCH_SIZE invoices or policies per transaction.
+ARCHIVE_AFTER_DAYS = 365
+ARCHIVE_BATCH_SIZE = 1000
+
+# With SNAPSHOT_ENABLED, get_result, /api/balances, the reports and the
+# exports read a copy of the database at SNAPSHOT_PATH (the database file
+# with .snapshot added by default) instead of the database itself, so long
+# reads never hold up writes. ./manage.py snapshot refresh makes the copy,
+# from cron or every --every seconds; until there is one, reads go to the
+# database.
+SNAPSHOT_ENABLED = False
+SNAPSHOT_PATH = None
+
+# Per-process settings on top of the ones above, picked by
+# accounting.configure(profile) or create_app(profile), else by the
+# ACCOUNTING_CONFIG environment variable (web by default). manage.py runs
+# the batch jobs as 'batch' and serve, loadtest and bench as 'web'; the
+# shell runs as 'batch' and the test suite as 'test'. Batch jobs look
+# nothing up twice, so they skip the response cache; the tests keep their
+# log records out of accounting.log and run on accounting-test.sqlite, a
+# copy of the database the suite makes and migrates when it starts.
+PROFILES = {
+    'web': {},
+    'batch': {'RESPONSE_CACHE_SIZE': 0},
+    'test': {'LOG_FILE': None,
+             'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.abspath("accounting-test.sqlite")},
+}
@@ -0,0 +1,264 @@
+#!/user/bin/env python2.7
+
+import os
+import threading
+import weakref
+from contextlib import contextmanager
+from functools import partial
+
+from flask.ext.sqlalchemy import SQLAlchemy, _SignallingSession
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, QueuePool
+
+"""
+#######################################################
+SQLite connection handling.
+
+Flask-SQLAlchemy opens a new SQLite connection for every
+session unless a pool size is given. AccountingSQLAlchemy
+keeps SQLALCHEMY_POOL_SIZE connections in a QueuePool
+instead, shareable between the threads of a worker, and
+every connection gets the SQLITE_* pragmas from config.py
+when it is opened: WAL lets readers carry on while a write
+is committing, busy_timeout makes a writer wait for another
+one instead of failing at once. Listeners added with
+db.on_engine() get every engine it makes.
+
+Outside requests (batch jobs, the shell, their threads) db
+works with the app accounting.configure() or create_app()
+bound last, or with one made from the process settings on
+first use, so the models and the accounting engine run
+without building the web app or setting up logging.
+
+With SNAPSHOT_ENABLED, code run in db.reading_snapshot()
+reads a copy of the database kept up to date by
+accounting.snapshot, through a second engine whose
+connections are query_only: the thread's db.session is a
+session of that engine until the block ends.
+#######################################################
+"""
+
+
+def pragmas(config):
+    """
+     The PRAGMA statements run on every new connection.
+    """
+    statements = []
+    if config.get('SQLITE_JOURNAL_MODE'):
+        statements.append("PRAGMA journal_mode = %s" % config['SQLITE_JOURNAL_MODE'])
+    if config.get('SQLITE_BUSY_TIMEOUT_MS') is not None:
+        statements.append("PRAGMA busy_timeout = %d" % config['SQLITE_BUSY_TIMEOUT_MS'])
+    if config.get('SQLITE_SYNCHRONOUS'):
+        statements.append("PRAGMA synchronous = %s" % config['SQLITE_SYNCHRONOUS'])
+    if config.get('SQLITE_CACHE_SIZE_KB'):
+        # negative sizes are in KiB rather than pages
+        statements.append("PRAGMA cache_size = -%d" % config['SQLITE_CACHE_SIZE_KB'])
+    return statements
+
+
+def snapshot_path(config):
+    """
+     Where the read snapshot of the database file is kept: SNAPSHOT_PATH,
+     or the database file with .snapshot added. None for databases that
+     aren't SQLite files.
+    """
+    if config.get('SNAPSHOT_PATH'):
+        return os.path.abspath(config['SNAPSHOT_PATH'])
+    info = make_url(config.get('SQLALCHEMY_DATABASE_URI', 'sqlite://'))
+    if info.drivername != 'sqlite' or info.database in (None, '', ':memory:'):
+        return None
+    return os.path.abspath(info.database) + '.snapshot'
+
+
+def snapshot_options(config):
+    """
+     (url, create_engine keyword arguments, pragmas) of the read snapshot,
+     None unless SNAPSHOT_ENABLED.
+    """
+    path = snapshot_path(config) if config.get('SNAPSHOT_ENABLED') else None
+    if path is None:
+        return None
+    statements = ["PRAGMA query_only = ON"]
+    statements.extend(statement for statement in pragmas(config)
+                      if 'busy_timeout' in statement or 'cache_size' in statement)
+    # a new connection for every session, so each reads the latest copy
+    options = {'echo': bool(config.get('SQLALCHEMY_ECHO')), 'poolclass': NullPool}
+    return 'sqlite:///' + path, options, statements
+
+
+
+class AccountingSQLAlchemy(SQLAlchemy):
+    """
+     Flask-SQLAlchemy with pooled SQLite connections, the app it works
+     with outside requests made by make_app when none was bound, and the
+     read snapshot.
+    """
+
+    def __init__(self, make_app=None, **kwargs):
+        self.make_app = make_app
+        self._prepared = weakref.WeakKeyDictionary()
+        self._engine_listeners = []
+        self._lock = threading.RLock()
+        self._snapshot_engine = None
+        self._snapshot_options = None
+        self._local = threading.local()
+        SQLAlchemy.__init__(self, **kwargs)
+
+    def create_scoped_session(self, options=None):
+        options = dict(options or {})
+        scopefunc = options.pop('scopefunc', None)
+        return orm.scoped_session(partial(self._make_session, options), scopefunc=scopefunc)
+
+    def _make_session(self, options):
+        if self.snapshot_taken_at is None:
+            return _SignallingSession(self, **options)
+        # the app's binds map every table to the database, so a plain session
+        return orm.Session(bind=self.snapshot_engine, autoflush=False)
+
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername == 'sqlite' and info.database not in (None, '', ':memory:') \
+                and options.get('pool_size'):
+            options['poolclass'] = QueuePool
+            # pooled connections move between threads, never used by two at once
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+
+    def get_app(self, reference_app=None):
+        if reference_app is None and self.app is None and self.make_app is not None:
+            with self._lock:
+                if self.app is None:
+                    self.bind_app(self.make_app())
+        return SQLAlchemy.get_app(self, reference_app)
+
+    def bind_app(self, app):
+        """
+         Makes db work with app outside requests, closing the connections
+         of the app it worked with before.
+        """
+        with self._lock:
+            if self.app is not None and self.app is not app:
+                close_connections(self)
+            self.app = app
+
+    def get_engine(self, app, bind=None):
+        engine = SQLAlchemy.get_engine(self, app, bind)
+        if engine not in self._prepared:
+            with self._lock:
+                if engine not in self._prepared:
+                    self._prepare(engine, pragmas(app.config))
+        return engine
+
+    def _prepare(self, engine, statements):
+        if statements and engine.dialect.name == 'sqlite':
+            event.listen(engine, 'connect', _run_pragmas(statements))
+        for listener in self._engine_listeners:
+            listener(engine)
+        self._prepared[engine] = True
+
+    def on_engine(self, listener):
+        """
+         Calls listener with every engine db has made and makes from now
+         on, the read snapshot's included, so hooks added to the engine
+         survive it being built again for another app or other settings.
+        """
+        with self._lock:
+            if listener not in self._engine_listeners:
+                self._engine_listeners.append(listener)
+                for engine in list(self._prepared.keys()):
+                    listener(engine)
+
+    @property
+    def snapshot_engine(self):
+        """
+         The engine of the read snapshot, None unless SNAPSHOT_ENABLED is
+         set for a database file.
+        """
+        options = snapshot_options(self.get_app().config)
+        if options != self._snapshot_options:
+            with self._lock:
+                if options != self._snapshot_options:
+                    if self._snapshot_engine is not None:
+                        self._snapshot_engine.dispose()
+                        self._snapshot_engine = None
+                    if options is not None:
+                        url, kwargs, statements = options
+                        engine = create_engine(url, **kwargs)
+                        self._prepare(engine, statements)
+                        self._snapshot_engine = engine
+                    self._snapshot_options = options
+        return self._snapshot_engine
+
+    @property
+    def snapshot_taken_at(self):
+        """
+         When the snapshot db.session reads in this thread was taken, in
+         seconds since the epoch; None when it reads the database itself.
+        """
+        return getattr(self._local, 'snapshot_taken_at', None)
+
+    @contextmanager
+    def reading_snapshot(self):
+        """
+         Makes db.session read the snapshot in this thread until the block
+         ends, and yields when it was taken. Yields None, and leaves
+         db.session alone, when snapshots are disabled or none was taken
+         yet. Nothing can be written in the block.
+        """
+        if self.snapshot_taken_at is not None:
+            yield self.snapshot_taken_at
+            return
+        engine = self.snapshot_engine
+        try:
+            # no older than this: a refresh may replace it before it is opened
+            taken_at = os.path.getmtime(snapshot_path(self.get_app().config)) if engine is not None else None
+        except OSError:
+            taken_at = None
+        if taken_at is None:
+            yield None
+            return
+
+        # the thread's session is put aside, and sessions made in the block
+        # are bound to the snapshot
+        registry = self.session.registry
+        previous = registry() if registry.has() else None
+        registry.clear()
+        self._local.snapshot_taken_at = taken_at
+        try:
+            yield taken_at
+        finally:
+            self.session.remove()
+            self._local.snapshot_taken_at = None
+            if previous is not None:
+                registry.set(previous)
+
+
+def _run_pragmas(statements):
+    def connected(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+    return connected
+
+
+def begin_immediate(session):
+    """
+     Starts session's transaction by taking SQLite's write lock, waiting
+     for another writer as long as busy_timeout allows, so that what it
+     reads before writing, e.g. the highest id, can't change under it
+     until it commits or rolls back.
+    """
+    connection = session.connection()
+    if connection.dialect.name == 'sqlite':
+        connection.execute("BEGIN IMMEDIATE")
+
+
+def close_connections(db):
+    db.session.remove()
+    if db.app is not None:
+        db.engine.dispose()
+    if db._snapshot_engine is not None:
+        db._snapshot_engine.dispose()
@@ -0,0 +1,200 @@
+#!/user/bin/env python2.7
+
+import csv
+import json
+import logging
+import zlib
+from StringIO import StringIO
+
+from sqlalchemy import Date, String, func, null, select, type_coerce, union_all
+
+from accounting import db, settings
+from models import ArchivedInvoice, ArchivedPayment, Invoice, Payment, Policy
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Streaming extracts of policies, invoices and payments.
+
+Rows are read with a single SELECT whose cursor is fetched
+EXPORT_BATCH_SIZE rows at a time and written out as CSV or
+JSON lines as they arrive, optionally gzipped, so memory use
+stays the same whatever the size of the table.
+
+Every extract comes with a watermark, the highest
+row_version it is sure to include. Passing it back as since
+gets only the rows inserted or updated after it. Rows that
+change while an extract runs can show up in it and again in
+the next one, never in neither, so loaders should upsert on
+id. Rows deleted outright (as opposed to invoices marked
+deleted) are only noticed by a full extract.
+
+Full extracts of invoices and payments include the rows
+accounting.archive moved out, with the columns the archive
+doesn't keep (row_version, amount_paid...) left empty.
+Archived rows are never in an incremental extract: they
+stopped changing before they were moved.
+
+Inside db.reading_snapshot() the extract, watermark
+included, is read from the snapshot.
+#######################################################
+"""
+
+TABLES = {
+    'policies': Policy.__table__,
+    'invoices': Invoice.__table__,
+    'payments': Payment.__table__,
+}
+
+ARCHIVED = {
+    'invoices': ArchivedInvoice.__table__,
+    'payments': ArchivedPayment.__table__,
+}
+
+FORMATS = ('csv', 'jsonl')
+
+
+def reading_bind(bind=None):
+    """
+     bind, else what db.session reads in this thread: the snapshot's
+     engine inside db.reading_snapshot(), the database's outside it.
+    """
+    if bind is not None:
+        return bind
+    return db.snapshot_engine if db.snapshot_taken_at is not None else db.engine
+
+
+def watermark(table_name, bind=None):
+    """
+     The highest row_version committed to the table so far.
+    """
+    table = TABLES[table_name]
+    return reading_bind(bind).execute(select([func.coalesce(func.max(table.c.row_version), 0)])).scalar()
+
+
+def _export_columns(table, source):
+    """
+     The columns of table, read from source, which is table or its
+     archive: dates as text, and NULL for what source doesn't keep.
+    """
+    columns = []
+    for column in table.columns:
+        if column.name not in source.c:
+            columns.append(null().label(column.name))
+        elif isinstance(column.type, Date):
+            # SQLite keeps dates as YYYY-MM-DD text already: pass it through as is
+            columns.append(type_coerce(source.c[column.name], String).label(column.name))
+        else:
+            columns.append(source.c[column.name].label(column.name))
+    return columns
+
+
+def export_rows(table_name, since=None, batch_size=None, bind=None):
+    """
+     Yields lists of at most batch_size rows of the table, in id order,
+     or only those with a row_version above since. Full extracts of
+     invoices and payments include their archived rows.
+    """
+    table = TABLES[table_name]
+    batch_size = batch_size or settings['EXPORT_BATCH_SIZE']
+    query = select(_export_columns(table, table))
+    if since is not None:
+        query = query.where(table.c.row_version > since).order_by(table.c.id)
+    elif table_name in ARCHIVED:
+        query = union_all(query, select(_export_columns(table, ARCHIVED[table_name]))).order_by('id')
+    else:
+        query = query.order_by(table.c.id)
+
+    connection = reading_bind(bind).connect()
+    try:
+        result = connection.execute(query)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+        result.close()
+    finally:
+        connection.close()
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def serialize(table_name, batches, output='csv'):
+    """
+     Turns batches of rows from export_rows into chunks of CSV (with a
+     header) or JSON lines text.
+    """
+    columns = [column.name for column in TABLES[table_name].columns]
+    if output == 'csv':
+        stream = StringIO()
+        writer = csv.writer(stream)
+        writer.writerow(columns)
+        for rows in batches:
+            for row in rows:
+                writer.writerow([_csv_value(value) for value in row])
+            yield stream.getvalue()
+            stream.seek(0)
+            stream.truncate()
+        # an empty extract is still a file with a header
+        if stream.getvalue():
+            yield stream.getvalue()
+    else:
+        for rows in batches:
+            yield ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+
+
+def gzipped(chunks, level=6):
+    """
+     Compresses a stream of chunks into a gzip stream as they come.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_table(table_name, since=None, output='csv', compress=False, batch_size=None, bind=None):
+    """
+     (watermark, chunks) for an extract of the table: chunks is a
+     generator of the encoded file, to be written out or streamed.
+    """
+    if table_name not in TABLES:
+        raise ValueError("Can't export %r, pick one of %s" % (table_name, ', '.join(sorted(TABLES))))
+    if output not in FORMATS:
+        raise ValueError("Can't export as %r, pick one of %s" % (output, ', '.join(FORMATS)))
+
+    # picked now, as the chunks may be read after a reading_snapshot() block
+    bind = reading_bind(bind)
+    # read first: everything up to it is committed and will be in the extract
+    mark = watermark(table_name, bind)
+    chunks = serialize(table_name, export_rows(table_name, since, batch_size, bind), output)
+    if compress:
+        chunks = gzipped(chunks)
+    return mark, chunks
+
+
+def export_to_file(path, table_name, since=None, output='csv', compress=False, batch_size=None):
+    """
+     Writes an extract of the table to path. Returns the watermark and
+     the number of bytes written.
+    """
+    mark, chunks = export_table(table_name, since, output, compress, batch_size)
+    written = 0
+    with open(path, 'wb') as stream:
+        for chunk in chunks:
+            stream.write(chunk)
+            written += len(chunk)
+    logger.info("Exported %s since %s to %s: %d bytes, watermark %d", table_name, since, path, written, mark)
+    return mark, written
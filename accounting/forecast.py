@@ -0,0 +1,373 @@
+#!/user/bin/env python2.7
+
+import csv
+import logging
+import random
+import time
+from array import array
+from datetime import date, datetime
+from StringIO import StringIO
+
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import Integer, and_, case, cast, exists, func, literal_column, select
+
+from accounting import db, settings
+from chunking import chunked
+from models import Contact, Invoice, Policy
+from onboarding import add_months, schedule_dates
+from utils import PolicyAccounting
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Cash-flow forecast of the book's receivables.
+
+What Active policies are due to pay, per day or month of a
+window of months from a start date, by agent and billing
+schedule, read-only:
+
+    scheduled   the unpaid part (amount_due - amount_paid)
+                of live invoices already written, by due date
+    projected   the invoices make_invoices would write for
+                every renewal (a new term each year from the
+                effective date, on the policy's current
+                schedule and premium), and for the first term
+                of policies not invoiced yet
+
+Everything is added up by SQLite, and Python only sees
+grouped rows; no ORM objects are made. Open invoices are
+summed per period, schedule and agent in one statement.
+
+By month, a policy's projected invoices fall due every 12,
+6, 3 or 1 months (STRIDES) from the month after its
+effective date, a term later if it has invoices already,
+so policies are added up per agent, schedule and first due
+month in the window, and each agent and schedule's array
+of months is filled with a running sum strided that way.
+
+By day, the due dates also depend on the day of the month
+(add_months moves the 29th to 31st back in short months), so
+policies are added up per effective date, schedule, agent
+and first term instead, and the periods of each of those
+worked out once, as a template.
+
+Credits left over from overpayments aren't netted against
+what is projected. Invoices past due at the start are only
+reported in total, as past_due.
+#######################################################
+"""
+
+BY = ('month', 'day')
+AMOUNTS = ['scheduled', 'projected', 'total']
+
+INSTALMENTS = PolicyAccounting.billing_schedules
+# months between two invoices of a term
+STRIDES = dict((schedule, 12 // count) for schedule, count in INSTALMENTS.items())
+
+
+def month_number(day):
+    return day.year * 12 + day.month - 1
+
+
+class Window(object):
+    """
+     The periods from start up to, not including, end: the months or the
+     days, numbered from 0. By month, start is the first of its month.
+    """
+
+    def __init__(self, start, months, by):
+        if by not in BY:
+            raise ValueError("Forecasts go by %s, not %r" % (' or '.join(BY), by))
+        if by == 'month':
+            start = start.replace(day=1)
+        self.start = start
+        self.end = add_months(start, months)
+        self.by = by
+        self.size = self.period(self.end - relativedelta(days=1)) + 1
+        self._templates = {}
+
+    def period(self, day):
+        if self.by == 'month':
+            return month_number(day) - month_number(self.start)
+        return day.toordinal() - self.start.toordinal()
+
+    def label(self, period):
+        if self.by == 'month':
+            year, month = divmod(month_number(self.start) + period, 12)
+            return '%04d-%02d' % (year, month + 1)
+        return date.fromordinal(self.start.toordinal() + period).strftime('%Y-%m-%d')
+
+    def sql_period(self, column):
+        """
+         The period of a date column, as an SQL expression.
+        """
+        if self.by == 'month':
+            return _sql_month_number(column) - month_number(self.start)
+        return cast(func.julianday(column) - func.julianday(self.start.strftime('%Y-%m-%d')), Integer)
+
+    def template(self, effective_date, billing_schedule, first_term):
+        """
+         Periods of the due dates, in the window, of the invoices of every
+         term of a policy from first_term on (0 is the term starting on
+         the effective date).
+        """
+        key = (effective_date, billing_schedule, first_term)
+        periods = self._templates.get(key)
+        if periods is None:
+            periods = self._templates[key] = array('i')
+            term = first_term
+            while True:
+                term_start = add_months(effective_date, 12 * term)
+                if term_start >= self.end:
+                    break
+                for bill_date, due_date, cancel_date in schedule_dates(term_start, billing_schedule):
+                    if self.start <= due_date < self.end:
+                        periods.append(self.period(due_date))
+                term += 1
+        return periods
+
+
+def _sql_month_number(column):
+    return cast(func.strftime('%Y', column), Integer) * 12 + cast(func.strftime('%m', column), Integer) - 1
+
+
+def _policies(policy_ids=None):
+    policies = Policy.__table__
+    invoices = Invoice.__table__
+    # SQLite divides integers like Python 2 does
+    instalment = policies.c.annual_premium / case([(policies.c.billing_schedule == schedule, count)
+                                                   for schedule, count in INSTALMENTS.items()])
+    invoiced = exists([invoices.c.id], invoices.c.policy_id == policies.c.id)
+    where = [policies.c.status == u'Active']
+    if policy_ids is not None:
+        where.append(policies.c.id.in_(policy_ids))
+    return policies, instalment, invoiced, and_(*where)
+
+
+def _first_months(window, policy_ids=None):
+    """
+     One row per agent, schedule and first month of the window a
+     projected invoice of the policies falls due in: the policies' count
+     and what each of their invoices comes to, added up. Past the window
+     for policies starting after it.
+    """
+    policies, instalment, invoiced, where = _policies(policy_ids)
+    interval = case([(policies.c.billing_schedule == schedule, months) for schedule, months in STRIDES.items()])
+    # the month of the first invoice not written yet; the LIMIT keeps
+    # SQLite from flattening the subquery, which would run the EXISTS
+    # again for each use of first
+    terms = select([policies.c.id, policies.c.agent, policies.c.billing_schedule, instalment.label('instalment'),
+                    interval.label('interval'),
+                    (window.sql_period(policies.c.effective_date) + 1 + case([(invoiced, 12)], else_=0)).label('first')],
+                   where).limit(-1).alias('terms')
+    # SQLite's % keeps the sign of the dividend
+    aligned = case([(terms.c.first >= 0, terms.c.first)],
+                   else_=(terms.c.first % terms.c.interval + terms.c.interval) % terms.c.interval)
+    return select([terms.c.agent, terms.c.billing_schedule, aligned.label('aligned'),
+                   func.count(terms.c.id), func.sum(terms.c.instalment)]) \
+        .group_by(terms.c.agent, terms.c.billing_schedule, literal_column('aligned'))
+
+
+def _terms(policy_ids=None):
+    """
+     One row per effective date, schedule, agent and whether the policies
+     have invoices: the policies' count and what each of their invoices
+     comes to, added up.
+    """
+    policies, instalment, invoiced, where = _policies(policy_ids)
+    return select([policies.c.effective_date, policies.c.billing_schedule, policies.c.agent,
+                   invoiced.label('invoiced'), func.count(policies.c.id), func.sum(instalment)], where) \
+        .group_by(policies.c.effective_date, policies.c.billing_schedule, policies.c.agent,
+                  literal_column('invoiced'))
+
+
+def _scheduled(window, policy_ids=None):
+    """
+     Unpaid amounts of the open invoices of Active policies due before the
+     end of the window, by period (-1 before its start), schedule and
+     agent.
+    """
+    policies = Policy.__table__
+    invoices = Invoice.__table__
+    period = case([(invoices.c.due_date < window.start, -1)], else_=window.sql_period(invoices.c.due_date))
+    # paid in full leaves nothing to add
+    where = [invoices.c.paid_in_full_on == None, invoices.c.deleted == False,
+             invoices.c.due_date < window.end, policies.c.status == u'Active']
+    if policy_ids is not None:
+        where.append(invoices.c.policy_id.in_(policy_ids))
+    return select([period.label('period'), policies.c.billing_schedule, policies.c.agent,
+                   func.sum(invoices.c.amount_due - invoices.c.amount_paid)],
+                  and_(*where), from_obj=[invoices.join(policies, policies.c.id == invoices.c.policy_id)]) \
+        .group_by(literal_column('period'), policies.c.billing_schedule, policies.c.agent)
+
+
+def _rows(query):
+    result = db.session.execute(query)
+    while True:
+        rows = result.fetchmany(settings['EXPORT_BATCH_SIZE'])
+        if not rows:
+            break
+        for row in rows:
+            yield row
+    result.close()
+
+
+def _agent_names(agent_ids):
+    contacts = Contact.__table__
+    names = {}
+    for ids in chunked(sorted(agent_id for agent_id in agent_ids if agent_id is not None)):
+        names.update(db.session.execute(select([contacts.c.id, contacts.c.name], contacts.c.id.in_(ids))).fetchall())
+    return names
+
+
+def cash_flow_forecast(start=None, months=12, by='month', policy_ids=None):
+    """
+     Receivables of the Active policies (or the ones in policy_ids) per
+     period of the months from start (today by default), by agent and
+     schedule. Returns a JSON-able dict with 'rows', per period 'periods'
+     and 'totals'.
+    """
+    if not start:
+        start = datetime.now().date()
+    started = time.time()
+    window = Window(start, months, by)
+
+    # (agent, schedule): amounts per period
+    projected = {}
+    scheduled = {}
+
+    def amounts(totals, agent_id, schedule):
+        key = (agent_id, schedule)
+        if key not in totals:
+            totals[key] = array('l', [0]) * window.size
+        return totals[key]
+
+    policies = past_due = 0
+    for ids in ([None] if policy_ids is None else chunked(sorted(set(policy_ids)))):
+        if by == 'month':
+            for agent_id, schedule, first, count, amount in _rows(_first_months(window, ids)):
+                if first < window.size:
+                    amounts(projected, agent_id, schedule)[first] += amount
+                policies += count
+        else:
+            for effective_date, schedule, agent_id, invoiced, count, amount in _rows(_terms(ids)):
+                periods = amounts(projected, agent_id, schedule)
+                for period in window.template(effective_date, schedule, 1 if invoiced else 0):
+                    periods[period] += amount
+                policies += count
+        for period, schedule, agent_id, unpaid in _rows(_scheduled(window, ids)):
+            if period < 0:
+                past_due += unpaid
+            else:
+                amounts(scheduled, agent_id, schedule)[period] += unpaid
+    if by == 'month':
+        for (agent_id, schedule), periods in projected.items():
+            interval = STRIDES[schedule]
+            for period in range(interval, window.size):
+                periods[period] += periods[period - interval]
+    read = time.time() - started
+
+    # rows of each period, in agent and schedule order
+    buckets = [[] for _ in range(window.size)]
+    per_period = [[0, 0] for _ in range(window.size)]
+    labels = [window.label(period) for period in range(window.size)]
+    empty = array('l', [0]) * window.size
+    keys = sorted(set(projected) | set(scheduled), key=lambda key: (key[0] is None, key))
+    names = _agent_names(agent_id for agent_id, _ in keys)
+    for agent_id, schedule in keys:
+        name = names.get(agent_id)
+        owing = scheduled.get((agent_id, schedule), empty)
+        billing = projected.get((agent_id, schedule), empty)
+        for period in range(window.size):
+            owed, billed = owing[period], billing[period]
+            if owed or billed:
+                buckets[period].append({'period': labels[period], 'agent_id': agent_id, 'agent': name,
+                                        'billing_schedule': schedule, 'scheduled': owed, 'projected': billed,
+                                        'total': owed + billed})
+                per_period[period][0] += owed
+                per_period[period][1] += billed
+    rows = [row for bucket in buckets for row in bucket]
+
+    periods = [{'period': labels[period], 'scheduled': owed, 'projected': billed, 'total': owed + billed}
+               for period, (owed, billed) in enumerate(per_period)]
+    totals = dict((name, sum(period[name] for period in periods)) for name in AMOUNTS)
+    totals['past_due'] = past_due
+    seconds = time.time() - started
+    logger.info("Cash-flow forecast of %d policies by %s from %s to %s: %d rows in %.3fs (%.3fs reading)",
+                policies, by, window.start, window.end, len(rows), seconds, read)
+    return {
+        'start': window.start.strftime('%Y-%m-%d'),
+        'end': window.end.strftime('%Y-%m-%d'),
+        'by': by,
+        'policies': policies,
+        'rows': rows,
+        'periods': periods,
+        'totals': totals,
+        'seconds': seconds,
+    }
+
+
+def forecast_csv(report, rows='rows'):
+    """
+     The rows (or, with rows='periods', the per period totals) of a
+     forecast as CSV text.
+    """
+    if rows == 'rows':
+        header = ['period', 'agent_id', 'agent', 'billing_schedule'] + AMOUNTS
+    else:
+        header = ['period'] + AMOUNTS
+    stream = StringIO()
+    writer = csv.writer(stream)
+    writer.writerow(header)
+    for row in report[rows]:
+        writer.writerow([u'' if row[name] is None else unicode(row[name]).encode('utf-8') for name in header])
+    return stream.getvalue()
+
+
+################################
+# Check
+################################
+def _expected(policy, start, end):
+    """
+     A policy's receivables in [start, end) worked out the slow way: its
+     live invoices read one by one, and the renewals generated with
+     relativedelta as make_invoices does.
+    """
+    expected = 0
+    invoices = Invoice.query.filter_by(policy_id=policy.id, deleted=False).all()
+    for invoice in invoices:
+        if start <= invoice.due_date < end:
+            expected += invoice.amount_due - invoice.amount_paid
+    interval = PolicyAccounting.scheduling_interval[policy.billing_schedule]
+    amount = policy.annual_premium / INSTALMENTS[policy.billing_schedule]
+    term = 1 if invoices or Invoice.query.filter_by(policy_id=policy.id).first() else 0
+    while policy.effective_date + relativedelta(years=term) < end:
+        term_start = policy.effective_date + relativedelta(years=term)
+        for number in range(INSTALMENTS[policy.billing_schedule]):
+            bill_date = term_start + relativedelta(months=number * interval)
+            if start <= bill_date + relativedelta(months=1) < end:
+                expected += amount
+        term += 1
+    return expected
+
+
+def check_forecast(start=None, months=12, by='month', sample=100, seed=0):
+    """
+     Compares the forecast total of up to sample Active policies, picked
+     with seed, with _expected. Returns a list of (policy_id, forecast,
+     expected) for every policy where the two disagree.
+    """
+    if not start:
+        start = datetime.now().date()
+    window = Window(start, months, by)
+    policy_ids = [row[0] for row in db.session.execute(
+        select([Policy.__table__.c.id], Policy.__table__.c.status == u'Active'))]
+    mismatches = []
+    for policy_id in random.Random(seed).sample(policy_ids, min(sample, len(policy_ids))):
+        forecast = cash_flow_forecast(start, months, by, policy_ids=[policy_id])['totals']['total']
+        expected = _expected(Policy.query.get(policy_id), window.start, window.end)
+        if forecast != expected:
+            mismatches.append((policy_id, forecast, expected))
+    db.session.remove()
+    return mismatches
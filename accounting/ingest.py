@@ -0,0 +1,193 @@
+#!/user/bin/env python2.7
+
+# imported up front: datetime.strptime importing it lazily fails in a second
+# thread that calls it meanwhile
+import _strptime
+import csv
+import json
+import logging
+import time
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import func, select
+
+from accounting import db
+from allocation import reallocate
+from database import begin_immediate
+from ledger import post_payments
+from models import Contact, Payment, Policy
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Bulk payment ingestion for lockbox and bank files.
+
+Records are streamed from a CSV or JSON lines file,
+validated against the policy and contact ids loaded up
+front, and inserted chunk by chunk with a single
+executemany per chunk. Each chunk (payments plus their
+ledger rows) is one transaction, so memory use depends on
+the chunk size and not on the size of the file.
+#######################################################
+"""
+
+FIELDS = ('policy_id', 'contact_id', 'amount_paid', 'transaction_date')
+
+# how many rejected rows are kept on the summary, the rest are only counted
+REJECTS_KEPT = 100
+
+
+def read_csv(stream):
+    """
+     Yields (line_number, record) for every data row of a CSV file
+     with a header naming the FIELDS.
+    """
+    for line_number, record in enumerate(csv.DictReader(stream), start=2):
+        yield line_number, record
+
+
+def read_json_lines(stream):
+    """
+     Yields (line_number, record) for every non blank line of a
+     JSON lines file holding one payment object per line.
+    """
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield line_number, record
+
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_json_lines,
+}
+
+
+def guess_format(path):
+    if path.endswith('.csv'):
+        return 'csv'
+    return 'jsonl'
+
+
+class PaymentValidator(object):
+    """
+     Turns a raw record into a row for the payments table, checking it
+     against the ids of every policy and contact loaded once up front.
+    """
+
+    def __init__(self):
+        self.policy_ids = set(row[0] for row in db.session.execute(select([Policy.__table__.c.id])))
+        self.contact_ids = set(row[0] for row in db.session.execute(select([Contact.__table__.c.id])))
+
+    def __call__(self, record):
+        """
+         Returns (row, None) for a good record and (None, reason) otherwise.
+        """
+        if not isinstance(record, dict):
+            return None, "not a payment record"
+        missing = [field for field in FIELDS if record.get(field) in (None, '')]
+        if missing:
+            return None, "missing %s" % ", ".join(missing)
+
+        try:
+            policy_id = int(record['policy_id'])
+            contact_id = int(record['contact_id'])
+            amount_paid = int(record['amount_paid'])
+        except (TypeError, ValueError):
+            return None, "policy_id, contact_id and amount_paid must be whole numbers"
+        try:
+            transaction_date = datetime.strptime(str(record['transaction_date']), '%Y-%m-%d').date()
+        except ValueError:
+            return None, "transaction_date must look like YYYY-MM-DD"
+
+        if amount_paid <= 0:
+            return None, "amount_paid must be positive"
+        if policy_id not in self.policy_ids:
+            return None, "unknown policy %d" % policy_id
+        if contact_id not in self.contact_ids:
+            return None, "unknown contact %d" % contact_id
+
+        return {'policy_id': policy_id,
+                'contact_id': contact_id,
+                'amount_paid': amount_paid,
+                'transaction_date': transaction_date}, None
+
+
+def insert_payments(rows):
+    """
+     Inserts a chunk of payment rows, their ledger entries and their
+     allocations in a transaction it starts. Ids are handed out here
+     rather than by SQLite so the ledger rows can point at them without
+     reading the chunk back, after taking the write lock so no other
+     writer can take them before the chunk commits.
+    """
+    payments = Payment.__table__
+    begin_immediate(db.session)
+    last_id = db.session.execute(select([func.coalesce(func.max(payments.c.id), 0)])).scalar()
+    for offset, row in enumerate(rows, start=1):
+        row['id'] = last_id + offset
+    db.session.execute(payments.insert(), rows)
+    post_payments(db.session, rows)
+    reallocate(set(row['policy_id'] for row in rows), bind=db.session, commit=False)
+
+
+def ingest_payments(records, chunk_size=5000, on_reject=None):
+    """
+     Validates and inserts (line_number, record) pairs, committing every
+     chunk_size good rows. on_reject(line_number, record, reason) is called
+     for every bad row. Returns a summary of the run.
+    """
+    validate = PaymentValidator()
+    summary = {'read': 0, 'inserted': 0, 'rejected': 0, 'chunks': 0, 'rejects': []}
+    started = time.time()
+
+    records = iter(records)
+    while True:
+        batch = list(islice(records, chunk_size))
+        if not batch:
+            break
+
+        rows = []
+        for line_number, record in batch:
+            summary['read'] += 1
+            row, reason = validate(record)
+            if row is not None:
+                rows.append(row)
+                continue
+            summary['rejected'] += 1
+            if len(summary['rejects']) < REJECTS_KEPT:
+                summary['rejects'].append((line_number, reason))
+            if on_reject is not None:
+                on_reject(line_number, record, reason)
+
+        if rows:
+            try:
+                insert_payments(rows)
+                db.session.commit()
+            except:
+                db.session.rollback()
+                raise
+            summary['inserted'] += len(rows)
+            summary['chunks'] += 1
+            logger.info("Ingested chunk %d: %d payments (%d read so far)",
+                        summary['chunks'], len(rows), summary['read'])
+
+    summary['seconds'] = time.time() - started
+    logger.info("Ingested %d of %d payments in %.3fs, %d rejected",
+                summary['inserted'], summary['read'], summary['seconds'], summary['rejected'])
+    return summary
+
+
+def ingest_file(path, format=None, chunk_size=5000, on_reject=None):
+    """
+     Streams a CSV or JSON lines payment file into the database.
+    """
+    reader = READERS[format or guess_format(path)]
+    with open(path, 'rb') as stream:
+        return ingest_payments(reader(stream), chunk_size=chunk_size, on_reject=on_reject)
@@ -0,0 +1,367 @@
+#!/user/bin/env python2.7
+
+import logging
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import and_, event, literal_column, null, or_, select, union_all
+from sqlalchemy.orm.attributes import get_history
+
+from accounting import db
+from chunking import chunked
+from models import Invoice, LedgerEntry, Payment, Policy
+# imported as modules: they and models import each other through here
+import cache
+import checkpoints
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Running-balance ledger.
+
+Every invoice billed, payment received and invoice voided
+is posted as one row of the ledger table, in (event_date, id)
+order per policy, with the balance right after it. A balance
+as of any date is then the balance of the last row on or
+before that date.
+
+Rows are posted from ORM flush events, so they are written
+in the same transaction as the invoice or payment itself.
+Bulk paths that bypass the ORM post their rows with
+post_entries() or call rebuild_ledger() for the policies
+they touched.
+
+Voids are dated on the voided invoice's bill date: deleted
+invoices never count towards a balance, whatever the date.
+#######################################################
+"""
+
+ledger = LedgerEntry.__table__
+
+INSERT_CHUNK = 1000
+
+
+def balance_as_of(policy_id, date_cursor, bind=None):
+    """
+     Balance of the last ledger row on or before date_cursor, or 0
+     when nothing has happened on the policy yet.
+    """
+    bind = bind or db.session
+    balance = bind.execute(
+        select([ledger.c.balance])
+        .where(and_(ledger.c.policy_id == policy_id, ledger.c.event_date <= date_cursor))
+        .order_by(ledger.c.event_date.desc(), ledger.c.id.desc())
+        .limit(1)).scalar()
+    return balance or 0
+
+
+def post_entry(bind, policy_id, event_date, event_type, amount, invoice_id=None, payment_id=None):
+    """
+     Appends an event to the policy's ledger. Back-dated events shift the
+     balance of every later row by the same amount.
+    """
+    balance = balance_as_of(policy_id, event_date, bind) + amount
+    bind.execute(ledger.insert().values(policy_id=policy_id,
+                                        event_date=event_date,
+                                        event_type=event_type,
+                                        invoice_id=invoice_id,
+                                        payment_id=payment_id,
+                                        amount=amount,
+                                        balance=balance))
+    bind.execute(ledger.update()
+                 .where(and_(ledger.c.policy_id == policy_id, ledger.c.event_date > event_date))
+                 .values(balance=ledger.c.balance + amount))
+
+
+def remove_entries(bind, invoice_id=None, payment_id=None):
+    """
+     Takes every row posted for an invoice or payment back out of the
+     ledger, shifting the balance of the rows that came after them.
+    """
+    source = ledger.c.invoice_id == invoice_id if invoice_id else ledger.c.payment_id == payment_id
+    entries = bind.execute(select([ledger.c.id, ledger.c.policy_id, ledger.c.event_date, ledger.c.amount])
+                           .where(source)).fetchall()
+    for entry_id, policy_id, event_date, amount in entries:
+        bind.execute(ledger.delete().where(ledger.c.id == entry_id))
+        bind.execute(ledger.update()
+                     .where(and_(ledger.c.policy_id == policy_id,
+                                 or_(ledger.c.event_date > event_date,
+                                     and_(ledger.c.event_date == event_date, ledger.c.id > entry_id))))
+                     .values(balance=ledger.c.balance - amount))
+
+
+def post_invoice(bind, invoice):
+    post_entry(bind, invoice.policy_id, invoice.bill_date, u'Invoice', invoice.amount_due,
+               invoice_id=invoice.id)
+    if invoice.deleted:
+        post_entry(bind, invoice.policy_id, invoice.bill_date, u'Void', -invoice.amount_due,
+                   invoice_id=invoice.id)
+
+
+def post_payment(bind, payment):
+    post_entry(bind, payment.policy_id, payment.transaction_date, u'Payment', -payment.amount_paid,
+               payment_id=payment.id)
+
+
+def _last_entries(bind, policy_ids, date_cursor=None):
+    """
+     Date and balance of the latest ledger row of each policy, optionally
+     only looking at rows on or before date_cursor. Policies that don't
+     exist are left out.
+    """
+    latest = {}
+    policies = Policy.__table__
+    where = ledger.c.policy_id == policies.c.id
+    if date_cursor is not None:
+        where = and_(where, ledger.c.event_date <= date_cursor)
+    for ids in _policy_chunks(policy_ids, bind):
+        last = lambda column: select([column]) \
+            .where(where) \
+            .order_by(ledger.c.event_date.desc(), ledger.c.id.desc()) \
+            .limit(1).as_scalar()
+        rows = bind.execute(select([policies.c.id, last(ledger.c.event_date), last(ledger.c.balance)],
+                                   policies.c.id.in_(ids)))
+        for policy_id, event_date, balance in rows:
+            latest[policy_id] = (_as_date(event_date), balance or 0)
+    return latest
+
+
+def balances_as_of(policy_ids, date_cursor, bind=None):
+    """
+     balance_as_of for many policies in one statement per 500 ids.
+     Returns a dict of policy_id => balance.
+    """
+    bind = bind or db.session
+    latest = _last_entries(bind, policy_ids, date_cursor)
+    return dict((policy_id, balance) for policy_id, (_, balance) in latest.items())
+
+
+def post_entries(bind, entries):
+    """
+     Posts many events for freshly inserted rows at once (dicts with
+     policy_id, event_date, event_type, invoice_id, payment_id and amount).
+     Events dated on or after a policy's latest ledger row are appended
+     with a single executemany; policies with back-dated events are
+     rebuilt instead. Returns (rows appended, policies rebuilt).
+    """
+    entries = sorted(entries, key=lambda entry: (entry['policy_id'], entry['event_date'],
+                                                 entry['invoice_id'], entry['payment_id']))
+    latest = _last_entries(bind, set(entry['policy_id'] for entry in entries))
+
+    appended = []
+    back_dated = set()
+    for entry in entries:
+        policy_id = entry['policy_id']
+        last_date, balance = latest[policy_id]
+        if policy_id in back_dated or (last_date is not None and entry['event_date'] < last_date):
+            back_dated.add(policy_id)
+            continue
+        balance += entry['amount']
+        latest[policy_id] = (entry['event_date'], balance)
+        appended.append(dict(entry, balance=balance))
+
+    appended = [entry for entry in appended if entry['policy_id'] not in back_dated]
+    cache.invalidate_policies(latest)
+    earliest = {}
+    for entry in entries:
+        earliest.setdefault(entry['policy_id'], entry['event_date'])
+    checkpoints.invalidate_from(bind, earliest)
+    if appended:
+        bind.execute(ledger.insert(), appended)
+    if back_dated:
+        rebuild_ledger(back_dated, bind=bind, commit=False)
+    return len(appended), len(back_dated)
+
+
+def post_payments(bind, payments):
+    """
+     post_entries for payment rows (dicts with id, policy_id,
+     transaction_date and amount_paid).
+    """
+    return post_entries(bind, [{'policy_id': payment['policy_id'],
+                                'event_date': payment['transaction_date'],
+                                'event_type': u'Payment',
+                                'invoice_id': None,
+                                'payment_id': payment['id'],
+                                'amount': -payment['amount_paid']} for payment in payments])
+
+
+def post_invoices(bind, invoices):
+    """
+     post_entries for live invoice rows (dicts with id, policy_id,
+     bill_date and amount_due).
+    """
+    return post_entries(bind, [{'policy_id': invoice['policy_id'],
+                                'event_date': invoice['bill_date'],
+                                'event_type': u'Invoice',
+                                'invoice_id': invoice['id'],
+                                'payment_id': None,
+                                'amount': invoice['amount_due']} for invoice in invoices])
+
+
+def _changed(target, *attributes):
+    return any(get_history(target, attribute).has_changes() for attribute in attributes)
+
+
+################################
+# ORM flush events
+################################
+def _invoice_inserted(mapper, connection, target):
+    post_invoice(connection, target)
+
+
+def _invoice_updated(mapper, connection, target):
+    if _changed(target, 'deleted', 'amount_due', 'bill_date', 'policy_id'):
+        remove_entries(connection, invoice_id=target.id)
+        post_invoice(connection, target)
+
+
+def _invoice_deleted(mapper, connection, target):
+    remove_entries(connection, invoice_id=target.id)
+
+
+def _payment_inserted(mapper, connection, target):
+    post_payment(connection, target)
+
+
+def _payment_updated(mapper, connection, target):
+    if _changed(target, 'amount_paid', 'transaction_date', 'policy_id'):
+        remove_entries(connection, payment_id=target.id)
+        post_payment(connection, target)
+
+
+def _payment_deleted(mapper, connection, target):
+    remove_entries(connection, payment_id=target.id)
+
+
+event.listen(Invoice, 'after_insert', _invoice_inserted)
+event.listen(Invoice, 'after_update', _invoice_updated)
+event.listen(Invoice, 'after_delete', _invoice_deleted)
+event.listen(Payment, 'after_insert', _payment_inserted)
+event.listen(Payment, 'after_update', _payment_updated)
+event.listen(Payment, 'after_delete', _payment_deleted)
+
+
+################################
+# Rebuild and verify
+################################
+def _policy_chunks(policy_ids, bind):
+    if policy_ids is None:
+        policy_ids = [row[0] for row in bind.execute(select([Policy.__table__.c.id]).order_by('id'))]
+    return chunked(sorted(policy_ids))
+
+
+def expected_entries(policy_ids, bind):
+    """
+     Recomputes the ledger of the given policies from the raw invoices and
+     payments, yielding row dicts in (policy_id, event_date) order.
+    """
+    invoices = Invoice.__table__
+    payments = Payment.__table__
+    events = union_all(
+        select([invoices.c.policy_id, invoices.c.bill_date.label('event_date'),
+                literal_column("0").label('seq'), literal_column("'Invoice'").label('event_type'),
+                invoices.c.id.label('invoice_id'), null().label('payment_id'),
+                invoices.c.amount_due.label('amount')],
+               invoices.c.policy_id.in_(policy_ids)),
+        select([invoices.c.policy_id, invoices.c.bill_date,
+                literal_column("1"), literal_column("'Void'"),
+                invoices.c.id, null(), -invoices.c.amount_due],
+               and_(invoices.c.policy_id.in_(policy_ids), invoices.c.deleted == True)),
+        select([payments.c.policy_id, payments.c.transaction_date,
+                literal_column("2"), literal_column("'Payment'"),
+                null(), payments.c.id, -payments.c.amount_paid],
+               payments.c.policy_id.in_(policy_ids))).alias('events')
+    rows = bind.execute(select([events])
+                        .order_by(events.c.policy_id, events.c.event_date, events.c.seq,
+                                  events.c.invoice_id, events.c.payment_id))
+
+    policy_id = balance = None
+    for row in rows:
+        if row.policy_id != policy_id:
+            policy_id, balance = row.policy_id, 0
+        balance += row.amount
+        yield {'policy_id': row.policy_id,
+               'event_date': _as_date(row.event_date),
+               'event_type': row.event_type,
+               'invoice_id': row.invoice_id,
+               'payment_id': row.payment_id,
+               'amount': row.amount,
+               'balance': balance}
+
+
+def _as_date(value):
+    # the union hides the column types, so SQLite hands dates back as text
+    if isinstance(value, basestring):
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    return value
+
+
+def rebuild_ledger(policy_ids=None, bind=None, commit=True):
+    """
+     Throws away and recomputes the ledger of the given policies (all of
+     them by default). Returns the number of rows written.
+    """
+    bind = bind or db.session
+    cache.invalidate_policies(policy_ids)
+    written = 0
+    for ids in _policy_chunks(policy_ids, bind):
+        bind.execute(ledger.delete().where(ledger.c.policy_id.in_(ids)))
+        batch = []
+        for entry in expected_entries(ids, bind):
+            batch.append(entry)
+            if len(batch) >= INSERT_CHUNK:
+                bind.execute(ledger.insert(), batch)
+                written += len(batch)
+                batch = []
+        if batch:
+            bind.execute(ledger.insert(), batch)
+            written += len(batch)
+    if commit and bind is db.session:
+        db.session.commit()
+    logger.info("Rebuilt %d ledger rows", written)
+    return written
+
+
+def _summarize(entries):
+    """
+     Reduces a policy's ledger rows to what must match whatever order
+     same-day events were posted in: the multiset of events and the
+     balance at the end of each day.
+    """
+    events = Counter()
+    closing = {}
+    for entry in entries:
+        events[(entry['policy_id'], entry['event_date'], entry['event_type'],
+                entry['invoice_id'], entry['payment_id'], entry['amount'])] += 1
+        closing[(entry['policy_id'], entry['event_date'])] = entry['balance']
+    return events, closing
+
+
+def verify_ledger(policy_ids=None, bind=None):
+    """
+     Recomputes the ledger from scratch and diffs it against the live
+     table. Returns a list of (policy_id, message) for every mismatch.
+    """
+    bind = bind or db.session
+    differences = []
+    for ids in _policy_chunks(policy_ids, bind):
+        live = bind.execute(select([ledger])
+                            .where(ledger.c.policy_id.in_(ids))
+                            .order_by(ledger.c.policy_id, ledger.c.event_date, ledger.c.id))
+        live_events, live_closing = _summarize(dict(row) for row in live)
+        expected_events, expected_closing = _summarize(expected_entries(ids, bind))
+
+        for key in sorted(set(expected_events) | set(live_events)):
+            if expected_events[key] != live_events[key]:
+                differences.append((key[0], "%s %s on %s for %d: expected %d row(s), found %d" % (
+                    key[2], key[3] or key[4], key[1], key[5], expected_events[key], live_events[key])))
+        for key in sorted(set(expected_closing) | set(live_closing)):
+            if expected_closing.get(key) != live_closing.get(key):
+                differences.append((key[0], "balance on %s: expected %s, found %s" % (
+                    key[1], expected_closing.get(key), live_closing.get(key))))
+
+    for policy_id, message in differences:
+        logger.warning("Ledger mismatch on policy %s: %s", policy_id, message)
+    return differences
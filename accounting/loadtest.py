@@ -0,0 +1,119 @@
+#!/user/bin/env python2.7
+
+import logging
+import random
+import threading
+import time
+import urllib2
+from datetime import datetime
+
+from sqlalchemy import select
+
+from accounting import db
+from benchmarks import percentile
+from chunking import chunked
+from models import Payment, Policy
+from utils import PolicyAccounting
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Load test for a running server.
+
+Reader threads request /<policy>/<date> for random policies
+over HTTP while writer threads post payments straight to the
+same database, the way a batch job would, so lookups are
+measured while writes are committing. Meant for a scratch
+book from ./manage.py generate: the payments written are
+deleted again at the end.
+#######################################################
+"""
+
+LOAD_TEST_AMOUNT = 1
+
+
+def _latency_summary(latencies, seconds):
+    ordered = sorted(latency * 1000 for latency in latencies)
+    return {
+        'requests': len(ordered),
+        'per_second': len(ordered) / seconds if seconds else None,
+        'p50_ms': percentile(ordered, 0.50),
+        'p99_ms': percentile(ordered, 0.99),
+        'max_ms': ordered[-1] if ordered else None,
+    }
+
+
+def run_load_test(url, readers=8, writers=1, duration=10, date_cursor=None, seed=0):
+    """
+     Runs readers and writers threads for duration seconds against the
+     server at url and returns requests per second and latency
+     percentiles of each.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    supplied_date = date_cursor.strftime('%Y-%m-%d')
+    policy_ids = [row[0] for row in db.session.execute(select([Policy.__table__.c.id]))]
+    db.session.remove()
+
+    deadline = time.time() + duration
+    lock = threading.Lock()
+    results = {'reads': [], 'writes': [], 'read_errors': 0, 'write_errors': 0, 'payment_ids': []}
+
+    def read(number):
+        rng = random.Random(seed * 1000 + number)
+        latencies, errors = [], 0
+        while time.time() < deadline:
+            started = time.time()
+            try:
+                urllib2.urlopen('%s/%s/%s' % (url.rstrip('/'), rng.choice(policy_ids), supplied_date)).read()
+                latencies.append(time.time() - started)
+            except (urllib2.URLError, IOError):
+                errors += 1
+        with lock:
+            results['reads'].extend(latencies)
+            results['read_errors'] += errors
+
+    def write(number):
+        rng = random.Random(-seed * 1000 - number - 1)
+        latencies, errors, payment_ids = [], 0, []
+        try:
+            while time.time() < deadline:
+                started = time.time()
+                try:
+                    pa = PolicyAccounting(rng.choice(policy_ids), generate_invoices=False)
+                    payment = pa.make_payment(date_cursor=date_cursor, amount=LOAD_TEST_AMOUNT)
+                    payment_ids.append(payment.id)
+                    latencies.append(time.time() - started)
+                except Exception:
+                    logger.exception("Load test payment failed")
+                    db.session.rollback()
+                    errors += 1
+        finally:
+            db.session.remove()
+        with lock:
+            results['writes'].extend(latencies)
+            results['write_errors'] += errors
+            results['payment_ids'].extend(payment_ids)
+
+    threads = [threading.Thread(target=read, args=(number,)) for number in range(readers)] + \
+              [threading.Thread(target=write, args=(number,)) for number in range(writers)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - started
+
+    for ids in chunked(results['payment_ids']):
+        for payment in Payment.query.filter(Payment.id.in_(ids)).all():
+            db.session.delete(payment)
+    db.session.commit()
+
+    return {
+        'seconds': seconds,
+        'readers': readers,
+        'writers': writers,
+        'get_result': dict(_latency_summary(results['reads'], seconds), errors=results['read_errors']),
+        'make_payment': dict(_latency_summary(results['writes'], seconds), errors=results['write_errors']),
+    }
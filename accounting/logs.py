@@ -0,0 +1,175 @@
+#!/user/bin/env python2.7
+
+import atexit
+import logging
+import sys
+import threading
+from Queue import Full, Queue
+
+"""
+#######################################################
+Logging setup shared by every accounting module.
+
+Modules only ask for logging.getLogger(__name__). The
+"accounting" logger they all sit under gets a single handler
+that puts records on a queue; a background thread takes them
+off and does the formatting and the writes to LOG_FILE (and
+stderr), so a request never waits on the disk. Levels come
+from LOG_LEVEL and the per-module LOG_LEVELS in config.py.
+
+When the queue is full records are dropped and counted
+rather than blocking the caller.
+#######################################################
+"""
+
+ROOT_LOGGER = 'accounting'
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# LOG_LEVEL = 'OFF' silences everything
+OFF = logging.CRITICAL + 1
+
+_listener = None
+_overridden = []
+
+
+def level_of(value):
+    if isinstance(value, int):
+        return value
+    if value.upper() == 'OFF':
+        return OFF
+    return getattr(logging, value.upper())
+
+
+class QueueHandler(logging.Handler):
+    """
+     Hands records over to a QueueListener. The message is merged with
+     its arguments here, while they are still what the caller meant.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """
+     Background thread passing queued records on to the real handlers.
+    """
+    _stop = object()
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._monitor, name='accounting-log-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            try:
+                if record is self._stop:
+                    return
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """
+         Waits until every record queued so far has been written.
+        """
+        self.queue.join()
+        for handler in self.handlers:
+            handler.flush()
+
+    def stop(self):
+        self.queue.put(self._stop)
+        self.thread.join()
+        for handler in self.handlers:
+            handler.close()
+
+
+def configure_logging(config):
+    """
+     (Re)configures the accounting loggers from the LOG_* settings of
+     config, replacing whatever an earlier call set up.
+    """
+    global _listener
+    stop()
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = []
+    if config.get('LOG_FILE'):
+        handlers.append(logging.FileHandler(config['LOG_FILE']))
+    if config.get('LOG_TO_CONSOLE'):
+        handlers.append(logging.StreamHandler(sys.stderr))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    root = logging.getLogger(ROOT_LOGGER)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    if config.get('LOG_ASYNC', True):
+        queue = Queue(config.get('LOG_QUEUE_SIZE', 10000))
+        root.addHandler(QueueHandler(queue))
+        _listener = QueueListener(queue, *handlers)
+        _listener.start()
+    else:
+        for handler in handlers:
+            root.addHandler(handler)
+    root.setLevel(level_of(config.get('LOG_LEVEL', 'INFO')))
+
+    while _overridden:
+        logging.getLogger(_overridden.pop()).setLevel(logging.NOTSET)
+    for name, level in config.get('LOG_LEVELS', {}).items():
+        logging.getLogger(name).setLevel(level_of(level))
+        _overridden.append(name)
+
+
+def flush():
+    if _listener is not None:
+        _listener.flush()
+    for handler in logging.getLogger(ROOT_LOGGER).handlers:
+        handler.flush()
+
+
+def stop():
+    """
+     Writes out what is still queued and stops the writer thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def dropped():
+    return sum(getattr(handler, 'dropped', 0) for handler in logging.getLogger(ROOT_LOGGER).handlers)
+
+
+# until configure_logging() runs, e.g. in a script that only imports the models
+logging.getLogger(ROOT_LOGGER).addHandler(logging.NullHandler())
+atexit.register(stop)
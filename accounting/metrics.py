@@ -0,0 +1,386 @@
+#!/user/bin/env python2.7
+
+import bisect
+import logging
+import threading
+import time
+import weakref
+from functools import wraps
+
+from sqlalchemy import event
+from sqlalchemy.orm import mapper
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Per-request and per-method instrumentation.
+
+When METRICS_ENABLED is set, hooks on the SQLAlchemy engine
+and on the Flask request lifecycle record, for every request
+and every instrumented PolicyAccounting method, the number of
+SQL statements, the time spent in SQL, the rows fetched
+(whether the ORM or Core reads them), the ORM objects
+hydrated from them and the template render time. Code that
+runs SQL on a DB-API connection of its own goes through
+execute() to be recorded the same way. They are aggregated
+in in-process histograms served on /metrics in Prometheus
+text format. Requests slower than SLOW_REQUEST_SECONDS are
+logged with the statements they ran.
+
+When disabled no hooks are registered and instrumented
+methods only pay for one flag check. Flask is only imported
+by the hooks, so the batch jobs can use instrumented methods
+without loading it.
+#######################################################
+"""
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+enabled = False
+slow_request_seconds = None
+
+_local = threading.local()
+_mapper_watched = False
+_watched_engines = weakref.WeakKeyDictionary()
+
+
+class Histogram(object):
+    """
+     Prometheus style histogram: cumulative bucket counts, sum and count
+     per combination of label values.
+    """
+
+    def __init__(self, name, help, label, buckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * len(self.buckets), 0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def exposition(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            for label_value in sorted(self.series):
+                counts, total, count = self.series[label_value]
+                label = '%s="%s"' % (self.label, label_value)
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, label, bound, cumulative))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (self.name, label, count))
+                lines.append('%s_sum{%s} %s' % (self.name, label, repr(float(total))))
+                lines.append('%s_count{%s} %d' % (self.name, label, count))
+        return lines
+
+    def reset(self):
+        with self.lock:
+            self.series = {}
+
+
+class Counter(object):
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_value, amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def exposition(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        with self.lock:
+            for label_value in sorted(self.values):
+                lines.append('%s{%s="%s"} %d' % (self.name, self.label, label_value, self.values[label_value]))
+        return lines
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+
+REQUEST_SECONDS = Histogram('accounting_request_seconds', "Time spent handling a request.",
+                            'endpoint', SECONDS_BUCKETS)
+REQUEST_SQL_SECONDS = Histogram('accounting_request_sql_seconds', "Time spent in SQL per request.",
+                                'endpoint', SECONDS_BUCKETS)
+REQUEST_STATEMENTS = Histogram('accounting_request_sql_statements', "SQL statements run per request.",
+                               'endpoint', COUNT_BUCKETS)
+REQUEST_ROWS = Histogram('accounting_request_sql_rows', "Rows fetched per request.",
+                         'endpoint', COUNT_BUCKETS)
+REQUEST_OBJECTS = Histogram('accounting_request_objects_hydrated', "ORM objects hydrated per request.",
+                            'endpoint', COUNT_BUCKETS)
+REQUEST_RENDER_SECONDS = Histogram('accounting_request_render_seconds', "Template render time per request.",
+                                   'endpoint', SECONDS_BUCKETS)
+METHOD_SECONDS = Histogram('accounting_method_seconds', "Time spent in a PolicyAccounting method.",
+                           'method', SECONDS_BUCKETS)
+METHOD_SQL_SECONDS = Histogram('accounting_method_sql_seconds', "Time spent in SQL per method call.",
+                               'method', SECONDS_BUCKETS)
+METHOD_STATEMENTS = Histogram('accounting_method_sql_statements', "SQL statements run per method call.",
+                              'method', COUNT_BUCKETS)
+METHOD_ROWS = Histogram('accounting_method_sql_rows', "Rows fetched per method call.",
+                        'method', COUNT_BUCKETS)
+SLOW_REQUESTS = Counter('accounting_slow_requests_total', "Requests slower than SLOW_REQUEST_SECONDS.",
+                        'endpoint')
+
+REGISTRY = [REQUEST_SECONDS, REQUEST_SQL_SECONDS, REQUEST_STATEMENTS, REQUEST_ROWS, REQUEST_OBJECTS,
+            REQUEST_RENDER_SECONDS, METHOD_SECONDS, METHOD_SQL_SECONDS, METHOD_STATEMENTS, METHOD_ROWS,
+            SLOW_REQUESTS]
+
+
+class Scope(object):
+    """
+     What happened while a request or a method call was running.
+    """
+    __slots__ = ('started', 'statements', 'sql_seconds', 'rows', 'objects', 'render_seconds', 'queries')
+
+    def __init__(self, keep_queries=False):
+        self.started = time.time()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.rows = 0
+        self.objects = 0
+        self.render_seconds = 0.0
+        self.queries = [] if keep_queries else None
+
+
+def _scopes():
+    scopes = getattr(_local, 'scopes', None)
+    if scopes is None:
+        scopes = _local.scopes = []
+    return scopes
+
+
+class _RecordedCursor(object):
+    """
+     A DB-API cursor that adds the rows fetched from it to the scopes that
+     were open when its statement ran.
+    """
+    __slots__ = ('cursor', 'scopes')
+
+    def __init__(self, cursor, scopes):
+        self.cursor = cursor
+        self.scopes = scopes
+
+    def _fetched(self, count):
+        for scope in self.scopes:
+            scope.rows += count
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self._fetched(1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        self._fetched(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self._fetched(len(rows))
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def _record(scopes, statement, elapsed):
+    for scope in scopes:
+        scope.statements += 1
+        scope.sql_seconds += elapsed
+        if scope.queries is not None:
+            scope.queries.append((elapsed, statement))
+
+
+################################
+# SQLAlchemy hooks
+################################
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _local.query_started = time.time()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    scopes = _scopes()
+    if not scopes:
+        return
+    _record(scopes, statement, time.time() - _local.query_started)
+    if context is not None and cursor.description is not None:
+        # the result proxy made next reads its rows from context.cursor
+        context.cursor = _RecordedCursor(cursor, list(scopes))
+
+
+def _object_loaded(target, context):
+    for scope in _scopes():
+        scope.objects += 1
+
+
+################################
+# Flask hooks
+################################
+def _before_request():
+    if not enabled:
+        return
+    from flask import g
+    scope = Scope(keep_queries=slow_request_seconds is not None)
+    _scopes().append(scope)
+    g.metrics_scope = scope
+
+
+def _teardown_request(exception=None):
+    from flask import g, request
+    scope = getattr(g, 'metrics_scope', None)
+    if scope is None:
+        return
+    _scopes().remove(scope)
+    elapsed = time.time() - scope.started
+    endpoint = request.endpoint or 'unknown'
+
+    REQUEST_SECONDS.observe(endpoint, elapsed)
+    REQUEST_SQL_SECONDS.observe(endpoint, scope.sql_seconds)
+    REQUEST_STATEMENTS.observe(endpoint, scope.statements)
+    REQUEST_ROWS.observe(endpoint, scope.rows)
+    REQUEST_OBJECTS.observe(endpoint, scope.objects)
+    REQUEST_RENDER_SECONDS.observe(endpoint, scope.render_seconds)
+
+    if slow_request_seconds is not None and elapsed >= slow_request_seconds:
+        SLOW_REQUESTS.inc(endpoint)
+        logger.warning("Slow request %s %s: %.3fs, %d statements in %.3fs, %d rows, %d objects, "
+                       "render %.3fs\n%s", request.method, request.path, elapsed, scope.statements,
+                       scope.sql_seconds, scope.rows, scope.objects, scope.render_seconds,
+                       "\n".join("  %.4fs %s" % query for query in scope.queries))
+
+
+def render_template(*args, **kwargs):
+    """
+     flask.render_template, timed into the current request's metrics.
+    """
+    from flask import g, render_template as flask_render_template
+    if not enabled:
+        return flask_render_template(*args, **kwargs)
+    started = time.time()
+    try:
+        return flask_render_template(*args, **kwargs)
+    finally:
+        scope = getattr(g, 'metrics_scope', None)
+        if scope is not None:
+            scope.render_seconds += time.time() - started
+
+
+def instrumented(method):
+    """
+     Records the time, SQL time, statement count and rows fetched of every
+     call to a PolicyAccounting method under its name.
+    """
+    name = method.__name__
+
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return method(*args, **kwargs)
+        scope = Scope()
+        _scopes().append(scope)
+        try:
+            return method(*args, **kwargs)
+        finally:
+            _scopes().remove(scope)
+            METHOD_SECONDS.observe(name, time.time() - scope.started)
+            METHOD_SQL_SECONDS.observe(name, scope.sql_seconds)
+            METHOD_STATEMENTS.observe(name, scope.statements)
+            METHOD_ROWS.observe(name, scope.rows)
+    return wrapper
+
+
+def execute(cursor, statement, parameters):
+    """
+     cursor.execute(statement, parameters) on a DB-API cursor, recorded
+     like the engine's statements. Returns the cursor to fetch from.
+    """
+    scopes = _scopes() if enabled else None
+    if not scopes:
+        cursor.execute(statement, parameters)
+        return cursor
+    started = time.time()
+    cursor.execute(statement, parameters)
+    _record(scopes, statement, time.time() - started)
+    return _RecordedCursor(cursor, list(scopes))
+
+
+def exposition():
+    """
+     Every metric in the Prometheus text format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.exposition())
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    for metric in REGISTRY:
+        metric.reset()
+
+
+def watch_engine(engine):
+    """
+     Records the statements engine runs, once per engine.
+    """
+    if engine not in _watched_engines:
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+        _watched_engines[engine] = True
+
+
+def enable(app, engine=None, slow_seconds=None):
+    """
+     Registers the hooks (once per app and engine; SQLAlchemy 0.7 can't
+     remove them) and switches recording on.
+    """
+    global enabled, slow_request_seconds, _mapper_watched
+    if engine is not None:
+        watch_engine(engine)
+    if not _mapper_watched:
+        event.listen(mapper, 'load', _object_loaded)
+        _mapper_watched = True
+    if 'metrics' not in app.extensions:
+        app.before_request(_before_request)
+        app.teardown_request(_teardown_request)
+        app.extensions['metrics'] = True
+    slow_request_seconds = slow_seconds
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def init_app(app, db):
+    """
+     Serves /metrics and, when METRICS_ENABLED is set, turns the hooks on
+     for app and for the statements of every engine db makes.
+    """
+    from flask import Response
+    app.add_url_rule('/metrics', 'metrics', lambda: Response(exposition(), mimetype='text/plain; version=0.0.4'))
+    if app.config.get('METRICS_ENABLED'):
+        enable(app, slow_seconds=app.config.get('SLOW_REQUEST_SECONDS'))
+        db.on_engine(watch_engine)
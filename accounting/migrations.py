@@ -0,0 +1,245 @@
+#!/user/bin/env python2.7
+
+import logging
+
+from accounting import db
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Schema migrations for existing accounting.sqlite files.
+
+The schema version is kept in SQLite's user_version pragma.
+Every migration is a function that takes a connection and
+is applied at most once, in order. pysqlite commits before
+every CREATE or ALTER statement, so a migration that fails
+part way keeps the tables and columns it added and must be
+safe to run again: tables and indexes are created IF NOT
+EXISTS and columns with add_column. Fresh databases built by
+build_or_refresh_db() get the whole schema from the models
+and are stamped with the latest version.
+#######################################################
+"""
+
+
+def add_column(connection, table, column, definition):
+    """
+     Adds column to table unless a previous, failed run of the migration
+     already did.
+    """
+    existing = [row[1] for row in connection.execute("PRAGMA table_info(%s)" % table)]
+    if column not in existing:
+        connection.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, definition))
+
+
+def add_balance_indexes(connection):
+    """
+     Composite indexes behind return_account_balance and the
+     cancellation checks (see Invoice and Payment __table_args__).
+    """
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_invoices_policy_deleted_bill_date "
+                       "ON invoices (policy_id, deleted, bill_date, amount_due)")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_invoices_policy_cancel_date "
+                       "ON invoices (policy_id, cancel_date)")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_payments_policy_transaction_date "
+                       "ON payments (policy_id, transaction_date, amount_paid)")
+
+
+def add_ledger(connection):
+    """
+     Running-balance ledger table (see LedgerEntry), filled in from
+     the existing invoices and payments.
+    """
+    from ledger import rebuild_ledger
+
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS ledger (
+            id INTEGER NOT NULL,
+            policy_id INTEGER NOT NULL,
+            event_date DATE NOT NULL,
+            event_type VARCHAR(7) NOT NULL,
+            invoice_id INTEGER,
+            payment_id INTEGER,
+            amount INTEGER NOT NULL,
+            balance INTEGER NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(policy_id) REFERENCES policies (id),
+            CHECK (event_type IN ('Invoice', 'Payment', 'Void')),
+            FOREIGN KEY(invoice_id) REFERENCES invoices (id),
+            FOREIGN KEY(payment_id) REFERENCES payments (id)
+        )""")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_ledger_policy_event_date ON ledger (policy_id, event_date)")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_ledger_invoice_id ON ledger (invoice_id)")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_ledger_payment_id ON ledger (payment_id)")
+    rebuild_ledger(bind=connection)
+
+
+def add_balance_checkpoints(connection):
+    """
+     Month-end billed and paid totals (see BalanceCheckpoint). Left
+     empty: ./manage.py checkpoints refresh fills them in.
+    """
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS balance_checkpoints (
+            id INTEGER NOT NULL,
+            policy_id INTEGER NOT NULL,
+            period_end DATE NOT NULL,
+            billed INTEGER NOT NULL,
+            paid INTEGER NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(policy_id) REFERENCES policies (id)
+        )""")
+    connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_balance_checkpoints_policy_period_end "
+                       "ON balance_checkpoints (policy_id, period_end)")
+
+
+def add_row_versions(connection):
+    """
+     row_version columns, indexes and triggers on policies, invoices and
+     payments, and the row_versions counter (see models.row_versions).
+     Rows already there keep version 0.
+    """
+    from models import VERSIONED_TABLES, row_version_triggers
+
+    connection.execute("CREATE TABLE IF NOT EXISTS row_versions (id INTEGER NOT NULL, value INTEGER NOT NULL, "
+                       "PRIMARY KEY (id))")
+    connection.execute("INSERT OR IGNORE INTO row_versions (id, value) VALUES (1, 0)")
+    for table in VERSIONED_TABLES:
+        add_column(connection, table, 'row_version', "INTEGER DEFAULT '0' NOT NULL")
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_%s_row_version ON %s (row_version)" % (table, table))
+        for statement in row_version_triggers(table):
+            connection.execute(statement)
+
+
+def add_archive_tables(connection):
+    """
+     policies.archived_on and the archived_invoices and archived_payments
+     tables (see ArchivedInvoice and ArchivedPayment), left empty:
+     ./manage.py archive moves rows into them.
+    """
+    add_column(connection, 'policies', 'archived_on', "DATE")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS archived_invoices (
+            id INTEGER NOT NULL,
+            policy_id INTEGER NOT NULL,
+            bill_date DATE NOT NULL,
+            due_date DATE NOT NULL,
+            cancel_date DATE NOT NULL,
+            amount_due INTEGER NOT NULL,
+            deleted BOOLEAN NOT NULL,
+            archived_on DATE NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(policy_id) REFERENCES policies (id),
+            CHECK (deleted IN (0, 1))
+        )""")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_archived_invoices_policy_bill_date "
+                       "ON archived_invoices (policy_id, bill_date)")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS archived_payments (
+            id INTEGER NOT NULL,
+            policy_id INTEGER NOT NULL,
+            contact_id INTEGER NOT NULL,
+            amount_paid INTEGER NOT NULL,
+            transaction_date DATE NOT NULL,
+            archived_on DATE NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(policy_id) REFERENCES policies (id),
+            FOREIGN KEY(contact_id) REFERENCES contacts (id)
+        )""")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_archived_payments_policy_transaction_date "
+                       "ON archived_payments (policy_id, transaction_date)")
+
+
+def add_payment_allocations(connection):
+    """
+     invoices.amount_paid and paid_in_full_on, payments.invoice_id and the
+     payment_allocations table (see PaymentAllocation), filled in from the
+     existing invoices and payments.
+    """
+    from allocation import reallocate
+
+    add_column(connection, 'invoices', 'amount_paid', "INTEGER DEFAULT '0' NOT NULL")
+    add_column(connection, 'invoices', 'paid_in_full_on', "DATE")
+    add_column(connection, 'payments', 'invoice_id', "INTEGER REFERENCES invoices (id)")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS payment_allocations (
+            id INTEGER NOT NULL,
+            policy_id INTEGER NOT NULL,
+            payment_id INTEGER NOT NULL,
+            invoice_id INTEGER NOT NULL,
+            transaction_date DATE NOT NULL,
+            amount INTEGER NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(policy_id) REFERENCES policies (id),
+            FOREIGN KEY(payment_id) REFERENCES payments (id),
+            FOREIGN KEY(invoice_id) REFERENCES invoices (id)
+        )""")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_payment_allocations_policy_id "
+                       "ON payment_allocations (policy_id)")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_payment_allocations_invoice_transaction_date "
+                       "ON payment_allocations (invoice_id, transaction_date, amount)")
+    reallocate(bind=connection)
+
+
+MIGRATIONS = [
+    add_balance_indexes,
+    add_ledger,
+    add_balance_checkpoints,
+    add_row_versions,
+    add_archive_tables,
+    add_payment_allocations,
+]
+
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def current_version(connection):
+    return connection.execute("PRAGMA user_version").scalar()
+
+
+def check_db():
+    """
+     Raises RuntimeError unless the database has had every migration: the
+     models read the columns they add.
+    """
+    connection = db.engine.connect()
+    try:
+        version = current_version(connection)
+    finally:
+        connection.close()
+    if version < LATEST_VERSION:
+        raise RuntimeError("%s is at schema version %d, this code needs %d: run ./manage.py migrate" % (
+            db.engine.url.database, version, LATEST_VERSION))
+
+
+def stamp_db(version=LATEST_VERSION):
+    """
+     Records that the database is at the given schema version.
+    """
+    db.engine.execute("PRAGMA user_version = %d" % version)
+
+
+def upgrade_db():
+    """
+     Applies every migration the database hasn't seen yet, each one in
+     its own transaction. Returns the list of migrations applied.
+    """
+    applied = []
+    connection = db.engine.connect()
+    try:
+        version = current_version(connection)
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            transaction = connection.begin()
+            try:
+                migration(connection)
+                connection.execute("PRAGMA user_version = %d" % number)
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+            logger.info("Applied migration %d: %s", number, migration.__name__)
+            applied.append(migration.__name__)
+    finally:
+        connection.close()
+    return applied
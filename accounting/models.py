@@ -1,3 +1,5 @@
+from sqlalchemy import DDL, event
+
 from accounting import db
 # from sqlalchemy.ext.declarative import declarative_base
 # 
@@ -6,7 +8,11 @@ from accounting import db
 class Policy(db.Model):
     __tablename__ = 'policies'
 
-    __table_args__ = {}
+    # Keep in sync with accounting.migrations.
+    __table_args__ = (
+        db.Index('ix_policies_row_version', 'row_version'),
+        {}
+    )
 
     #column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
@@ -19,6 +25,9 @@ class Policy(db.Model):
     annual_premium = db.Column(u'annual_premium', db.INTEGER(), nullable=False)
     named_insured = db.Column(u'named_insured', db.INTEGER(), db.ForeignKey('contacts.id'))
     agent = db.Column(u'agent', db.INTEGER(), db.ForeignKey('contacts.id'))
+    row_version = db.Column(u'row_version', db.INTEGER(), nullable=False, server_default='0')
+    # set once some of its invoices or payments were moved by accounting.archive
+    archived_on = db.Column(u'archived_on', db.DATE(), nullable=True, default=None)
 
     def __init__(self, policy_number, effective_date, annual_premium):
         self.policy_number = policy_number
@@ -47,7 +56,15 @@ class Contact(db.Model):
 class Invoice(db.Model):
     __tablename__ = 'invoices'
 
-    __table_args__ = {}
+    # balance lookups sum amount_due of live invoices billed up to a date,
+    # cancellation checks walk cancel dates; both stay index-only.
+    # Keep in sync with accounting.migrations.
+    __table_args__ = (
+        db.Index('ix_invoices_policy_deleted_bill_date', 'policy_id', 'deleted', 'bill_date', 'amount_due'),
+        db.Index('ix_invoices_policy_cancel_date', 'policy_id', 'cancel_date'),
+        db.Index('ix_invoices_row_version', 'row_version'),
+        {}
+    )
 
     #column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
@@ -57,6 +74,11 @@ class Invoice(db.Model):
     cancel_date = db.Column(u'cancel_date', db.DATE(), nullable=False)
     amount_due = db.Column(u'amount_due', db.INTEGER(), nullable=False)
     deleted = db.Column(u'deleted', db.Boolean, default=False, server_default='0', nullable=False)
+    row_version = db.Column(u'row_version', db.INTEGER(), nullable=False, server_default='0')
+    # what accounting.allocation applied to the invoice so far, and the date
+    # of the payment that settled it (before bill_date when paid in advance)
+    amount_paid = db.Column(u'amount_paid', db.INTEGER(), nullable=False, default=0, server_default='0')
+    paid_in_full_on = db.Column(u'paid_in_full_on', db.DATE(), nullable=True, default=None)
 
     def __init__(self, policy_id, bill_date, due_date, cancel_date, amount_due):
         self.policy_id = policy_id
@@ -69,7 +91,12 @@ class Invoice(db.Model):
 class Payment(db.Model):
     __tablename__ = 'payments'
 
-    __table_args__ = {}
+    # Keep in sync with accounting.migrations.
+    __table_args__ = (
+        db.Index('ix_payments_policy_transaction_date', 'policy_id', 'transaction_date', 'amount_paid'),
+        db.Index('ix_payments_row_version', 'row_version'),
+        {}
+    )
 
     #column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
@@ -77,9 +104,168 @@ class Payment(db.Model):
     contact_id = db.Column(u'contact_id', db.INTEGER(), db.ForeignKey('contacts.id'), nullable=False)
     amount_paid = db.Column(u'amount_paid', db.INTEGER(), nullable=False)
     transaction_date = db.Column(u'transaction_date', db.DATE(), nullable=False)
+    row_version = db.Column(u'row_version', db.INTEGER(), nullable=False, server_default='0')
+    # the invoice the payment was made for, paid first; None to pay the oldest ones
+    invoice_id = db.Column(u'invoice_id', db.INTEGER(), db.ForeignKey('invoices.id'), nullable=True)
 
-    def __init__(self, policy_id, contact_id, amount_paid, transaction_date):
+    def __init__(self, policy_id, contact_id, amount_paid, transaction_date, invoice_id=None):
         self.policy_id = policy_id
         self.contact_id = contact_id
         self.amount_paid = amount_paid
         self.transaction_date = transaction_date
+        self.invoice_id = invoice_id
+
+
+class LedgerEntry(db.Model):
+    """
+     One dated event on a policy's account together with the
+     running balance right after it. Maintained by accounting.ledger.
+    """
+    __tablename__ = 'ledger'
+
+    # Keep in sync with accounting.migrations.
+    __table_args__ = (
+        db.Index('ix_ledger_policy_event_date', 'policy_id', 'event_date'),
+        db.Index('ix_ledger_invoice_id', 'invoice_id'),
+        db.Index('ix_ledger_payment_id', 'payment_id'),
+        {}
+    )
+
+    #column definitions
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
+    event_date = db.Column(u'event_date', db.DATE(), nullable=False)
+    event_type = db.Column(u'event_type', db.Enum(u'Invoice', u'Payment', u'Void'), nullable=False)
+    invoice_id = db.Column(u'invoice_id', db.INTEGER(), db.ForeignKey('invoices.id'), nullable=True)
+    payment_id = db.Column(u'payment_id', db.INTEGER(), db.ForeignKey('payments.id'), nullable=True)
+    amount = db.Column(u'amount', db.INTEGER(), nullable=False)
+    balance = db.Column(u'balance', db.INTEGER(), nullable=False)
+
+
+class BalanceCheckpoint(db.Model):
+    """
+     Everything billed and paid on a policy up to and including a
+     month-end. Maintained by accounting.checkpoints.
+    """
+    __tablename__ = 'balance_checkpoints'
+
+    # Keep in sync with accounting.migrations.
+    __table_args__ = (
+        db.Index('ix_balance_checkpoints_policy_period_end', 'policy_id', 'period_end', unique=True),
+        {}
+    )
+
+    #column definitions
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
+    period_end = db.Column(u'period_end', db.DATE(), nullable=False)
+    billed = db.Column(u'billed', db.INTEGER(), nullable=False)
+    paid = db.Column(u'paid', db.INTEGER(), nullable=False)
+
+
+class PaymentAllocation(db.Model):
+    """
+     The part of a payment applied to one invoice. Maintained by
+     accounting.allocation.
+    """
+    __tablename__ = 'payment_allocations'
+
+    # Keep in sync with accounting.migrations.
+    __table_args__ = (
+        db.Index('ix_payment_allocations_policy_id', 'policy_id'),
+        db.Index('ix_payment_allocations_invoice_transaction_date', 'invoice_id', 'transaction_date', 'amount'),
+        {}
+    )
+
+    #column definitions
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
+    payment_id = db.Column(u'payment_id', db.INTEGER(), db.ForeignKey('payments.id'), nullable=False)
+    invoice_id = db.Column(u'invoice_id', db.INTEGER(), db.ForeignKey('invoices.id'), nullable=False)
+    # the payment's, so what was paid on an invoice as of a date is one index range
+    transaction_date = db.Column(u'transaction_date', db.DATE(), nullable=False)
+    amount = db.Column(u'amount', db.INTEGER(), nullable=False)
+
+
+class ArchivedInvoice(db.Model):
+    """
+     An invoice moved out of invoices by accounting.archive, with the
+     same id and columns.
+    """
+    __tablename__ = 'archived_invoices'
+
+    # Keep in sync with accounting.migrations.
+    __table_args__ = (
+        db.Index('ix_archived_invoices_policy_bill_date', 'policy_id', 'bill_date'),
+        {}
+    )
+
+    #column definitions
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
+    bill_date = db.Column(u'bill_date', db.DATE(), nullable=False)
+    due_date = db.Column(u'due_date', db.DATE(), nullable=False)
+    cancel_date = db.Column(u'cancel_date', db.DATE(), nullable=False)
+    amount_due = db.Column(u'amount_due', db.INTEGER(), nullable=False)
+    deleted = db.Column(u'deleted', db.Boolean, nullable=False)
+    archived_on = db.Column(u'archived_on', db.DATE(), nullable=False)
+
+
+class ArchivedPayment(db.Model):
+    """
+     A payment moved out of payments by accounting.archive, with the
+     same id and columns.
+    """
+    __tablename__ = 'archived_payments'
+
+    # Keep in sync with accounting.migrations.
+    __table_args__ = (
+        db.Index('ix_archived_payments_policy_transaction_date', 'policy_id', 'transaction_date'),
+        {}
+    )
+
+    #column definitions
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
+    contact_id = db.Column(u'contact_id', db.INTEGER(), db.ForeignKey('contacts.id'), nullable=False)
+    amount_paid = db.Column(u'amount_paid', db.INTEGER(), nullable=False)
+    transaction_date = db.Column(u'transaction_date', db.DATE(), nullable=False)
+    archived_on = db.Column(u'archived_on', db.DATE(), nullable=False)
+
+
+# Every insert into or update of policies, invoices and payments stamps the
+# row with the next value of row_versions.value, so that accounting.export
+# can pick up what changed since a watermark. Writers are serialized by
+# SQLite, so versions follow commit order. Keep in sync with
+# accounting.migrations.
+row_versions = db.Table('row_versions',
+                        db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False),
+                        db.Column(u'value', db.INTEGER(), nullable=False))
+
+VERSIONED_TABLES = ('policies', 'invoices', 'payments')
+
+
+def row_version_triggers(table):
+    statements = []
+    for event_name in ('INSERT', 'UPDATE'):
+        statements.append(
+            "CREATE TRIGGER IF NOT EXISTS tr_%(table)s_row_version_%(event)s AFTER %(EVENT)s ON %(table)s "
+            "BEGIN "
+            "UPDATE row_versions SET value = value + 1 WHERE id = 1; "
+            "UPDATE %(table)s SET row_version = (SELECT value FROM row_versions WHERE id = 1) WHERE id = NEW.id; "
+            "END" % {'table': table, 'event': event_name.lower(), 'EVENT': event_name})
+    return statements
+
+
+event.listen(row_versions, 'after_create', DDL("INSERT INTO row_versions (id, value) VALUES (1, 0)"))
+for model in (Policy, Invoice, Payment):
+    for statement in row_version_triggers(model.__tablename__):
+        event.listen(model.__table__, 'after_create', DDL(statement))
+
+
+# keeps the ledger, the checkpoints, the allocations and the response cache in step with every invoice
+# and payment write
+import ledger
+import checkpoints
+import allocation
+import cache
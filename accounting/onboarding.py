@@ -0,0 +1,160 @@
+#!/user/bin/env python2.7
+
+import calendar
+import logging
+import time
+from datetime import timedelta
+
+from sqlalchemy import exists, func, select
+
+from accounting import db
+from allocation import reallocate
+from chunking import chunked
+from database import begin_immediate
+from ledger import post_invoices
+from models import Invoice, Policy
+from utils import PolicyAccounting
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Bulk onboarding: generates the invoices of many policies
+at once with the same dates and amounts make_invoices
+would give each of them.
+
+The month arithmetic is done once per distinct effective
+date and billing schedule (a whole book shares a few
+thousand of those) from a table of month offsets, and the
+rows are written with one executemany per chunk.
+#######################################################
+"""
+
+# months after the effective date each invoice is billed on
+SCHEDULE_OFFSETS = dict(
+    (schedule, [i * PolicyAccounting.scheduling_interval[schedule] for i in range(count)])
+    for schedule, count in PolicyAccounting.billing_schedules.items())
+
+GRACE_PERIOD = timedelta(days=14)
+
+_month_lengths = {}
+_templates = {}
+
+
+def month_length(year, month):
+    try:
+        return _month_lengths[(year, month)]
+    except KeyError:
+        length = _month_lengths[(year, month)] = calendar.monthrange(year, month)[1]
+        return length
+
+
+def add_months(day, months):
+    """
+     Same as day + relativedelta(months=months): the day of the month is
+     clamped to the length of the month landed on.
+    """
+    year, month = divmod(day.year * 12 + day.month - 1 + months, 12)
+    month += 1
+    return day.replace(year=year, month=month, day=min(day.day, month_length(year, month)))
+
+
+def schedule_dates(effective_date, billing_schedule):
+    """
+     (bill_date, due_date, cancel_date) of every invoice make_invoices
+     creates for a policy, computed once per effective date and schedule.
+     Like make_invoices, due and cancel dates are derived from the
+     (possibly clamped) bill date rather than the effective date.
+    """
+    key = (effective_date, billing_schedule)
+    if key not in _templates:
+        dates = []
+        for offset in SCHEDULE_OFFSETS[billing_schedule]:
+            bill_date = add_months(effective_date, offset)
+            due_date = add_months(bill_date, 1)
+            dates.append((bill_date, due_date, due_date + GRACE_PERIOD))
+        _templates[key] = dates
+    return _templates[key]
+
+
+def invoice_rows(policy_id, effective_date, billing_schedule, annual_premium):
+    """
+     The invoice rows make_invoices would create for a policy.
+    """
+    amount_due = annual_premium / PolicyAccounting.billing_schedules[billing_schedule]
+    return [{'policy_id': policy_id,
+             'bill_date': bill_date,
+             'due_date': due_date,
+             'cancel_date': cancel_date,
+             'amount_due': amount_due,
+             'deleted': False} for bill_date, due_date, cancel_date in schedule_dates(effective_date,
+                                                                                         billing_schedule)]
+
+
+def policies_without_invoices(policy_ids=None):
+    """
+     Ids of the policies that still need invoices (all of them, or
+     only those among policy_ids).
+    """
+    policies = Policy.__table__
+    invoices = Invoice.__table__
+    query = select([policies.c.id],
+                   ~exists([invoices.c.id], invoices.c.policy_id == policies.c.id)) \
+        .order_by(policies.c.id)
+    if policy_ids is None:
+        return [row[0] for row in db.session.execute(query)]
+    found = []
+    for ids in chunked(sorted(set(policy_ids))):
+        found.extend(row[0] for row in db.session.execute(query.where(policies.c.id.in_(ids))))
+    return found
+
+
+def onboard_policies(policy_ids=None, chunk_size=1000, progress=None):
+    """
+     Generates invoices for every policy (or every policy in policy_ids)
+     that has none yet, chunk_size policies per transaction.
+     progress(done, total) is called after every chunk.
+     Returns a summary of the run.
+    """
+    started = time.time()
+    pending = policies_without_invoices(policy_ids)
+    summary = {'policies': len(pending), 'invoices': 0, 'chunks': 0}
+
+    policies = Policy.__table__
+    invoices = Invoice.__table__
+    for ids in chunked(pending, chunk_size):
+        rows = []
+        for part in chunked(ids):
+            for policy in db.session.execute(
+                    select([policies.c.id, policies.c.effective_date, policies.c.billing_schedule,
+                            policies.c.annual_premium], policies.c.id.in_(part))):
+                rows.extend(invoice_rows(policy.id, policy.effective_date, policy.billing_schedule,
+                                         policy.annual_premium))
+        try:
+            # ids are handed out here so the ledger rows can point at them,
+            # under the write lock so no other writer takes them meanwhile
+            begin_immediate(db.session)
+            last_id = db.session.execute(select([func.coalesce(func.max(invoices.c.id), 0)])).scalar()
+            for offset, row in enumerate(rows, start=1):
+                row['id'] = last_id + offset
+            if rows:
+                db.session.execute(invoices.insert(), rows)
+                post_invoices(db.session, rows)
+                # payments made before the policy was billed
+                reallocate(ids, bind=db.session, commit=False)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+
+        summary['invoices'] += len(rows)
+        summary['chunks'] += 1
+        done = min(summary['chunks'] * chunk_size, len(pending))
+        logger.info("Onboarded %d of %d policies", done, len(pending))
+        if progress is not None:
+            progress(done, len(pending))
+
+    summary['seconds'] = time.time() - started
+    logger.info("Created %d invoices for %d policies in %.3fs",
+                summary['invoices'], summary['policies'], summary['seconds'])
+    return summary
@@ -0,0 +1,232 @@
+#!/user/bin/env python2.7
+
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy import and_, func, or_, select
+
+from accounting import db
+from archive import archived_policy_ids, archived_whole_ids
+from cache import invalidate_policies
+from chunking import chunked
+from ledger import balances_as_of
+from models import Invoice, Payment, Policy
+from utils import PolicyReader
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Set-based queries that run over the whole book of
+policies instead of one PolicyAccounting at a time.
+#######################################################
+"""
+
+def _cancel_checkpoints(date_cursor, policy_ids=None, statuses=(u'Active',)):
+    """
+     Every distinct (policy_id, cancel_date) pair that has been reached
+     by date_cursor. These are the dates evaluate_cancel checks the
+     invoices on.
+    """
+    invoices = Invoice.__table__
+    policies = Policy.__table__
+
+    where = [invoices.c.cancel_date <= date_cursor, invoices.c.deleted == False]
+    if statuses:
+        where.append(policies.c.status.in_(statuses))
+    if policy_ids is not None:
+        where.append(invoices.c.policy_id.in_(policy_ids))
+
+    return select([invoices.c.policy_id, invoices.c.cancel_date],
+                  and_(*where),
+                  from_obj=[invoices.join(policies, policies.c.id == invoices.c.policy_id)],
+                  distinct=True).alias('checkpoints')
+
+
+def _overdue_checkpoints(checkpoints):
+    """
+     The first checkpoint of each policy by which one of its live
+     invoices billed by then wasn't paid in full, going by the
+     paid_in_full_on dates accounting.allocation keeps, as
+     allocation.overdue_invoice finds it.
+    """
+    invoices = Invoice.__table__
+    still_open = and_(invoices.c.policy_id == checkpoints.c.policy_id,
+                      invoices.c.deleted == False,
+                      invoices.c.bill_date <= checkpoints.c.cancel_date,
+                      or_(invoices.c.paid_in_full_on == None,
+                          invoices.c.paid_in_full_on > checkpoints.c.cancel_date))
+    return select([checkpoints.c.policy_id, func.min(checkpoints.c.cancel_date).label('cancel_date')],
+                  from_obj=[checkpoints.join(invoices, still_open)]) \
+        .group_by(checkpoints.c.policy_id) \
+        .alias('overdue')
+
+
+def _totals_at_checkpoints(checkpoints, table, amount, date_column, *criteria):
+    """
+     Sums amount over the rows of table dated on or before each checkpoint,
+     ordered by policy and cancel date so the results can be merged.
+    """
+    joined = checkpoints.join(table, and_(table.c.policy_id == checkpoints.c.policy_id,
+                                          date_column <= checkpoints.c.cancel_date,
+                                          *criteria))
+    return select([checkpoints.c.policy_id, checkpoints.c.cancel_date, func.sum(amount)],
+                  from_obj=[joined]) \
+        .group_by(checkpoints.c.policy_id, checkpoints.c.cancel_date) \
+        .order_by(checkpoints.c.policy_id, checkpoints.c.cancel_date)
+
+
+def find_policies_to_cancel(date_cursor=None, policy_ids=None, statuses=(u'Active',)):
+    """
+     Returns a dict of policy_id => (cancel_date, outstanding) for every
+     policy with an invoice not paid in full by one of its invoices'
+     cancel dates up to date_cursor, outstanding being what the policy
+     owed that day. The cancel date reported is the earliest one that
+     triggered, which is the same invoice evaluate_cancel reports.
+
+     The work is done in two grouped queries (billed and paid totals at
+     each policy's first overdue checkpoint) whose ordered results are
+     merged as they stream in. Policies archived whole, whose invoices
+     keep no paid in full dates, are asked PolicyReader one by one.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+
+    results = {}
+    for ids in ([None] if policy_ids is None else chunked(policy_ids)):
+        overdue = _overdue_checkpoints(_cancel_checkpoints(date_cursor, ids, statuses))
+        invoices = Invoice.__table__
+        payments = Payment.__table__
+        billed = db.session.execute(
+            _totals_at_checkpoints(overdue, invoices, invoices.c.amount_due, invoices.c.bill_date,
+                                   invoices.c.deleted == False))
+        paid = db.session.execute(
+            _totals_at_checkpoints(overdue, payments, payments.c.amount_paid,
+                                   payments.c.transaction_date))
+
+        paid_row = paid.fetchone()
+        for policy_id, cancel_date, billed_total in billed:
+            # both cursors are sorted on the same key, so advance the payments
+            # side until it catches up with the current checkpoint
+            while paid_row is not None and (paid_row[0], paid_row[1]) < (policy_id, cancel_date):
+                paid_row = paid.fetchone()
+            paid_total = 0
+            if paid_row is not None and (paid_row[0], paid_row[1]) == (policy_id, cancel_date):
+                paid_total = paid_row[2]
+            results[policy_id] = (cancel_date, billed_total - paid_total)
+        paid.close()
+
+        for policy_id in archived_whole_ids(ids, statuses):
+            result = PolicyReader(policy_id).evaluate_cancel(date_cursor)
+            if result:
+                results[policy_id] = (result.cancel_date, result.outstanding)
+            else:
+                results.pop(policy_id, None)
+
+    return results
+
+
+def cancel_policies(policy_ids, reason):
+    """
+     Bulk equivalent of PolicyAccounting.cancel_policy: flips the status,
+     reason and date_changed of every policy in one transaction.
+     Returns the number of policies updated.
+    """
+    policies = Policy.__table__
+    today = datetime.now().date()
+    updated = 0
+    invalidate_policies(policy_ids)
+    for ids in chunked(policy_ids):
+        result = db.session.execute(
+            policies.update()
+            .where(and_(policies.c.id.in_(ids), policies.c.status != u'Canceled'))
+            .values(status=u'Canceled', reason=reason, date_changed=today))
+        updated += result.rowcount
+    db.session.commit()
+    logger.info("Cancelled %d policies: %s", updated, reason)
+    return updated
+
+
+def run_cancellation_sweep(date_cursor=None, apply=False, reason=u'Non-payment', policy_ids=None):
+    """
+     Nightly sweep: finds every active policy due for cancellation as of
+     date_cursor and, when apply is set, cancels them in bulk.
+     Returns a summary with the counts and how long each step took.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+
+    started = time.time()
+    to_cancel = find_policies_to_cancel(date_cursor, policy_ids=policy_ids)
+    evaluated = time.time()
+
+    canceled = 0
+    if apply and to_cancel:
+        canceled = cancel_policies(sorted(to_cancel), reason)
+    finished = time.time()
+
+    summary = {
+        'date': date_cursor,
+        'to_cancel': len(to_cancel),
+        'canceled': canceled,
+        'outstanding': sum(outstanding for _, outstanding in to_cancel.values()),
+        'policies': to_cancel,
+        'timings': {
+            'evaluate': evaluated - started,
+            'apply': finished - evaluated,
+            'total': finished - started,
+        },
+    }
+    logger.info("Cancellation sweep for %s: %d due, %d canceled in %.3fs",
+                date_cursor, summary['to_cancel'], canceled, summary['timings']['total'])
+    return summary
+
+
+def policy_summaries(policy_ids, date_cursor):
+    """
+     What the get_result view shows for one policy, for many policies at
+     once: balance, invoices billed up to date_cursor and whether the
+     policy is pending cancellation. Uses a few grouped queries for the
+     whole batch instead of one PolicyAccounting per policy.
+     Returns a dict of policy_id => summary; unknown ids are left out.
+     Policies with archived rows are looked up one by one instead.
+    """
+    policy_ids = sorted(set(policy_ids))
+    balances = balances_as_of(policy_ids, date_cursor)
+    pending = find_policies_to_cancel(date_cursor, policy_ids=balances.keys(), statuses=None)
+
+    summaries = {}
+    for policy_id, balance in balances.items():
+        summaries[policy_id] = {
+            'policy_id': policy_id,
+            'balance': balance,
+            'cancellation_pending': policy_id in pending,
+            'invoices': [],
+        }
+
+    invoices = Invoice.__table__
+    for ids in chunked(summaries.keys()):
+        rows = db.session.execute(
+            select([invoices.c.policy_id, invoices.c.bill_date, invoices.c.due_date,
+                    invoices.c.cancel_date, invoices.c.amount_due],
+                   and_(invoices.c.policy_id.in_(ids), invoices.c.bill_date <= date_cursor))
+            .order_by(invoices.c.policy_id, invoices.c.bill_date))
+        for row in rows:
+            summaries[row.policy_id]['invoices'].append({
+                'bill_date': row.bill_date.strftime('%Y-%m-%d'),
+                'due_date': row.due_date.strftime('%Y-%m-%d'),
+                'cancel_date': row.cancel_date.strftime('%Y-%m-%d'),
+                'amount_due': row.amount_due,
+            })
+
+    for policy_id in archived_policy_ids(summaries.keys()):
+        reader = PolicyReader(policy_id)
+        summaries[policy_id].update(
+            balance=reader.return_account_balance(date_cursor),
+            cancellation_pending=bool(reader.evaluate_cancel(date_cursor)),
+            invoices=[{'bill_date': invoice.bill_date.strftime('%Y-%m-%d'),
+                       'due_date': invoice.due_date.strftime('%Y-%m-%d'),
+                       'cancel_date': invoice.cancel_date.strftime('%Y-%m-%d'),
+                       'amount_due': invoice.amount_due} for invoice in reader.get_invoices(date_cursor)])
+    return summaries
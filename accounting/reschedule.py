@@ -0,0 +1,157 @@
+#!/user/bin/env python2.7
+
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy import and_, func, select
+
+from accounting import db
+from allocation import reallocate
+from chunking import chunked
+from ledger import rebuild_ledger
+from models import Invoice, Policy
+from onboarding import GRACE_PERIOD, add_months
+from utils import PolicyAccounting
+# imported as a module: it and models import each other through here
+import checkpoints
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Bulk billing schedule changes.
+
+reschedule_policies() does what change_policy does, for many
+policies at once: the invoices billed on or after the date
+are voided with one UPDATE, the policies get the new schedule
+and, as effective date, the first voided bill date, and the
+replacement invoices are inserted with one executemany.
+The ledger and the payment allocations of the policies
+changed are worked out again from their invoices and
+payments afterwards.
+
+change_policy's quirks are kept so both give the same
+invoices: it creates as many invoices as the new schedule has
+per year minus the old schedule's interval in months, it
+fails on a policy with nothing billed on or after the date,
+and changes nothing when that count is 0. Those policies are
+reported as skipped.
+#######################################################
+"""
+
+
+def _replacement_rows(policy_id, effective_date, schedule, count, annual_premium):
+    """
+     The count invoices make_invoices(changing=True, count) creates once
+     the policy is on schedule from effective_date.
+    """
+    amount_due = annual_premium / PolicyAccounting.billing_schedules[schedule]
+    rows = []
+    for i in range(count):
+        bill_date = add_months(effective_date, i * PolicyAccounting.scheduling_interval[schedule])
+        due_date = add_months(bill_date, 1)
+        rows.append({'policy_id': policy_id,
+                     'bill_date': bill_date,
+                     'due_date': due_date,
+                     'cancel_date': due_date + GRACE_PERIOD,
+                     'amount_due': amount_due,
+                     'deleted': False})
+    return rows
+
+
+def policies_on_schedule(schedule, statuses=(u'Active',)):
+    """
+     Ids of the policies billed on schedule, for moving a whole product.
+    """
+    policies = Policy.__table__
+    where = [policies.c.billing_schedule == schedule]
+    if statuses:
+        where.append(policies.c.status.in_(statuses))
+    return [row[0] for row in db.session.execute(select([policies.c.id], and_(*where)).order_by(policies.c.id))]
+
+
+def _reschedule_chunk(ids, schedule, date_cursor, summary):
+    policies = Policy.__table__
+    invoices = Invoice.__table__
+    first_bill_date = select([func.min(invoices.c.bill_date)],
+                             and_(invoices.c.policy_id == policies.c.id,
+                                  invoices.c.bill_date >= date_cursor)).as_scalar()
+
+    changing = {}
+    for part in chunked(ids):
+        for policy_id, old_schedule, annual_premium, first in db.session.execute(
+                select([policies.c.id, policies.c.billing_schedule, policies.c.annual_premium,
+                        first_bill_date.label('first_bill_date')], policies.c.id.in_(part))):
+            if first is None:
+                summary['skipped'].append((policy_id, "no invoice billed on or after %s" % date_cursor))
+                continue
+            count = PolicyAccounting.billing_schedules[schedule] - \
+                PolicyAccounting.scheduling_interval[old_schedule]
+            if count == 0:
+                summary['skipped'].append((policy_id, "can't change policy with no invoices emitted"))
+                continue
+            changing[policy_id] = (first, count, annual_premium)
+    if not changing:
+        return
+
+    rows = []
+    for policy_id in sorted(changing):
+        first, count, annual_premium = changing[policy_id]
+        rows.extend(_replacement_rows(policy_id, first, schedule, count, annual_premium))
+
+    for part in chunked(sorted(changing)):
+        summary['voided'] += db.session.execute(
+            invoices.update()
+            .where(and_(invoices.c.policy_id.in_(part), invoices.c.bill_date >= date_cursor,
+                        invoices.c.deleted == False))
+            .values(deleted=True)).rowcount
+        # first_bill_date doesn't look at deleted, so it still finds the invoices just voided
+        db.session.execute(policies.update()
+                           .where(policies.c.id.in_(part))
+                           .values(billing_schedule=schedule, effective_date=first_bill_date))
+    if rows:
+        db.session.execute(invoices.insert(), rows)
+
+    rebuild_ledger(changing.keys(), bind=db.session, commit=False)
+    reallocate(changing.keys(), bind=db.session, commit=False)
+    checkpoints.invalidate_from(db.session, dict((policy_id, first)
+                                                 for policy_id, (first, _, _) in changing.items()))
+    summary['changed'] += len(changing)
+    summary['invoices'] += len(rows)
+
+
+def reschedule_policies(policy_ids, schedule, date_cursor=None, chunk_size=1000, progress=None):
+    """
+     change_policy(schedule, date_cursor) for every policy in policy_ids,
+     chunk_size policies per transaction. progress(done, total) is called
+     after every chunk. Returns a summary of the run, with the policies
+     left alone and why under 'skipped'.
+    """
+    if schedule not in PolicyAccounting.billing_schedules:
+        raise ValueError("Unknown billing schedule %r" % schedule)
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+
+    started = time.time()
+    pending = sorted(set(policy_ids))
+    summary = {'policies': len(pending), 'changed': 0, 'voided': 0, 'invoices': 0, 'chunks': 0, 'skipped': []}
+    for ids in chunked(pending, chunk_size):
+        try:
+            _reschedule_chunk(ids, schedule, date_cursor, summary)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+
+        summary['chunks'] += 1
+        done = min(summary['chunks'] * chunk_size, len(pending))
+        logger.info("Rescheduled %d of %d policies", done, len(pending))
+        if progress is not None:
+            progress(done, len(pending))
+
+    summary['seconds'] = time.time() - started
+    logger.info("Moved %d policies to %s as of %s in %.3fs: %d invoices voided, %d created, %d skipped",
+                summary['changed'], schedule, date_cursor, summary['seconds'], summary['voided'],
+                summary['invoices'], len(summary['skipped']))
+    return summary
@@ -0,0 +1,60 @@
+#!/user/bin/env python2.7
+
+from gunicorn.app.base import BaseApplication
+
+from accounting import create_app, db, settings
+from cache import response_cache
+from database import close_connections
+from logs import configure_logging
+
+"""
+#######################################################
+Production serving mode.
+
+Runs the app under gunicorn's pre-fork server: a master
+process binding the socket and SERVER_WORKERS worker
+processes, each with SERVER_THREADS threads, taking requests
+from it. runserver.py stays the single-threaded debug server.
+
+Each worker drops what it inherited from the master that
+can't cross a fork (the log writer thread, pooled SQLite
+connections, cached lookups) and starts its own. Metrics and
+the response cache are per worker.
+#######################################################
+"""
+
+
+def post_fork(server, worker):
+    configure_logging(settings)
+    close_connections(db)
+    response_cache.clear()
+
+
+class AccountingServer(BaseApplication):
+
+    def __init__(self, options):
+        self.options = options
+        BaseApplication.__init__(self)
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return create_app()
+
+
+def serve(bind=None, workers=None, threads=None):
+    """
+     Serves the app until interrupted. Settings default to the SERVER_*
+     values of config.py.
+    """
+    threads = threads or settings['SERVER_THREADS']
+    AccountingServer({
+        'bind': bind or settings['SERVER_BIND'],
+        'workers': workers or settings['SERVER_WORKERS'],
+        'threads': threads,
+        'worker_class': 'gthread' if threads > 1 else 'sync',
+        'timeout': settings['SERVER_TIMEOUT'],
+        'post_fork': post_fork,
+    }).run()
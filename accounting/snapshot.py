@@ -0,0 +1,110 @@
+#!/user/bin/env python2.7
+
+import logging
+import os
+import tempfile
+import time
+
+import metrics
+from accounting import db, settings
+from database import snapshot_path
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Read snapshots of the database.
+
+With SNAPSHOT_ENABLED, the lookups, reports and exports run
+in db.reading_snapshot() and read a copy of the database
+instead of the database itself, so a long report never
+holds up make_payment or change_policy, at the price of not
+seeing what was written since the copy was taken. Writes
+always go to the database.
+
+refresh_snapshot() makes the copy with SQLite's VACUUM INTO,
+in one read transaction, which with WAL never keeps a writer
+waiting, into a scratch file next to the snapshot that is
+then renamed over it. Readers that have the old copy open
+carry on reading it; the next ones get the new one. The
+copy's modification time is when it was taken, so every
+process can tell its age, which the views send in an
+X-Snapshot-Age header and /metrics serves.
+#######################################################
+"""
+
+REFRESH_SECONDS = metrics.Histogram('accounting_snapshot_refresh_seconds',
+                                    "Time spent copying the database into the read snapshot.",
+                                    'outcome', metrics.SECONDS_BUCKETS)
+
+
+def snapshot_file():
+    return snapshot_path(settings)
+
+
+def seconds_since(taken_at, now=None):
+    return max(0.0, (now or time.time()) - taken_at)
+
+
+def snapshot_age(now=None):
+    """
+     Seconds since the snapshot was taken, None when there is none.
+    """
+    path = snapshot_file()
+    try:
+        return seconds_since(os.path.getmtime(path), now) if path else None
+    except OSError:
+        return None
+
+
+def refresh_snapshot():
+    """
+     Copies the database into the snapshot file, replacing the previous
+     copy. Returns the seconds it took.
+    """
+    path = snapshot_file()
+    if path is None:
+        raise ValueError("Only an SQLite database file can have a read snapshot")
+    started = time.time()
+    # VACUUM INTO writes to a file that is missing or empty
+    handle, scratch = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                       dir=os.path.dirname(path))
+    os.close(handle)
+    connection = db.engine.raw_connection()
+    try:
+        connection.cursor().execute("VACUUM INTO ?", (scratch,))
+        # everything committed before started is in the copy
+        os.utime(scratch, (started, started))
+        os.rename(scratch, path)
+    except Exception:
+        REFRESH_SECONDS.observe('failed', time.time() - started)
+        if os.path.exists(scratch):
+            os.remove(scratch)
+        raise
+    finally:
+        connection.close()
+    seconds = time.time() - started
+    REFRESH_SECONDS.observe('ok', seconds)
+    logger.info("Refreshed the read snapshot %s in %.3fs", path, seconds)
+    return seconds
+
+
+class SnapshotMetrics(object):
+    """
+     Serves the snapshot's age on /metrics when snapshots are enabled.
+    """
+    name = 'accounting_snapshot_age_seconds'
+
+    def exposition(self):
+        age = snapshot_age() if settings.get('SNAPSHOT_ENABLED') else None
+        if age is None:
+            return []
+        return ["# HELP %s Seconds since the read snapshot was taken." % self.name,
+                "# TYPE %s gauge" % self.name,
+                "%s %s" % (self.name, repr(round(age, 3)))]
+
+    def reset(self):
+        pass
+
+
+metrics.REGISTRY.extend([REFRESH_SECONDS, SnapshotMetrics()])
@@ -0,0 +1,215 @@
+#!/user/bin/env python2.7
+
+import logging
+import os
+import random
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import create_engine
+
+from accounting import db
+from allocation import InvoiceRow, PaymentRow, allocate
+from migrations import LATEST_VERSION
+from models import Contact, Invoice, LedgerEntry, Payment, PaymentAllocation, Policy
+from onboarding import invoice_rows
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Synthetic portfolios for benchmarking.
+
+Builds a scratch SQLite file holding N policies spread over
+every billing schedule, their invoices and a realistic
+payment history. The same seed and size always give the
+same database, so benchmark runs can be compared.
+#######################################################
+"""
+
+SCALES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+
+SCHEDULE_WEIGHTS = [('Annual', 20), ('Two-Pay', 20), ('Quarterly', 30), ('Monthly', 30)]
+
+# policies become effective over two years; payments stop at HISTORY_END
+FIRST_EFFECTIVE_DATE = date(2014, 1, 1)
+EFFECTIVE_DAYS = 730
+HISTORY_END = date(2016, 6, 30)
+
+POLICIES_PER_AGENT = 200
+
+
+def parse_scale(value):
+    """
+     Accepts either one of the SCALES names or a plain number of policies.
+    """
+    if value.lower() in SCALES:
+        return SCALES[value.lower()]
+    return int(value)
+
+
+def _weighted_choice(rng, weights):
+    pick = rng.uniform(0, sum(weight for _, weight in weights))
+    for value, weight in weights:
+        pick -= weight
+        if pick <= 0:
+            return value
+    return weights[-1][0]
+
+
+def _payments_for(rng, policy, invoices, agent_id):
+    """
+     A payment history for one policy: most insureds pay every invoice
+     before it is due, some pay late, some pay only part and a few stop
+     paying altogether.
+    """
+    profile = _weighted_choice(rng, [('prompt', 80), ('late', 12), ('partial', 5), ('lapsed', 3)])
+    stop_after = rng.randint(0, len(invoices)) if profile == 'lapsed' else len(invoices)
+
+    payments = []
+    for number, invoice in enumerate(invoices):
+        if number >= stop_after:
+            break
+        if profile == 'late':
+            paid_on = invoice['due_date'] + timedelta(days=rng.randint(0, 24))
+        else:
+            paid_on = invoice['bill_date'] + timedelta(days=rng.randint(0, (invoice['due_date'] -
+                                                                          invoice['bill_date']).days))
+        if paid_on > HISTORY_END:
+            break
+        amount = invoice['amount_due']
+        if profile == 'partial':
+            amount = amount * rng.randint(50, 90) / 100
+        contact_id = agent_id if rng.random() < 0.1 else policy['named_insured']
+        payments.append({'policy_id': policy['id'],
+                         'contact_id': contact_id,
+                         'amount_paid': amount,
+                         'transaction_date': paid_on})
+    return payments
+
+
+def _ledger_rows(policy_id, invoices, payments):
+    # same event order as ledger.expected_entries: invoices before payments on a day
+    events = sorted([(invoice['bill_date'], 0, invoice['id'], None, invoice['amount_due'])
+                     for invoice in invoices] +
+                    [(payment['transaction_date'], 2, None, payment['id'], -payment['amount_paid'])
+                     for payment in payments])
+    balance = 0
+    rows = []
+    for event_date, seq, invoice_id, payment_id, amount in events:
+        balance += amount
+        rows.append({'policy_id': policy_id,
+                     'event_date': event_date,
+                     'event_type': u'Invoice' if seq == 0 else u'Payment',
+                     'invoice_id': invoice_id,
+                     'payment_id': payment_id,
+                     'amount': amount,
+                     'balance': balance})
+    return rows
+
+
+def _allocation_rows(policy_id, invoices, payments):
+    """
+     Fills in amount_paid and paid_in_full_on of the invoice rows and
+     returns the payment_allocations rows, as accounting.allocation
+     would write them.
+    """
+    applied, paid, _ = allocate(
+        [InvoiceRow(invoice['id'], invoice['bill_date'], invoice['cancel_date'], invoice['amount_due'], False)
+         for invoice in invoices],
+        sorted(PaymentRow(payment['id'], payment['transaction_date'], payment['amount_paid'], None)
+               for payment in payments))
+    for invoice in invoices:
+        invoice['amount_paid'], invoice['paid_in_full_on'] = paid[invoice['id']]
+    return [{'policy_id': policy_id,
+             'payment_id': payment_id,
+             'invoice_id': invoice_id,
+             'transaction_date': transaction_date,
+             'amount': amount} for (payment_id, invoice_id), (transaction_date, amount) in sorted(applied.items())]
+
+
+def generate_portfolio(path, policies, seed=0, chunk_size=10000, overwrite=False, progress=None):
+    """
+     Writes a synthetic book of the given number of policies to a new
+     SQLite file at path. progress(done, total) is called after every
+     chunk of policies. Returns a summary with the row counts.
+    """
+    if os.path.exists(path):
+        if not overwrite:
+            raise ValueError("%s already exists" % path)
+        os.remove(path)
+
+    started = time.time()
+    rng = random.Random(seed)
+    engine = create_engine('sqlite:///' + os.path.abspath(path))
+    db.Model.metadata.create_all(engine)
+    engine.execute("PRAGMA user_version = %d" % LATEST_VERSION)
+
+    summary = {'policies': policies, 'contacts': 0, 'invoices': 0, 'payments': 0, 'seed': seed}
+    connection = engine.connect()
+    try:
+        agents = [{'id': number, 'name': u'Agent %d' % number, 'role': u'Agent'}
+                  for number in range(1, policies / POLICIES_PER_AGENT + 2)]
+        connection.execute(Contact.__table__.insert(), agents)
+        summary['contacts'] += len(agents)
+        next_contact = len(agents) + 1
+        next_invoice = next_payment = 1
+
+        for first in range(1, policies + 1, chunk_size):
+            transaction = connection.begin()
+            contacts, policy_batch, invoice_batch, payment_batch, ledger_batch = [], [], [], [], []
+            allocation_batch = []
+            for policy_id in range(first, min(first + chunk_size, policies + 1)):
+                agent_id = rng.choice(agents)['id']
+                contacts.append({'id': next_contact, 'name': u'Insured %d' % policy_id, 'role': u'Named Insured'})
+                policy = {'id': policy_id,
+                          'policy_number': u'Policy %07d' % policy_id,
+                          'effective_date': FIRST_EFFECTIVE_DATE + timedelta(days=rng.randint(0, EFFECTIVE_DAYS - 1)),
+                          'status': u'Active',
+                          'date_changed': None,
+                          'reason': None,
+                          'billing_schedule': _weighted_choice(rng, SCHEDULE_WEIGHTS),
+                          'annual_premium': rng.randint(25, 400) * 12,
+                          'named_insured': next_contact,
+                          'agent': agent_id}
+                next_contact += 1
+                policy_batch.append(policy)
+
+                invoices = invoice_rows(policy_id, policy['effective_date'], policy['billing_schedule'],
+                                        policy['annual_premium'])
+                for invoice in invoices:
+                    invoice['id'] = next_invoice
+                    next_invoice += 1
+                payments = _payments_for(rng, policy, invoices, agent_id)
+                for payment in payments:
+                    payment['id'] = next_payment
+                    next_payment += 1
+
+                invoice_batch.extend(invoices)
+                payment_batch.extend(payments)
+                ledger_batch.extend(_ledger_rows(policy_id, invoices, payments))
+                allocation_batch.extend(_allocation_rows(policy_id, invoices, payments))
+
+            connection.execute(Contact.__table__.insert(), contacts)
+            connection.execute(Policy.__table__.insert(), policy_batch)
+            connection.execute(Invoice.__table__.insert(), invoice_batch)
+            if payment_batch:
+                connection.execute(Payment.__table__.insert(), payment_batch)
+            connection.execute(LedgerEntry.__table__.insert(), ledger_batch)
+            if allocation_batch:
+                connection.execute(PaymentAllocation.__table__.insert(), allocation_batch)
+            transaction.commit()
+
+            summary['contacts'] += len(contacts)
+            summary['invoices'] += len(invoice_batch)
+            summary['payments'] += len(payment_batch)
+            if progress is not None:
+                progress(policy_batch[-1]['id'], policies)
+    finally:
+        connection.close()
+        engine.dispose()
+
+    summary['seconds'] = time.time() - started
+    logger.info("Generated %d policies, %d invoices and %d payments in %s in %.1fs",
+                policies, summary['invoices'], summary['payments'], path, summary['seconds'])
+    return summary
@@ -1,12 +1,63 @@
 #!/user/bin/env python2.7
 
+import csv
+import gzip
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from Queue import Queue
+from StringIO import StringIO
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
 from mock import MagicMock
-from accounting import db
-from models import Contact, Invoice, Payment, Policy
-from utils import PolicyAccounting
+from accounting import configure, create_app, db, load_settings, settings
+from models import (ArchivedInvoice, ArchivedPayment, BalanceCheckpoint, Contact, Invoice, LedgerEntry, Payment,
+                    PaymentAllocation, Policy)
+from ingest import ingest_file
+from ledger import rebuild_ledger, verify_ledger
+from migrations import MIGRATIONS, upgrade_db
+import config
+import logs
+import metrics
+from aging import aging_report, check_aging, report_csv
+from allocation import reallocate, verify_allocations
+from archive import archive_rows, closed_policies
+from batch import run_batch, shard_ranges
+from benchmarks import percentile
+from cache import ResponseCache, data_version, response_cache
+from checkpoints import refresh_checkpoints, totals_as_of
+from columnar import ColumnarBook
+from export import export_rows, export_table, watermark
+from forecast import cash_flow_forecast, check_forecast, forecast_csv
+from onboarding import add_months, onboard_policies
+from portfolio import find_policies_to_cancel, policy_summaries, run_cancellation_sweep
+from reschedule import reschedule_policies
+from snapshot import refresh_snapshot, snapshot_age
+from synthetic import generate_portfolio
+from utils import PolicyAccounting, PolicyReader
+from writequeue import WriteQueue
+
+# the suite runs with the test profile of accounting/config.py, on a fresh
+# copy of the database brought up to the current schema
+configure('test')
+test_database = make_url(settings['SQLALCHEMY_DATABASE_URI']).database
+for suffix in ('-wal', '-shm'):
+    if os.path.exists(test_database + suffix):
+        os.remove(test_database + suffix)
+shutil.copyfile(make_url(config.SQLALCHEMY_DATABASE_URI).database, test_database)
+upgrade_db()
+app = create_app()
 
 """
 #######################################################
@@ -123,6 +174,16 @@ class TestReturnAccountBalance(unittest.TestCase):
         self.assertEquals(pa.return_account_balance(date_cursor=invoices[1].bill_date), 0)
 
 
+    def test_quarterly_ignores_deleted_invoices(self):
+        self.policy.billing_schedule = "Quarterly"
+        pa = PolicyAccounting(self.policy.id)
+        invoices = Invoice.query.filter_by(policy_id=self.policy.id) \
+            .order_by(Invoice.bill_date).all()
+        invoices[1].deleted = True
+        db.session.commit()
+        self.assertEquals(pa.return_account_balance(date_cursor=invoices[3].bill_date), 900)
+
+
 class TestCancellationPolicies(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -195,6 +256,26 @@ class TestCancellationPolicies(unittest.TestCase):
         self.assertIsNotNone(result)
         self.assertFalse(result)
 
+    def test_Given_unpaid_policy_When_past_cancel_date_Then_result_names_triggering_invoice(self):
+        evaluation_date = self.invoices[3].cancel_date
+
+        result = self.pa.evaluate_cancel(evaluation_date)
+
+        self.assertTrue(result.should_cancel)
+        self.assertEqual(result.invoice.id, self.invoices[1].id)
+        self.assertEqual(result.cancel_date, self.invoices[1].cancel_date)
+        self.assertEqual(result.outstanding, 400)
+
+    def test_Given_overpaid_policy_When_past_cancel_date_Then_not_due_to_cancel(self):
+        self.payments.append(self.pa.make_payment(contact_id=self.policy.named_insured,
+                                                  date_cursor=self.invoices[0].bill_date,
+                                                  amount=1300))
+
+        result = self.pa.evaluate_cancel(self.invoices[3].cancel_date)
+
+        self.assertFalse(result)
+        self.assertIsNone(result.invoice)
+
     def test_Given_policy_to_cancel_When_policy_canceled_Then_policy_data_updated(self):
         pa = PolicyAccounting(self.policy.id)
 
@@ -283,3 +364,1946 @@ class TestChangingPolicy(unittest.TestCase):
         self.assertEqual(self.test_insured.id, result.named_insured)
         self.assertEqual(self.test_agent.id, result.agent)
         self.assertEqual('Monthly', self.policy.billing_schedule)
+
+
+class TestCancellationSweep(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policies = []
+        cls.payments = []
+        for number, schedule in enumerate(['Annual', 'Two-Pay', 'Quarterly', 'Monthly']):
+            policy = Policy('Sweep Policy %d' % number, date(2015, 1, 1), 1200)
+            policy.billing_schedule = schedule
+            policy.named_insured = cls.test_insured.id
+            policy.agent = cls.test_agent.id
+            db.session.add(policy)
+            cls.policies.append(policy)
+        db.session.commit()
+
+        # Annual paid in full, Two-Pay paid late, Quarterly and Monthly only pay their first invoice
+        for policy, amount, paid_on in [(cls.policies[0], 1200, date(2015, 1, 15)),
+                                        (cls.policies[1], 600, date(2015, 2, 20)),
+                                        (cls.policies[2], 300, date(2015, 1, 1)),
+                                        (cls.policies[3], 100, date(2015, 1, 1))]:
+            pa = PolicyAccounting(policy.id)
+            cls.payments.append(pa.make_payment(contact_id=cls.test_insured.id,
+                                                date_cursor=paid_on, amount=amount))
+
+    @classmethod
+    def tearDownClass(cls):
+        for payment in cls.payments:
+            db.session.delete(payment)
+        for policy in cls.policies:
+            for invoice in policy.invoices:
+                db.session.delete(invoice)
+            db.session.delete(policy)
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def policy_ids(self):
+        return [policy.id for policy in self.policies]
+
+    def test_sweep_matches_evaluate_cancel(self):
+        for evaluation_date in [date(2015, 1, 31), date(2015, 2, 14), date(2015, 2, 15),
+                                date(2015, 3, 20), date(2015, 6, 1), date(2016, 1, 31)]:
+            found = find_policies_to_cancel(evaluation_date, policy_ids=self.policy_ids())
+            for policy in self.policies:
+                expected = bool(PolicyAccounting(policy.id).evaluate_cancel(evaluation_date))
+                self.assertEqual(expected, policy.id in found,
+                                 "%s on %s" % (policy.billing_schedule, evaluation_date))
+
+    def test_sweep_reports_earliest_cancel_date_and_outstanding(self):
+        found = find_policies_to_cancel(date(2016, 1, 31), policy_ids=self.policy_ids())
+
+        self.assertEqual(found[self.policies[3].id], (date(2015, 2, 15), 100))
+        self.assertEqual(found[self.policies[2].id], (date(2015, 5, 15), 300))
+        self.assertNotIn(self.policies[0].id, found)
+
+    def test_sweep_apply_cancels_in_bulk(self):
+        summary = run_cancellation_sweep(date(2016, 1, 31), apply=True, reason=u'Non-payment',
+                                         policy_ids=self.policy_ids())
+        try:
+            self.assertEqual(summary['to_cancel'], 3)
+            self.assertEqual(summary['canceled'], 3)
+            for policy in self.policies:
+                db.session.refresh(policy)
+            self.assertEqual([p.status for p in self.policies], ['Active', 'Canceled', 'Canceled', 'Canceled'])
+            self.assertEqual(self.policies[3].reason, u'Non-payment')
+            # canceled policies are no longer picked up by the next sweep
+            self.assertEqual(run_cancellation_sweep(date(2016, 1, 31), policy_ids=self.policy_ids())['to_cancel'], 0)
+        finally:
+            for policy in self.policies:
+                policy.status = u'Active'
+                policy.reason = None
+                policy.date_changed = None
+            db.session.commit()
+
+
+class TestLedger(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        cls.policy.billing_schedule = "Quarterly"
+        db.session.add(cls.policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.delete(cls.policy)
+        db.session.commit()
+
+    def setUp(self):
+        self.payments = []
+        self.policy.billing_schedule = "Quarterly"
+        self.pa = PolicyAccounting(self.policy.id)
+
+    def tearDown(self):
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        for payment in self.payments:
+            db.session.delete(payment)
+        db.session.commit()
+        self.assertEqual(LedgerEntry.query.filter_by(policy_id=self.policy.id).count(), 0)
+
+    def test_back_dated_payment_shifts_later_balances(self):
+        self.assertEqual(self.pa.return_account_balance(date(2015, 12, 31)), 1200)
+        self.payments.append(self.pa.make_payment(contact_id=self.policy.named_insured,
+                                                  date_cursor=date(2015, 12, 1), amount=600))
+        self.payments.append(self.pa.make_payment(contact_id=self.policy.named_insured,
+                                                  date_cursor=date(2015, 2, 1), amount=300))
+
+        self.assertEqual(self.pa.return_account_balance(date(2015, 1, 31)), 300)
+        self.assertEqual(self.pa.return_account_balance(date(2015, 2, 1)), 0)
+        self.assertEqual(self.pa.return_account_balance(date(2015, 11, 30)), 900)
+        self.assertEqual(self.pa.return_account_balance(date(2015, 12, 31)), 300)
+        self.assertEqual(verify_ledger([self.policy.id]), [])
+
+    def test_change_policy_voids_replaced_invoices(self):
+        self.payments.append(self.pa.make_payment(contact_id=self.policy.named_insured,
+                                                  date_cursor=date(2015, 1, 1), amount=300))
+        self.pa.change_policy(schedule='Monthly', date_cursor=date(2015, 3, 1))
+
+        voids = LedgerEntry.query.filter_by(policy_id=self.policy.id, event_type=u'Void').count()
+        self.assertEqual(voids, 3)
+        self.assertEqual(self.pa.return_account_balance(date(2015, 12, 31)), 900)
+        self.assertEqual(verify_ledger([self.policy.id]), [])
+
+    def test_verify_reports_and_rebuild_repairs_drift(self):
+        entry = LedgerEntry.query.filter_by(policy_id=self.policy.id) \
+            .order_by(LedgerEntry.event_date.desc()).first()
+        entry.balance += 1
+        db.session.commit()
+
+        self.assertEqual(len(verify_ledger([self.policy.id])), 1)
+        rebuild_ledger([self.policy.id])
+        self.assertEqual(verify_ledger([self.policy.id]), [])
+
+
+class TestPaymentIngestion(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policies = []
+        for number in range(2):
+            policy = Policy('Ingest Policy %d' % number, date(2015, 1, 1), 1200)
+            policy.billing_schedule = 'Quarterly'
+            policy.named_insured = cls.test_insured.id
+            policy.agent = cls.test_agent.id
+            db.session.add(policy)
+            cls.policies.append(policy)
+        db.session.commit()
+        for policy in cls.policies:
+            PolicyAccounting(policy.id)
+
+    @classmethod
+    def tearDownClass(cls):
+        for policy in cls.policies:
+            for invoice in policy.invoices:
+                db.session.delete(invoice)
+            db.session.delete(policy)
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.csv')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+        for payment in Payment.query.filter(Payment.policy_id.in_([p.id for p in self.policies])).all():
+            db.session.delete(payment)
+        db.session.commit()
+
+    def write_csv(self, rows):
+        with open(self.path, 'w') as stream:
+            stream.write("policy_id,contact_id,amount_paid,transaction_date\n")
+            for row in rows:
+                stream.write(",".join(str(value) for value in row) + "\n")
+
+    def test_ingest_inserts_good_rows_and_reports_rejects(self):
+        first, second = [policy.id for policy in self.policies]
+        insured = self.test_insured.id
+        self.write_csv([(first, insured, 1200, '2016-01-01'),
+                        (999999, insured, 100, '2015-02-01'),
+                        (second, insured, 300, '2015-02-01'),
+                        (second, insured, 300, '02/01/2015'),
+                        (second, insured, -5, '2015-02-01'),
+                        (second, '', 300, '2015-02-01')])
+        rejected = []
+
+        summary = ingest_file(self.path, chunk_size=2,
+                              on_reject=lambda line, record, reason: rejected.append(line))
+
+        self.assertEqual(summary['read'], 6)
+        self.assertEqual(summary['inserted'], 2)
+        self.assertEqual(summary['rejected'], 4)
+        self.assertEqual(rejected, [3, 5, 6, 7])
+        self.assertEqual(PolicyAccounting(first).return_account_balance(date(2016, 1, 1)), 0)
+        self.assertEqual(PolicyAccounting(second).return_account_balance(date(2015, 3, 1)), 0)
+        self.assertEqual(PolicyAccounting(second).return_account_balance(date(2015, 12, 31)), 900)
+        self.assertEqual(verify_ledger([first, second]), [])
+
+    def test_concurrent_ingests_hand_out_distinct_ids(self):
+        insured = self.test_insured.id
+        policy_ids = [policy.id for policy in self.policies]
+        self.write_csv([(policy_id, insured, 10, '2015-02-01') for policy_id in policy_ids] * 10)
+        handle, other_path = tempfile.mkstemp(suffix='.csv')
+        os.close(handle)
+        shutil.copyfile(self.path, other_path)
+        errors = []
+
+        def ingest(path):
+            try:
+                ingest_file(path, chunk_size=1)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                db.session.remove()
+
+        threads = [threading.Thread(target=ingest, args=(path,)) for path in (self.path, other_path)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(30)
+            self.assertEqual(errors, [])
+            self.assertEqual(Payment.query.filter(Payment.policy_id.in_(policy_ids)).count(), 40)
+            self.assertEqual(verify_ledger(policy_ids), [])
+        finally:
+            os.remove(other_path)
+
+
+class TestBalanceApi(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policies = []
+        for number, schedule in enumerate(['Annual', 'Quarterly', 'Monthly']):
+            policy = Policy('Api Policy %d' % number, date(2015, 1, 1), 1200)
+            policy.billing_schedule = schedule
+            policy.named_insured = cls.test_insured.id
+            policy.agent = cls.test_agent.id
+            db.session.add(policy)
+            cls.policies.append(policy)
+        db.session.commit()
+
+        for policy in cls.policies:
+            pa = PolicyAccounting(policy.id)
+            pa.make_payment(contact_id=cls.test_insured.id, date_cursor=date(2015, 1, 1), amount=300)
+
+        # requests through the test client end the session, so only ids are kept
+        cls.policy_ids = [policy.id for policy in cls.policies]
+        cls.contact_ids = [cls.test_agent.id, cls.test_insured.id]
+
+    @classmethod
+    def tearDownClass(cls):
+        for payment in Payment.query.filter(Payment.policy_id.in_(cls.policy_ids)).all():
+            db.session.delete(payment)
+        for invoice in Invoice.query.filter(Invoice.policy_id.in_(cls.policy_ids)).all():
+            db.session.delete(invoice)
+        for policy in Policy.query.filter(Policy.id.in_(cls.policy_ids)).all():
+            db.session.delete(policy)
+        for contact in Contact.query.filter(Contact.id.in_(cls.contact_ids)).all():
+            db.session.delete(contact)
+        db.session.commit()
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def post(self, payload):
+        response = self.client.post('/api/balances', content_type='application/json', data=json.dumps(payload))
+        return response.status_code, json.loads(response.data)
+
+    def test_batch_matches_policy_accounting(self):
+        evaluation_date = date(2015, 5, 20)
+        ids = self.policy_ids
+
+        status, body = self.post({'policies': ids + [999999], 'date': '2015-05-20'})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body['missing'], [999999])
+        self.assertEqual([summary['policy_id'] for summary in body['policies']], ids)
+        for summary in body['policies']:
+            pa = PolicyAccounting(summary['policy_id'])
+            self.assertEqual(summary['balance'], pa.return_account_balance(evaluation_date))
+            self.assertEqual(summary['cancellation_pending'],
+                             bool(pa.evaluate_cancellation_pending_due_to_non_pay(evaluation_date)))
+            self.assertEqual([invoice['bill_date'] for invoice in summary['invoices']],
+                             [invoice.bill_date.strftime('%Y-%m-%d') for invoice in pa.get_invoices(evaluation_date)])
+
+    def test_bad_requests_are_rejected(self):
+        self.assertEqual(self.post({'policies': [], 'date': '2015-05-20'})[0], 400)
+        self.assertEqual(self.post({'policies': [1], 'date': '05/20/2015'})[0], 400)
+        self.assertEqual(self.post({'policies': ['one'], 'date': '2015-05-20'})[0], 400)
+        too_many = range(1, app.config['BALANCE_API_MAX_POLICIES'] + 2)
+        self.assertEqual(self.post({'policies': too_many, 'date': '2015-05-20'})[0], 413)
+
+
+class TestReadOnlyAccounting(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        db.session.add(cls.test_agent)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        cls.policy.billing_schedule = "Quarterly"
+        cls.policy.agent = cls.test_agent.id
+        db.session.add(cls.policy)
+        db.session.commit()
+        cls.policy_id = cls.policy.id
+        cls.agent_id = cls.test_agent.id
+
+    @classmethod
+    def tearDownClass(cls):
+        for invoice in Invoice.query.filter_by(policy_id=cls.policy_id).all():
+            db.session.delete(invoice)
+        db.session.delete(Policy.query.get(cls.policy_id))
+        db.session.delete(Contact.query.get(cls.agent_id))
+        db.session.commit()
+
+    def invoice_count(self):
+        return Invoice.query.filter_by(policy_id=self.policy_id).count()
+
+    def test_reader_never_generates_invoices(self):
+        reader = PolicyReader(self.policy_id)
+
+        self.assertEqual(reader.return_account_balance(date(2015, 12, 31)), 0)
+        self.assertEqual(reader.get_invoices(date(2015, 12, 31)), [])
+        self.assertFalse(reader.evaluate_cancel(date(2015, 12, 31)))
+        self.assertEqual(self.invoice_count(), 0)
+
+    def test_get_result_view_does_not_write(self):
+        response = app.test_client().get('/%s/2015-12-31' % self.policy_id)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.invoice_count(), 0)
+
+    def test_invoice_generation_is_an_explicit_write_step(self):
+        pa = PolicyAccounting(self.policy_id, generate_invoices=False)
+        self.assertEqual(self.invoice_count(), 0)
+
+        self.assertTrue(pa.ensure_invoices())
+        self.assertFalse(pa.ensure_invoices())
+        self.assertEqual(self.invoice_count(), 4)
+        for invoice in Invoice.query.filter_by(policy_id=self.policy_id).all():
+            db.session.delete(invoice)
+        db.session.commit()
+
+
+class TestBulkOnboarding(unittest.TestCase):
+    effective_dates = [date(2015, 1, 1), date(2015, 1, 31), date(2015, 8, 31),
+                       date(2015, 12, 31), date(2016, 2, 29), date(2015, 5, 30)]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        db.session.add(cls.test_agent)
+        db.session.commit()
+
+        # every effective date and schedule twice: once for make_invoices, once for the bulk path
+        cls.pairs = []
+        for effective_date in cls.effective_dates:
+            for schedule in ['Annual', 'Two-Pay', 'Quarterly', 'Monthly']:
+                pair = []
+                for copy in range(2):
+                    policy = Policy('Onboard %s %s' % (effective_date, schedule), effective_date, 1000)
+                    policy.billing_schedule = schedule
+                    policy.agent = cls.test_agent.id
+                    db.session.add(policy)
+                    pair.append(policy)
+                cls.pairs.append(pair)
+        db.session.commit()
+        cls.pairs = [(one.id, other.id) for one, other in cls.pairs]
+        cls.agent_id = cls.test_agent.id
+
+    @classmethod
+    def tearDownClass(cls):
+        policy_ids = [policy_id for pair in cls.pairs for policy_id in pair]
+        for invoice in Invoice.query.filter(Invoice.policy_id.in_(policy_ids)).all():
+            db.session.delete(invoice)
+        for policy in Policy.query.filter(Policy.id.in_(policy_ids)).all():
+            db.session.delete(policy)
+        db.session.delete(Contact.query.get(cls.agent_id))
+        db.session.commit()
+
+    def schedule(self, policy_id):
+        return [(invoice.bill_date, invoice.due_date, invoice.cancel_date, invoice.amount_due, invoice.deleted)
+                for invoice in Invoice.query.filter_by(policy_id=policy_id).order_by(Invoice.bill_date).all()]
+
+    def test_add_months_matches_relativedelta(self):
+        for effective_date in self.effective_dates:
+            for months in range(0, 25):
+                self.assertEqual(add_months(effective_date, months), effective_date + relativedelta(months=months))
+
+    def test_bulk_invoices_match_make_invoices(self):
+        for per_policy, _ in self.pairs:
+            PolicyAccounting(per_policy)
+        bulk = [bulk_id for _, bulk_id in self.pairs]
+
+        summary = onboard_policies(bulk, chunk_size=7)
+
+        self.assertEqual(summary['policies'], len(bulk))
+        for per_policy, bulk_id in self.pairs:
+            self.assertEqual(self.schedule(per_policy), self.schedule(bulk_id))
+        self.assertEqual(verify_ledger(bulk), [])
+        # policies that already have invoices are left alone
+        self.assertEqual(onboard_policies(bulk)['invoices'], 0)
+
+    def test_concurrent_runs_hand_out_distinct_ids(self):
+        policies = []
+        for number in range(20):
+            policy = Policy('Onboard Concurrently %d' % number, date(2015, 1, 1), 1200)
+            policy.billing_schedule = 'Monthly'
+            policy.agent = self.agent_id
+            policies.append(policy)
+        db.session.add_all(policies)
+        db.session.commit()
+        policy_ids = [policy.id for policy in policies]
+        errors = []
+
+        def onboard(ids):
+            try:
+                onboard_policies(ids, chunk_size=1)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                db.session.remove()
+
+        threads = [threading.Thread(target=onboard, args=(policy_ids[half::2],)) for half in (0, 1)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(30)
+            self.assertEqual(errors, [])
+            self.assertEqual(Invoice.query.filter(Invoice.policy_id.in_(policy_ids)).count(), 240)
+            self.assertEqual(verify_ledger(policy_ids), [])
+        finally:
+            for invoice in Invoice.query.filter(Invoice.policy_id.in_(policy_ids)).all():
+                db.session.delete(invoice)
+            for policy in Policy.query.filter(Policy.id.in_(policy_ids)).all():
+                db.session.delete(policy)
+            db.session.commit()
+
+
+class TestSyntheticPortfolio(unittest.TestCase):
+    def setUp(self):
+        self.paths = []
+
+    def tearDown(self):
+        for path in self.paths:
+            os.remove(path)
+
+    def generate(self, seed):
+        handle, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        self.paths.append(path)
+        generate_portfolio(path, 120, seed=seed, chunk_size=50, overwrite=True)
+        engine = create_engine('sqlite:///' + path)
+        try:
+            return dict((table, engine.execute("SELECT * FROM %s ORDER BY id" % table).fetchall())
+                        for table in ('contacts', 'policies', 'invoices', 'payments', 'ledger'))
+        finally:
+            engine.dispose()
+
+    def test_same_seed_gives_the_same_book(self):
+        first = self.generate(seed=7)
+
+        self.assertEqual(first, self.generate(seed=7))
+        self.assertNotEqual(first['payments'], self.generate(seed=8)['payments'])
+        self.assertEqual(len(first['policies']), 120)
+        self.assertEqual(set(policy.billing_schedule for policy in first['policies']),
+                         set(['Annual', 'Two-Pay', 'Quarterly', 'Monthly']))
+
+    def test_ledger_closes_on_billed_minus_paid(self):
+        book = self.generate(seed=3)
+        expected = {}
+        for invoice in book['invoices']:
+            expected[invoice.policy_id] = expected.get(invoice.policy_id, 0) + invoice.amount_due
+        for payment in book['payments']:
+            expected[payment.policy_id] -= payment.amount_paid
+        closing = {}
+        for entry in book['ledger']:
+            closing[entry.policy_id] = entry.balance
+        self.assertEqual(closing, expected)
+
+    def test_allocations_match_the_payments(self):
+        self.generate(seed=3)
+        engine = create_engine('sqlite:///' + self.paths[-1])
+        try:
+            self.assertEqual(verify_allocations(date_cursor=date(2016, 6, 30), bind=engine.connect()), [])
+        finally:
+            engine.dispose()
+
+    def test_percentile_is_nearest_rank(self):
+        ordered = range(1, 101)
+        self.assertEqual(percentile(ordered, 0.5), 50)
+        self.assertEqual(percentile(ordered, 0.99), 99)
+        self.assertEqual(percentile([4.0], 0.9), 4.0)
+        self.assertIsNone(percentile([], 0.5))
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.policy_id = Policy.query.first().id
+        response_cache.clear()
+        metrics.reset()
+        metrics.enable(app, db.engine, slow_seconds=0)
+        # the engine hooks only see connections checked out after they are added
+        db.session.remove()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        metrics.disable()
+        metrics.reset()
+
+    def test_requests_and_methods_are_recorded(self):
+        response = self.client.get('/%s/2015-06-30' % self.policy_id)
+        self.assertEqual(response.status_code, 200)
+
+        exposition = self.client.get('/metrics').data
+        self.assertIn('accounting_request_seconds_count{endpoint="get_result"} 1', exposition)
+        self.assertIn('accounting_slow_requests_total{endpoint="get_result"} 1', exposition)
+        self.assertIn('accounting_method_seconds_count{method="return_account_balance"} 1', exposition)
+        self.assertIn('accounting_method_seconds_count{method="get_invoices"} 1', exposition)
+        statements = metrics.REQUEST_STATEMENTS.series['get_result']
+        self.assertEqual(statements[2], 1)
+        self.assertTrue(statements[1] > 0)
+        self.assertTrue(metrics.REQUEST_OBJECTS.series['get_result'][1] > 0)
+        self.assertTrue(metrics.REQUEST_ROWS.series['get_result'][1] > 0)
+        self.assertTrue(metrics.METHOD_ROWS.series['get_invoices'][1] > 0)
+
+    def test_rows_read_without_the_orm_are_counted(self):
+        response = self.client.post('/api/balances', content_type='application/json',
+                                    data=json.dumps({'policies': [self.policy_id], 'date': '2015-06-30'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(metrics.REQUEST_OBJECTS.series['get_balances'][1], 0)
+        self.assertTrue(metrics.REQUEST_ROWS.series['get_balances'][1] > 0)
+
+        # the response cache's version lookup runs on a DB-API connection
+        scope = metrics.Scope()
+        metrics._scopes().append(scope)
+        try:
+            data_version(self.policy_id)
+        finally:
+            metrics._scopes().remove(scope)
+        self.assertEqual((scope.statements, scope.rows), (1, 1))
+
+    def test_nothing_is_recorded_when_disabled(self):
+        metrics.disable()
+        self.client.get('/%s/2015-06-30' % self.policy_id)
+        PolicyReader(self.policy_id).return_account_balance(date(2015, 6, 30))
+
+        self.assertEqual(metrics.REQUEST_SECONDS.series, {})
+        self.assertEqual(metrics.METHOD_SECONDS.series, {})
+
+    def test_every_app_and_engine_is_recorded(self):
+        metrics.disable()
+        engine = db.engine
+        second = create_app('test', METRICS_ENABLED=True, SLOW_REQUEST_SECONDS=0)
+        try:
+            self.assertIsNot(db.engine, engine)
+            second.test_client().get('/%s/2015-06-30' % self.policy_id)
+            self.assertEqual(metrics.REQUEST_SECONDS.series['get_result'][2], 1)
+            self.assertTrue(metrics.REQUEST_STATEMENTS.series['get_result'][1] > 0)
+        finally:
+            configure('test')
+            db.bind_app(app)
+
+
+class TestResponseCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Cached Policy', date(2015, 1, 1), 1200)
+        cls.policy.billing_schedule = "Quarterly"
+        cls.policy.named_insured = cls.test_insured.id
+        db.session.add(cls.policy)
+        db.session.commit()
+        PolicyAccounting(cls.policy.id)
+        cls.policy_id = cls.policy.id
+        cls.insured_id = cls.test_insured.id
+
+    @classmethod
+    def tearDownClass(cls):
+        for payment in Payment.query.filter_by(policy_id=cls.policy_id).all():
+            db.session.delete(payment)
+        for invoice in Invoice.query.filter_by(policy_id=cls.policy_id).all():
+            db.session.delete(invoice)
+        db.session.delete(Policy.query.get(cls.policy_id))
+        db.session.delete(Contact.query.get(cls.insured_id))
+        db.session.commit()
+
+    def setUp(self):
+        response_cache.clear()
+        response_cache.reset_counts()
+        self.client = app.test_client()
+        self.url = '/%s/2015-06-30' % self.policy_id
+
+    def test_lru_eviction_and_expiry(self):
+        now = [0]
+        cache = ResponseCache(max_entries=2, ttl=10, clock=lambda: now[0])
+        for policy_id in (1, 2, 3):
+            cache.put(policy_id, (policy_id, 'day'), {'balance': policy_id}, cache.version(policy_id))
+
+        self.assertIsNone(cache.get((1, 'day')))
+        self.assertEqual(cache.get((3, 'day')).value, {'balance': 3})
+        now[0] = 10
+        self.assertIsNone(cache.get((3, 'day')))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2, 'evictions': 1, 'expirations': 1,
+                                         'invalidations': 0, 'entries': 1})
+
+    def test_values_computed_across_an_invalidation_are_not_kept(self):
+        cache = ResponseCache()
+        version = cache.version(1)
+        cache.invalidate([1])
+        cache.put(1, (1, 'day'), {'balance': 0}, version)
+
+        self.assertIsNone(cache.get((1, 'day')))
+
+    def test_repeat_lookups_are_served_from_the_cache(self):
+        first = self.client.get(self.url)
+        second = self.client.get(self.url)
+
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(response_cache.stats()['hits'], 1)
+        self.assertEqual(response_cache.stats()['misses'], 1)
+
+    def test_conditional_get_answers_not_modified(self):
+        etag = self.client.get(self.url).headers['ETag']
+
+        response = self.client.get(self.url, headers={'If-None-Match': etag})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+        self.assertEqual(response.headers['ETag'], etag)
+
+    def test_writes_invalidate_the_policy(self):
+        etag = self.client.get(self.url).headers['ETag']
+        pa = PolicyAccounting(self.policy_id)
+        pa.make_payment(contact_id=self.insured_id, date_cursor=date(2015, 2, 1), amount=300)
+
+        response = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Amount Due: </strong> 300', response.data)
+
+        etag = response.headers['ETag']
+        invoice = Invoice.query.filter_by(policy_id=self.policy_id, bill_date=date(2015, 4, 1)).one()
+        invoice.deleted = True
+        db.session.commit()
+        response = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Amount Due: </strong> 0', response.data)
+        self.assertTrue(response_cache.stats()['invalidations'] >= 2)
+
+    def test_writes_from_other_processes_change_the_key(self):
+        first = self.client.get(self.url)
+        # another worker, with nothing cached, knows the ETag all the same
+        response_cache.clear()
+        response_cache.reset_counts()
+        response = self.client.get(self.url, headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response_cache.stats()['misses'], 0)
+
+        # no ORM events: nothing is invalidated in this process
+        invoices = Invoice.__table__
+        january = (invoices.c.policy_id == self.policy_id) & (invoices.c.bill_date == date(2015, 1, 1))
+        other = create_engine(db.engine.url)
+        try:
+            other.execute(invoices.update().where(january).values(amount_due=invoices.c.amount_due + 1))
+            response = self.client.get(self.url, headers={'If-None-Match': first.headers['ETag']})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('301', response.data)
+            self.assertNotEqual(response.headers['ETag'], first.headers['ETag'])
+        finally:
+            other.execute(invoices.update().where(january).values(amount_due=invoices.c.amount_due - 1))
+            other.dispose()
+
+
+class TestLogging(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.log')
+        os.close(handle)
+
+    def tearDown(self):
+        logs.configure_logging(app.config)
+        os.remove(self.path)
+
+    def test_levels_are_set_per_module(self):
+        logs.configure_logging({'LOG_FILE': self.path, 'LOG_LEVEL': 'DEBUG',
+                                'LOG_LEVELS': {'accounting.views': 'WARNING'}})
+        logging.getLogger('accounting.utils').debug("utils %s", 'debug')
+        logging.getLogger('accounting.views').debug("views debug")
+        logging.getLogger('accounting.views').warning("views warning")
+        logs.flush()
+
+        with open(self.path) as log_file:
+            lines = log_file.read().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith("accounting.utils - DEBUG - utils debug"))
+        self.assertTrue(lines[1].endswith("accounting.views - WARNING - views warning"))
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        handler = logs.QueueHandler(Queue(1))
+        logger = logging.getLogger('accounting.tests.queue')
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            logger.error("first")
+            logger.error("second")
+        finally:
+            logger.removeHandler(handler)
+
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual(handler.queue.get().msg, "first")
+
+
+class TestBalanceCheckpoints(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        cls.insured_id = cls.test_insured.id
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(Contact.query.get(cls.insured_id))
+        db.session.commit()
+
+    def setUp(self):
+        self.policy = Policy('Checkpoint Policy', date(2014, 1, 1), 1200)
+        self.policy.billing_schedule = "Monthly"
+        self.policy.named_insured = self.insured_id
+        db.session.add(self.policy)
+        db.session.commit()
+        self.pa = PolicyAccounting(self.policy.id)
+        for month in range(6):
+            self.pa.make_payment(contact_id=self.insured_id, date_cursor=date(2014, 1 + month, 20), amount=100)
+
+    def tearDown(self):
+        for payment in Payment.query.filter_by(policy_id=self.policy.id).all():
+            db.session.delete(payment)
+        for invoice in Invoice.query.filter_by(policy_id=self.policy.id).all():
+            db.session.delete(invoice)
+        db.session.delete(self.policy)
+        db.session.commit()
+
+    def checkpoint_dates(self):
+        return [checkpoint.period_end for checkpoint in
+                BalanceCheckpoint.query.filter_by(policy_id=self.policy.id).order_by(BalanceCheckpoint.period_end)]
+
+    def brute_force(self, date_cursor):
+        billed = sum(invoice.amount_due for invoice in Invoice.query.filter_by(policy_id=self.policy.id)
+                     if not invoice.deleted and invoice.bill_date <= date_cursor)
+        paid = sum(payment.amount_paid for payment in Payment.query.filter_by(policy_id=self.policy.id)
+                   if payment.transaction_date <= date_cursor)
+        return billed, paid
+
+    def assert_totals_match(self):
+        for date_cursor in (date(2013, 12, 31), date(2014, 1, 31), date(2014, 3, 10), date(2014, 6, 30),
+                            date(2014, 9, 1), date(2015, 2, 1)):
+            self.assertEqual(totals_as_of(self.policy.id, date_cursor), self.brute_force(date_cursor))
+            billed, paid = self.pa.return_account_totals(date_cursor)
+            self.assertEqual(billed - paid, self.pa.return_account_balance(date_cursor))
+
+    def test_refresh_is_incremental(self):
+        self.assertEqual(refresh_checkpoints([self.policy.id], through=date(2014, 6, 15)), 5)
+        self.assertEqual(self.checkpoint_dates()[-1], date(2014, 5, 31))
+        self.assertEqual(refresh_checkpoints([self.policy.id], through=date(2014, 5, 31)), 0)
+        self.assertEqual(refresh_checkpoints([self.policy.id], through=date(2014, 12, 31)), 7)
+        self.assert_totals_match()
+
+    def test_back_dated_writes_invalidate_later_checkpoints(self):
+        refresh_checkpoints([self.policy.id], through=date(2014, 12, 31))
+
+        self.pa.make_payment(contact_id=self.insured_id, date_cursor=date(2014, 3, 5), amount=50)
+        self.assertEqual(self.checkpoint_dates()[-1], date(2014, 2, 28))
+        self.assert_totals_match()
+
+        self.pa.change_policy('Quarterly', date(2014, 4, 1))
+        self.assertEqual(self.checkpoint_dates()[-1], date(2014, 2, 28))
+        self.assertEqual(refresh_checkpoints([self.policy.id], through=date(2014, 12, 31)), 6)
+        # quarterly invoices from April on: nothing billed or paid in August, September or November
+        self.assertEqual(self.checkpoint_dates()[-3:], [date(2014, 6, 30), date(2014, 7, 31), date(2014, 10, 31)])
+        self.assert_totals_match()
+
+
+class TestDatabaseSettings(unittest.TestCase):
+    def test_connections_are_pooled_with_the_configured_pragmas(self):
+        self.assertIsInstance(db.engine.pool, QueuePool)
+        self.assertEqual(db.engine.pool.size(), app.config['SQLALCHEMY_POOL_SIZE'])
+
+        connection = db.engine.connect()
+        try:
+            self.assertEqual(connection.execute("PRAGMA journal_mode").scalar(), 'wal')
+            self.assertEqual(connection.execute("PRAGMA busy_timeout").scalar(),
+                             app.config['SQLITE_BUSY_TIMEOUT_MS'])
+            # NORMAL
+            self.assertEqual(connection.execute("PRAGMA synchronous").scalar(), 1)
+            self.assertEqual(connection.execute("PRAGMA cache_size").scalar(), -app.config['SQLITE_CACHE_SIZE_KB'])
+        finally:
+            connection.close()
+
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        self.engine = create_engine('sqlite:///' + self.path)
+
+    def tearDown(self):
+        self.engine.dispose()
+        os.remove(self.path)
+
+    def test_migrations_run_again_over_what_they_added(self):
+        # what a migration that failed part way leaves behind, at worst all of it
+        db.Model.metadata.create_all(self.engine)
+        connection = self.engine.connect()
+        try:
+            for migration in MIGRATIONS:
+                transaction = connection.begin()
+                migration(connection)
+                transaction.commit()
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(invoices)")]
+        finally:
+            connection.close()
+
+        self.assertEqual(columns.count('amount_paid'), 1)
+        self.assertEqual(columns.count('row_version'), 1)
+
+    def test_the_app_needs_every_migration(self):
+        db.Model.metadata.create_all(self.engine)
+        self.engine.execute("PRAGMA user_version = %d" % (len(MIGRATIONS) - 1))
+        try:
+            self.assertRaises(RuntimeError, create_app, 'test', SQLALCHEMY_DATABASE_URI='sqlite:///' + self.path)
+        finally:
+            configure('test')
+
+
+class TestWriteQueue(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        cls.insured_id = cls.test_insured.id
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(Contact.query.get(cls.insured_id))
+        db.session.commit()
+
+    def setUp(self):
+        self.policy = Policy('Write Queue Policy', date(2015, 1, 1), 1200)
+        self.policy.billing_schedule = "Quarterly"
+        self.policy.named_insured = self.insured_id
+        db.session.add(self.policy)
+        db.session.commit()
+        self.policy_id = self.policy.id
+        self.queue = WriteQueue(max_batch=10, max_delay=0.05)
+
+    def tearDown(self):
+        self.queue.stop()
+        db.session.expire_all()
+        for payment in Payment.query.filter_by(policy_id=self.policy_id).all():
+            db.session.delete(payment)
+        for invoice in Invoice.query.filter_by(policy_id=self.policy_id).all():
+            db.session.delete(invoice)
+        db.session.delete(Policy.query.get(self.policy_id))
+        db.session.commit()
+
+    def test_payments_are_committed_together(self):
+        futures = [self.queue.submit_payment(self.policy_id, date_cursor=date(2015, 2, day), amount=100)
+                   for day in range(1, 6)]
+        self.queue.start()
+        payment_ids = [future.result(timeout=10) for future in futures]
+
+        self.assertEqual(self.queue.batches, 1)
+        payments = Payment.query.filter(Payment.id.in_(payment_ids)).all()
+        self.assertEqual(sorted(payment.id for payment in payments), sorted(payment_ids))
+        self.assertTrue(all(payment.contact_id == self.insured_id for payment in payments))
+        self.assertEqual(verify_ledger([self.policy_id]), [])
+        pa = PolicyAccounting(self.policy_id)
+        self.assertEqual(pa.return_account_balance(date(2015, 2, 28)), 1200 / 4 - 500)
+
+    def test_failed_write_only_fails_its_own_future(self):
+        good = self.queue.submit_payment(self.policy_id, date_cursor=date(2015, 2, 1), amount=100)
+        bad = self.queue.submit_payment(-1, date_cursor=date(2015, 2, 1), amount=100)
+        also_good = self.queue.submit_payment(self.policy_id, date_cursor=date(2015, 2, 2), amount=50)
+        self.queue.start()
+
+        self.assertRaises(ValueError, bad.result, 10)
+        self.assertEqual(Payment.query.filter(Payment.id.in_([good.result(10), also_good.result(10)])).count(), 2)
+        self.assertEqual(Payment.query.filter_by(policy_id=-1).count(), 0)
+
+    def test_cancellations(self):
+        self.queue.start()
+        self.assertEqual(self.queue.submit_cancellation(self.policy_id, u'Queued').result(10), self.policy_id)
+
+        db.session.expire_all()
+        policy = Policy.query.get(self.policy_id)
+        self.assertEqual(policy.status, u'Canceled')
+        self.assertEqual(policy.reason, u'Queued')
+
+    def test_stop_writes_out_what_was_submitted(self):
+        futures = [self.queue.submit_payment(self.policy_id, date_cursor=date(2015, 3, 1), amount=10)
+                   for _ in range(25)]
+        self.queue.start()
+        self.queue.stop()
+
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(Payment.query.filter_by(policy_id=self.policy_id).count(), 25)
+        self.assertEqual(self.queue.batches, 3)
+
+
+class TestAgingReport(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Aging Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.quarterly = Policy('Aging Quarterly', date(2015, 1, 1), 1200)
+        cls.quarterly.billing_schedule = "Quarterly"
+        cls.annual = Policy('Aging Annual', date(2015, 1, 1), 1200)
+        cls.annual.billing_schedule = "Annual"
+        for policy in (cls.quarterly, cls.annual):
+            policy.named_insured = cls.test_insured.id
+            policy.agent = cls.test_agent.id
+            db.session.add(policy)
+        db.session.commit()
+        cls.agent_id = cls.test_agent.id
+        cls.insured_id = cls.test_insured.id
+        cls.quarterly_id = cls.quarterly.id
+        cls.annual_id = cls.annual.id
+        cls.policy_ids = [cls.quarterly_id, cls.annual_id]
+
+        PolicyAccounting(cls.quarterly.id)
+        voided = Invoice(cls.quarterly.id, date(2015, 3, 1), date(2015, 3, 15), date(2015, 4, 1), 1000)
+        voided.deleted = True
+        db.session.add(voided)
+        db.session.commit()
+        PolicyAccounting(cls.quarterly.id).make_payment(date_cursor=date(2015, 2, 10), amount=100)
+        PolicyAccounting(cls.annual.id, generate_invoices=False).make_payment(date_cursor=date(2015, 2, 10), amount=500)
+
+    @classmethod
+    def tearDownClass(cls):
+        for policy_id in cls.policy_ids:
+            for payment in Payment.query.filter_by(policy_id=policy_id).all():
+                db.session.delete(payment)
+            for invoice in Invoice.query.filter_by(policy_id=policy_id).all():
+                db.session.delete(invoice)
+            db.session.delete(Policy.query.get(policy_id))
+        db.session.delete(Contact.query.get(cls.agent_id))
+        db.session.delete(Contact.query.get(cls.insured_id))
+        db.session.commit()
+
+    def aging_of(self, report, policy_id):
+        for line in report['policies']:
+            if line['policy_id'] == policy_id:
+                return dict((name, line[name]) for name in
+                            ('current', 'days_1_30', 'days_31_60', 'days_61_plus', 'credit', 'balance'))
+
+    def test_payments_settle_the_earliest_invoices_first(self):
+        # 300 billed quarterly from January 1st, each due a month later,
+        # and 100 paid on February 10th
+        expected = {
+            date(2015, 1, 15): (300, 0, 0, 0),
+            date(2015, 2, 15): (0, 200, 0, 0),
+            date(2015, 4, 15): (300, 0, 0, 200),
+            date(2015, 5, 20): (0, 300, 0, 200),
+            date(2015, 6, 15): (0, 0, 300, 200),
+        }
+        for date_cursor, buckets in expected.items():
+            aging = self.aging_of(aging_report(date_cursor, self.policy_ids), self.quarterly_id)
+            self.assertEqual((aging['current'], aging['days_1_30'], aging['days_31_60'], aging['days_61_plus']),
+                             buckets, date_cursor)
+            self.assertEqual(aging['balance'], sum(buckets))
+
+    def test_overpayments_are_a_credit(self):
+        aging = self.aging_of(aging_report(date(2015, 6, 15), self.policy_ids), self.annual_id)
+
+        self.assertEqual(aging, {'current': 0, 'days_1_30': 0, 'days_31_60': 0, 'days_61_plus': 0,
+                                 'credit': 500, 'balance': -500})
+        self.assertIsNone(self.aging_of(aging_report(date(2015, 1, 1), self.policy_ids), self.annual_id))
+
+    def test_rolled_up_by_agent(self):
+        report = aging_report(date(2015, 6, 15), self.policy_ids)
+
+        self.assertEqual(len(report['agents']), 1)
+        agent = report['agents'][0]
+        self.assertEqual((agent['agent_id'], agent['agent'], agent['policies']),
+                         (self.agent_id, 'Aging Agent', 2))
+        self.assertEqual((agent['days_31_60'], agent['days_61_plus'], agent['credit'], agent['balance']),
+                         (300, 200, 500, 0))
+        self.assertEqual(report['totals'], dict((name, agent[name]) for name in report['totals']))
+
+    def test_matches_return_account_balance(self):
+        for date_cursor in (date(2015, 2, 1), date(2015, 6, 15), date(2016, 1, 1)):
+            report = aging_report(date_cursor)
+            self.assertTrue(report['policies'])
+            self.assertEqual(check_aging(report, sample=len(report['policies'])), [])
+
+    def test_endpoint(self):
+        client = app.test_client()
+        response = client.get('/reports/aging?date=2015-06-15&by=policy')
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(response.data)
+        self.assertEqual(body['date'], '2015-06-15')
+        self.assertIn(self.quarterly_id, [line['policy_id'] for line in body['policies']])
+
+        response = client.get('/reports/aging?date=2015-06-15&format=csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'text/csv')
+        self.assertEqual(response.data, report_csv(aging_report(date(2015, 6, 15))))
+        self.assertIn('%s,Aging Agent,2,' % self.agent_id, response.data)
+
+        self.assertEqual(client.get('/reports/aging?date=June').status_code, 400)
+        self.assertEqual(client.get('/reports/aging?by=insured').status_code, 400)
+
+
+class TestForecast(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Forecast Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.quarterly = Policy('Forecast Quarterly', date(2015, 1, 1), 1200)
+        cls.quarterly.billing_schedule = "Quarterly"
+        cls.monthly = Policy('Forecast Monthly', date(2015, 1, 31), 1200)
+        cls.monthly.billing_schedule = "Monthly"
+        for policy in (cls.quarterly, cls.monthly):
+            policy.named_insured = cls.test_insured.id
+            policy.agent = cls.test_agent.id
+            db.session.add(policy)
+        db.session.commit()
+        cls.agent_id = cls.test_agent.id
+        cls.insured_id = cls.test_insured.id
+        cls.quarterly_id = cls.quarterly.id
+        cls.monthly_id = cls.monthly.id
+        cls.policy_ids = [cls.quarterly_id, cls.monthly_id]
+
+        # 300 due on the 1st of February, May, August and November, 100
+        # of it paid; the monthly policy has no invoices yet
+        PolicyAccounting(cls.quarterly.id).make_payment(date_cursor=date(2015, 2, 10), amount=100)
+
+    @classmethod
+    def tearDownClass(cls):
+        for policy_id in cls.policy_ids:
+            for payment in Payment.query.filter_by(policy_id=policy_id).all():
+                db.session.delete(payment)
+            for invoice in Invoice.query.filter_by(policy_id=policy_id).all():
+                db.session.delete(invoice)
+            db.session.delete(Policy.query.get(policy_id))
+        db.session.delete(Contact.query.get(cls.agent_id))
+        db.session.delete(Contact.query.get(cls.insured_id))
+        db.session.commit()
+
+    def amounts(self, rows, name):
+        return dict((row['period'], row[name]) for row in rows if row[name])
+
+    def test_by_month(self):
+        report = cash_flow_forecast(date(2015, 3, 10), 12, policy_ids=self.policy_ids)
+
+        self.assertEqual((report['start'], report['end'], report['policies']), ('2015-03-01', '2016-03-01', 2))
+        self.assertEqual(self.amounts(report['periods'], 'scheduled'),
+                         {'2015-05': 300, '2015-08': 300, '2015-11': 300})
+        # the monthly policy's first term, and the quarterly's second one
+        projected = dict(('%04d-%02d' % (2015 + (month + 2) // 12, (month + 2) % 12 + 1), 100) for month in range(12))
+        projected['2016-02'] += 300
+        self.assertEqual(self.amounts(report['periods'], 'projected'), projected)
+        self.assertEqual(report['totals'], {'scheduled': 900, 'projected': 1500, 'total': 2400, 'past_due': 200})
+
+        quarterly = [row for row in report['rows'] if row['billing_schedule'] == 'Quarterly']
+        self.assertEqual([(row['period'], row['agent'], row['total']) for row in quarterly],
+                         [('2015-05', 'Forecast Agent', 300), ('2015-08', 'Forecast Agent', 300),
+                          ('2015-11', 'Forecast Agent', 300), ('2016-02', 'Forecast Agent', 300)])
+
+    def test_by_day(self):
+        by_day = cash_flow_forecast(date(2015, 3, 1), 12, 'day', self.policy_ids)
+        by_month = cash_flow_forecast(date(2015, 3, 1), 12, 'month', self.policy_ids)
+
+        self.assertEqual(len(by_day['periods']), 366)
+        projected = self.amounts(by_day['periods'], 'projected')
+        # billed on the last day of the month, due a month after that
+        self.assertEqual(sorted(projected)[:3], ['2015-03-28', '2015-04-30', '2015-05-30'])
+        self.assertEqual(self.amounts(by_day['periods'], 'scheduled')['2015-05-01'], 300)
+        for name in ('scheduled', 'projected'):
+            months = {}
+            for period, amount in self.amounts(by_day['periods'], name).items():
+                months[period[:7]] = months.get(period[:7], 0) + amount
+            self.assertEqual(months, self.amounts(by_month['periods'], name))
+        self.assertEqual(by_day['totals'], by_month['totals'])
+
+    def test_matches_invoices_and_schedules(self):
+        for by in ('month', 'day'):
+            for start in (date(2014, 6, 15), date(2015, 3, 10)):
+                self.assertEqual(check_forecast(start, 24, by, sample=1000), [])
+
+    def test_csv_and_endpoint(self):
+        report = cash_flow_forecast(date(2015, 3, 1), 12, policy_ids=self.policy_ids)
+        lines = forecast_csv(report).splitlines()
+        self.assertEqual(lines[0], 'period,agent_id,agent,billing_schedule,scheduled,projected,total')
+        self.assertIn('2016-02,%s,Forecast Agent,Quarterly,0,300,300' % self.agent_id, lines)
+        self.assertEqual(forecast_csv(report, 'periods').splitlines()[1], '2015-03,0,100,100')
+
+        client = app.test_client()
+        response = client.get('/reports/forecast?date=2015-03-01&months=6&rows=periods')
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(response.data)
+        self.assertEqual((body['start'], body['end'], len(body['periods'])), ('2015-03-01', '2015-09-01', 6))
+        response = client.get('/reports/forecast?date=2015-03-01&format=csv')
+        self.assertEqual(response.headers['Content-Type'], 'text/csv')
+        self.assertEqual(response.data, forecast_csv(cash_flow_forecast(date(2015, 3, 1))))
+
+        self.assertEqual(client.get('/reports/forecast?by=week').status_code, 400)
+        self.assertEqual(client.get('/reports/forecast?months=0').status_code, 400)
+
+
+class TestExport(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        cls.insured_id = cls.test_insured.id
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(Contact.query.get(cls.insured_id))
+        db.session.commit()
+
+    def setUp(self):
+        self.policy = Policy('Export Policy', date(2015, 1, 1), 1200)
+        self.policy.billing_schedule = "Quarterly"
+        self.policy.named_insured = self.insured_id
+        db.session.add(self.policy)
+        db.session.commit()
+        self.policy_id = self.policy.id
+
+    def tearDown(self):
+        for payment in Payment.query.filter_by(policy_id=self.policy_id).all():
+            db.session.delete(payment)
+        for invoice in Invoice.query.filter_by(policy_id=self.policy_id).all():
+            db.session.delete(invoice)
+        db.session.delete(Policy.query.get(self.policy_id))
+        db.session.commit()
+
+    def read(self, table, since=None, output='csv', compress=False):
+        mark, chunks = export_table(table, since, output, compress, batch_size=2)
+        data = ''.join(chunks)
+        if compress:
+            data = gzip.GzipFile(fileobj=StringIO(data)).read()
+        if output == 'csv':
+            return mark, list(csv.DictReader(StringIO(data)))
+        return mark, [json.loads(line) for line in data.splitlines()]
+
+    def test_full_extract(self):
+        PolicyAccounting(self.policy_id)
+        mark, rows = self.read('invoices')
+
+        self.assertEqual(len(rows), Invoice.query.count())
+        self.assertEqual([int(row['id']) for row in rows], sorted(int(row['id']) for row in rows))
+        ours = [row for row in rows if int(row['policy_id']) == self.policy_id]
+        self.assertEqual([row['bill_date'] for row in ours], ['2015-01-01', '2015-04-01', '2015-07-01', '2015-10-01'])
+        self.assertEqual(set(row['deleted'] for row in ours), set(['false']))
+        self.assertEqual(mark, watermark('invoices'))
+        self.assertEqual(self.read('invoices', output='jsonl', compress=True)[1][-1]['bill_date'], '2015-10-01')
+
+    def test_batches(self):
+        batches = list(export_rows('policies', batch_size=2))
+
+        self.assertTrue(all(1 <= len(rows) <= 2 for rows in batches))
+        self.assertEqual(sum(len(rows) for rows in batches), Policy.query.count())
+
+    def test_incremental_extract_has_only_what_changed(self):
+        pa = PolicyAccounting(self.policy_id)
+        mark, _ = self.read('invoices')
+        payments_mark, _ = self.read('payments')
+        self.assertEqual(self.read('invoices', since=mark)[1], [])
+
+        payment = pa.make_payment(date_cursor=date(2015, 2, 1), amount=300)
+        first = Invoice.query.filter_by(policy_id=self.policy_id).order_by(Invoice.bill_date).first()
+        invoice = Invoice.query.filter_by(policy_id=self.policy_id).order_by(Invoice.bill_date.desc()).first()
+        invoice.deleted = True
+        db.session.commit()
+
+        # the payment went to the first invoice, which now shows it as paid
+        new_mark, rows = self.read('invoices', since=mark, output='jsonl')
+        self.assertEqual([(row['id'], row['deleted'], row['amount_paid']) for row in rows],
+                         [(first.id, False, 300), (invoice.id, True, 0)])
+        self.assertTrue(new_mark > mark)
+        self.assertEqual([row['id'] for row in self.read('payments', since=payments_mark, output='jsonl')[1]],
+                         [payment.id])
+        self.assertEqual(self.read('invoices', since=new_mark)[1], [])
+
+    def test_endpoint(self):
+        client = app.test_client()
+        mark = watermark('policies')
+        response = client.get('/export/policies?format=jsonl&since=%d' % (mark - 1))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Watermark'], str(mark))
+        self.assertEqual([json.loads(line)['id'] for line in response.data.splitlines()], [self.policy_id])
+
+        response = client.get('/export/payments?gzip=1')
+        self.assertEqual(response.headers['Content-Type'], 'application/gzip')
+        self.assertTrue(gzip.GzipFile(fileobj=StringIO(response.data)).read().startswith('id,policy_id,'))
+        self.assertEqual(client.get('/export/contacts').status_code, 404)
+        self.assertEqual(client.get('/export/invoices?since=yesterday').status_code, 400)
+
+
+class TestBulkReschedule(unittest.TestCase):
+    # (current schedule, new schedule) pairs, covering change_policy failing
+    # (nothing billed after the date), doing nothing (0 invoices to create)
+    # and voiding without replacing (a negative count)
+    CHANGES = [('Annual', 'Monthly'), ('Two-Pay', 'Monthly'), ('Quarterly', 'Monthly'), ('Monthly', 'Monthly'),
+               ('Monthly', 'Quarterly'), ('Monthly', 'Annual'), ('Two-Pay', 'Quarterly')]
+    DATE = date(2015, 3, 1)
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        cls.insured_id = cls.test_insured.id
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(Contact.query.get(cls.insured_id))
+        db.session.commit()
+
+    def setUp(self):
+        self.pairs = []
+        for current, new in self.CHANGES:
+            pair = []
+            for copy in ('orm', 'bulk'):
+                policy = Policy('Reschedule %s %s %s' % (current, new, copy), date(2015, 1, 15), 1200)
+                policy.billing_schedule = current
+                policy.named_insured = self.insured_id
+                db.session.add(policy)
+                db.session.commit()
+                PolicyAccounting(policy.id).make_payment(date_cursor=date(2015, 2, 1), amount=100)
+                pair.append(policy.id)
+            self.pairs.append((new, pair[0], pair[1]))
+
+    def tearDown(self):
+        for _, orm_id, bulk_id in self.pairs:
+            for policy_id in (orm_id, bulk_id):
+                for payment in Payment.query.filter_by(policy_id=policy_id).all():
+                    db.session.delete(payment)
+                for invoice in Invoice.query.filter_by(policy_id=policy_id).all():
+                    db.session.delete(invoice)
+                db.session.delete(Policy.query.get(policy_id))
+        db.session.commit()
+
+    def state(self, policy_id):
+        policy = Policy.query.get(policy_id)
+        invoices = sorted((invoice.bill_date, invoice.due_date, invoice.cancel_date, invoice.amount_due,
+                           invoice.deleted) for invoice in Invoice.query.filter_by(policy_id=policy_id))
+        balances = [PolicyReader(policy_id).return_account_balance(day)
+                    for day in (date(2015, 3, 1), date(2015, 7, 1), date(2016, 12, 31))]
+        return policy.billing_schedule, policy.effective_date, invoices, balances
+
+    def test_matches_change_policy(self):
+        skipped = 0
+        for new, orm_id, _ in self.pairs:
+            try:
+                PolicyAccounting(orm_id).change_policy(new, self.DATE)
+            except IndexError:
+                db.session.rollback()
+                skipped += 1
+
+        for schedule in set(new for new, _, _ in self.pairs):
+            reschedule_policies([bulk_id for new, _, bulk_id in self.pairs if new == schedule], schedule,
+                                self.DATE, chunk_size=2)
+        db.session.expire_all()
+
+        for new, orm_id, bulk_id in self.pairs:
+            self.assertEqual(self.state(orm_id), self.state(bulk_id), new)
+        self.assertEqual(verify_ledger([bulk_id for _, _, bulk_id in self.pairs]), [])
+        self.assertEqual(skipped, 1)
+
+    def test_summary(self):
+        progress = []
+        summary = reschedule_policies([bulk_id for _, _, bulk_id in self.pairs], 'Monthly', self.DATE,
+                                      chunk_size=4, progress=lambda done, total: progress.append((done, total)))
+
+        self.assertEqual(progress, [(4, 7), (7, 7)])
+        # Annual has nothing billed after March 1st, the six others move
+        self.assertEqual(summary['changed'], 6)
+        self.assertEqual([policy_id for policy_id, _ in summary['skipped']], [self.pairs[0][2]])
+        self.assertEqual(Policy.query.get(self.pairs[2][2]).effective_date, date(2015, 4, 15))
+        self.assertRaises(ValueError, reschedule_policies, [self.pairs[0][2]], 'Weekly')
+
+
+class TestColumnarBook(unittest.TestCase):
+    DATES = [date(2015, 1, 1), date(2015, 2, 14), date(2015, 3, 15), date(2015, 6, 30), date(2016, 1, 1)]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        cls.insured_id = cls.test_insured.id
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(Contact.query.get(cls.insured_id))
+        db.session.commit()
+
+    def setUp(self):
+        self.policy_ids = []
+        for schedule, paid in (('Monthly', [(date(2015, 1, 20), 100), (date(2015, 3, 1), 150)]),
+                               ('Quarterly', [(date(2015, 2, 1), 300)]),
+                               ('Annual', [(date(2015, 2, 1), 1500)]),
+                               ('Two-Pay', [])):
+            policy = Policy('Columnar %s' % schedule, date(2015, 1, 15), 1200)
+            policy.billing_schedule = schedule
+            policy.named_insured = self.insured_id
+            db.session.add(policy)
+            db.session.commit()
+            pa = PolicyAccounting(policy.id)
+            for day, amount in paid:
+                pa.make_payment(date_cursor=day, amount=amount)
+            self.policy_ids.append(policy.id)
+        # a deleted invoice is left out of balances but still listed
+        invoice = Invoice.query.filter_by(policy_id=self.policy_ids[0]).order_by(Invoice.bill_date).all()[2]
+        invoice.deleted = True
+        db.session.commit()
+        rebuild_ledger([self.policy_ids[0]])
+
+    def tearDown(self):
+        for policy_id in self.policy_ids:
+            for payment in Payment.query.filter_by(policy_id=policy_id).all():
+                db.session.delete(payment)
+            for invoice in Invoice.query.filter_by(policy_id=policy_id).all():
+                db.session.delete(invoice)
+            db.session.delete(Policy.query.get(policy_id))
+        db.session.commit()
+
+    def assertMatchesReader(self, book, policy_ids):
+        for policy_id in policy_ids:
+            for day in self.DATES:
+                reader = PolicyReader(policy_id)
+                self.assertEqual(book.return_account_balance(policy_id, day), reader.return_account_balance(day))
+
+                expected, result = reader.evaluate_cancel(day), book.evaluate_cancel(policy_id, day)
+                self.assertEqual(bool(result), bool(expected))
+                self.assertEqual(result.outstanding, expected.outstanding)
+                self.assertEqual(result.cancel_date, expected.cancel_date)
+                if expected:
+                    self.assertEqual(result.invoice.id, expected.invoice.id)
+
+                self.assertEqual([(invoice.id, invoice.bill_date, invoice.amount_due, invoice.deleted)
+                                  for invoice in book.get_invoices(policy_id, day)],
+                                 [(invoice.id, invoice.bill_date, invoice.amount_due, invoice.deleted)
+                                  for invoice in reader.get_invoices(day)])
+
+    def test_matches_policy_reader(self):
+        book = ColumnarBook(batch_size=3)
+        book.load()
+        all_ids = [policy.id for policy in Policy.query.all()]
+        self.assertMatchesReader(book, all_ids)
+        self.assertTrue(book.evaluate_cancel(self.policy_ids[3], date(2015, 6, 30)))
+        self.assertEqual(book.return_account_balance(10 ** 9, date(2015, 6, 30)), 0)
+        self.assertEqual(book.get_invoices(10 ** 9, date(2015, 6, 30)), [])
+
+    def test_refresh(self):
+        book = ColumnarBook()
+        book.load()
+        unchanged = book.policies[self.policy_ids[2]]
+
+        PolicyAccounting(self.policy_ids[3]).make_payment(date_cursor=date(2015, 2, 1), amount=600)
+        PolicyAccounting(self.policy_ids[1]).change_policy('Monthly', date(2015, 4, 1))
+        self.assertEqual(sorted(book.refresh()), sorted(self.policy_ids[i] for i in (1, 3)))
+
+        self.assertIs(book.policies[self.policy_ids[2]], unchanged)
+        self.assertMatchesReader(book, self.policy_ids)
+        self.assertEqual(book.refresh(), [])
+        self.assertEqual(book.invoice_count, Invoice.query.count())
+        self.assertEqual(book.payment_count, Payment.query.count())
+
+    def test_memory_report(self):
+        book = ColumnarBook()
+        book.load()
+        report = book.memory_report()
+        self.assertEqual(report['policies'], Policy.query.filter(Policy.invoices.any()).count())
+        self.assertEqual(report['invoices'], Invoice.query.count())
+        self.assertTrue(report['bytes'] > 0)
+        self.assertTrue(report['mb_per_million_invoices'] > 0)
+
+
+class TestBatchRunner(unittest.TestCase):
+    DATE = date(2015, 6, 30)
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        cls.insured_id = cls.test_insured.id
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(Contact.query.get(cls.insured_id))
+        db.session.commit()
+
+    def setUp(self):
+        self.policy_ids = []
+        for number in range(6):
+            policy = Policy('Batch %d' % number, date(2015, 1, 1), 1200)
+            policy.billing_schedule = 'Quarterly'
+            policy.named_insured = self.insured_id
+            db.session.add(policy)
+            db.session.commit()
+            PolicyAccounting(policy.id)
+            self.policy_ids.append(policy.id)
+        for policy_id in self.policy_ids[:4]:
+            PolicyAccounting(policy_id).make_payment(date_cursor=date(2015, 1, 10), amount=600)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for policy_id in self.policy_ids:
+            for payment in Payment.query.filter_by(policy_id=policy_id).all():
+                db.session.delete(payment)
+            for invoice in Invoice.query.filter_by(policy_id=policy_id).all():
+                db.session.delete(invoice)
+            db.session.delete(Policy.query.get(policy_id))
+        db.session.commit()
+        shutil.rmtree(self.directory)
+
+    def run_batch(self, operation, **options):
+        output = StringIO()
+        summary = run_batch(operation, output, self.DATE, **options)
+        return summary, list(csv.reader(StringIO(output.getvalue())))
+
+    def test_shard_ranges(self):
+        self.assertEqual(shard_ranges([5, 1, 3, 9, 7], 2), [(1, 3), (5, 9)])
+        self.assertEqual(shard_ranges([4, 2], 8), [(2, 2), (4, 4)])
+
+    def test_balances_in_worker_processes(self):
+        summary, rows = self.run_batch('balances', workers=2, shards=3, chunk_size=2)
+
+        all_ids = [policy.id for policy in Policy.query.order_by(Policy.id)]
+        self.assertEqual(rows[0], ['policy_id', 'balance'])
+        self.assertEqual([int(row[0]) for row in rows[1:]], all_ids)
+        for policy_id, balance in rows[1:]:
+            self.assertEqual(int(balance), PolicyReader(int(policy_id)).return_account_balance(self.DATE))
+        self.assertEqual(summary['shards'], 3)
+        self.assertEqual(summary['rows'], len(all_ids))
+
+    def test_resume_from_checkpoint(self):
+        expected = self.run_batch('cancellations', workers=1, shards=2, chunk_size=2,
+                                  checkpoint_dir=self.directory + '/full', policy_ids=self.policy_ids)[1]
+        self.assertEqual([int(row[0]) for row in expected[1:]], self.policy_ids[4:])
+
+        interrupted = os.path.join(self.directory, 'interrupted')
+        self.run_batch('cancellations', workers=1, shards=2, chunk_size=2, checkpoint_dir=interrupted,
+                       policy_ids=self.policy_ids)
+        # the second shard got through one chunk and was cut short writing the next
+        path = os.path.join(interrupted, 'shard-0001.jsonl')
+        first_chunk = open(path).readline()
+        with open(path, 'w') as stream:
+            stream.write(first_chunk + '{"through": ')
+
+        progress = []
+        summary, rows = self.run_batch('cancellations', workers=1, checkpoint_dir=interrupted,
+                                       policy_ids=self.policy_ids,
+                                       progress=lambda done, total: progress.append(done))
+        self.assertEqual(rows, expected)
+        self.assertEqual(summary['resumed_shards'], 2)
+        # only the last policy was left to do
+        self.assertEqual(progress, [6])
+        self.assertRaises(ValueError, self.run_batch, 'balances', checkpoint_dir=interrupted)
+
+    def test_writing_operations_can_repeat(self):
+        unbilled = Policy('Batch unbilled', date(2015, 1, 1), 1200)
+        unbilled.billing_schedule = 'Two-Pay'
+        unbilled.named_insured = self.insured_id
+        db.session.add(unbilled)
+        db.session.commit()
+        self.policy_ids.append(unbilled.id)
+
+        rows = self.run_batch('invoices', workers=1, policy_ids=self.policy_ids)[1]
+        self.assertEqual(rows, [['policy_id'], [str(unbilled.id)]])
+        self.assertEqual(Invoice.query.filter_by(policy_id=unbilled.id).count(), 2)
+        self.assertEqual(self.run_batch('invoices', workers=1, policy_ids=self.policy_ids)[1], [['policy_id']])
+
+        rows = self.run_batch('reschedule', workers=1, policy_ids=self.policy_ids[:2], schedule='Monthly')[1]
+        self.assertEqual(rows[1:], [[str(policy_id), 'moved'] for policy_id in self.policy_ids[:2]])
+        self.assertEqual(Policy.query.get(self.policy_ids[0]).billing_schedule, 'Monthly')
+        rows = self.run_batch('reschedule', workers=1, policy_ids=self.policy_ids[:2], schedule='Monthly')[1]
+        self.assertEqual(rows, [['policy_id', 'result']])
+        self.assertRaises(ValueError, self.run_batch, 'reschedule', policy_ids=self.policy_ids)
+
+
+class TestArchive(unittest.TestCase):
+    DATES = [date(2014, 1, 1), date(2014, 3, 1), date(2014, 5, 20), date(2014, 12, 31), date(2015, 6, 30)]
+    BEFORE = date(2015, 1, 1)
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        cls.insured_id = cls.test_insured.id
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(Contact.query.get(cls.insured_id))
+        db.session.commit()
+
+    def add_policy(self, name, paid, paid_on=date(2014, 2, 1)):
+        policy = Policy('Archive %s' % name, date(2014, 1, 1), 1200)
+        policy.billing_schedule = 'Quarterly'
+        policy.named_insured = self.insured_id
+        db.session.add(policy)
+        db.session.commit()
+        pa = PolicyAccounting(policy.id)
+        if paid:
+            pa.make_payment(date_cursor=paid_on, amount=paid)
+        self.policy_ids.append(policy.id)
+        return pa
+
+    def setUp(self):
+        self.policy_ids = []
+        self.settled = self.add_policy('settled', 1200).cancel_policy(u'Sold the car').id
+        self.owing = self.add_policy('owing', 300).cancel_policy(u'Non-payment').id
+        self.voided = self.add_policy('voided', 300).change_policy('Monthly', date(2014, 4, 1)).id
+        # owns the newest invoice and payment, which are never archived
+        self.newest = self.add_policy('newest', 100).policy.id
+
+    def tearDown(self):
+        for policy_id in self.policy_ids:
+            for model in (Payment, Invoice, ArchivedPayment, ArchivedInvoice):
+                for row in model.query.filter_by(policy_id=policy_id).all():
+                    db.session.delete(row)
+            db.session.delete(Policy.query.get(policy_id))
+        db.session.commit()
+
+    def lookups(self):
+        results = {}
+        for policy_id in self.policy_ids:
+            for day in self.DATES:
+                reader = PolicyReader(policy_id)
+                cancel = reader.evaluate_cancel(day)
+                results[(policy_id, day)] = (
+                    reader.return_account_balance(day),
+                    reader.return_account_totals(day),
+                    (bool(cancel), cancel.outstanding, cancel.invoice.id if cancel.invoice else None),
+                    [(invoice.id, invoice.bill_date, invoice.amount_due, invoice.deleted)
+                     for invoice in reader.get_invoices(day)])
+        db.session.remove()
+        for day in self.DATES:
+            results[(None, day)] = policy_summaries(self.policy_ids, day)
+        return results
+
+    def test_reads_fall_back_to_the_archive(self):
+        expected = self.lookups()
+        summary = archive_rows(self.BEFORE, batch_size=2, policy_ids=self.policy_ids)
+
+        self.assertEqual(summary['voided_invoices'], 3)
+        self.assertEqual(summary['policies'], 1)
+        self.assertEqual((summary['invoices'], summary['payments']), (4, 1))
+        self.assertEqual(summary['sizes']['after']['archived_invoices']['rows'] -
+                         summary['sizes']['before']['archived_invoices']['rows'], 7)
+        self.assertEqual(Invoice.query.filter_by(policy_id=self.settled).count(), 0)
+        self.assertEqual(Payment.query.filter_by(policy_id=self.settled).count(), 0)
+        self.assertEqual(LedgerEntry.query.filter_by(policy_id=self.settled).count(), 0)
+        self.assertEqual(Invoice.query.filter_by(policy_id=self.voided, deleted=True).count(), 0)
+        self.assertEqual(Policy.query.get(self.owing).archived_on, None)
+        self.assertEqual(Policy.query.get(self.newest).archived_on, None)
+
+        response_cache.clear()
+        after = self.lookups()
+        self.assertEqual(after, expected)
+        self.assertEqual(verify_ledger(self.policy_ids), [])
+        self.assertEqual(PaymentAllocation.query.filter_by(policy_id=self.settled).count(), 0)
+        self.assertEqual(verify_allocations(self.policy_ids, self.BEFORE), [])
+        # nothing left to move, and archived policies don't get invoices again
+        self.assertEqual(archive_rows(self.BEFORE, policy_ids=self.policy_ids)['policies'], 0)
+        self.assertFalse(PolicyAccounting(self.settled).ensure_invoices())
+
+    def set_based_reads(self):
+        book = ColumnarBook()
+        book.load()
+        # a list rather than a dict, so that a failure prints a readable diff
+        results = []
+        for day in self.DATES:
+            results.append(('aging', day, sorted(
+                (line['policy_id'], [line[name] for name in ('current', 'days_1_30', 'days_31_60',
+                                                             'days_61_plus', 'credit', 'balance')])
+                for line in aging_report(day, self.policy_ids)['policies'])))
+            results.append(('aging of all', day, sorted(
+                line['policy_id'] for line in aging_report(day)['policies'] if line['policy_id'] in self.policy_ids)))
+            results.append(('sweep', day, find_policies_to_cancel(day, self.policy_ids, statuses=None)))
+            results.append(('sweep of all', day, dict(
+                (policy_id, due) for policy_id, due in find_policies_to_cancel(day, statuses=None).items()
+                if policy_id in self.policy_ids)))
+            for policy_id in self.policy_ids:
+                cancel = book.evaluate_cancel(policy_id, day)
+                results.append(('columnar', day, policy_id, book.return_account_balance(policy_id, day),
+                                (bool(cancel), cancel.outstanding, cancel.invoice.id if cancel.invoice else None),
+                                [invoice.id for invoice in book.get_invoices(policy_id, day)]))
+        for table_name in ('invoices', 'payments'):
+            results.append(('export', table_name, sorted(
+                (row['id'], row['policy_id']) for rows in export_rows(table_name) for row in rows
+                if row['policy_id'] in self.policy_ids)))
+        db.session.remove()
+        return results
+
+    def test_set_based_reads_fall_back_to_the_archive(self):
+        # paid in full two months late, so it was due to cancel in March
+        late = self.add_policy('late', 1200, date(2014, 4, 15)).cancel_policy(u'Sold the car').id
+        self.add_policy('newest again', 100)
+        expected = self.set_based_reads()
+        sweeps = dict((line[1], line[2]) for line in expected if line[0] == 'sweep')
+        self.assertEqual(sweeps[date(2014, 3, 1)][late], (date(2014, 2, 15), 300))
+        self.assertIn(('columnar', date(2014, 3, 1), late, 300, True), [line[:4] + line[4][:1] for line in expected
+                                                                        if line[0] == 'columnar'])
+
+        summary = archive_rows(self.BEFORE, policy_ids=self.policy_ids)
+        self.assertEqual(summary['policies'], 2)
+        self.assertEqual(Invoice.query.filter_by(policy_id=late).count(), 0)
+
+        response_cache.clear()
+        self.assertEqual(self.set_based_reads(), expected)
+
+    def test_recent_activity_is_kept(self):
+        summary = archive_rows(date(2014, 6, 1), policy_ids=self.policy_ids)
+        self.assertEqual(summary['policies'], 0)
+        self.assertEqual(summary['voided_invoices'], 3)
+        self.assertEqual(closed_policies(self.BEFORE, self.policy_ids), [self.settled])
+
+
+class TestPaymentAllocation(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        cls.insured_id = cls.test_insured.id
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(Contact.query.get(cls.insured_id))
+        db.session.commit()
+
+    def setUp(self):
+        policy = Policy('Allocation Policy', date(2015, 1, 1), 1200)
+        policy.billing_schedule = 'Quarterly'
+        policy.named_insured = self.insured_id
+        db.session.add(policy)
+        db.session.commit()
+        self.policy_id = policy.id
+        self.pa = PolicyAccounting(self.policy_id)
+
+    def tearDown(self):
+        for model in (Payment, Invoice):
+            for row in model.query.filter_by(policy_id=self.policy_id).all():
+                db.session.delete(row)
+        db.session.delete(Policy.query.get(self.policy_id))
+        db.session.commit()
+        self.assertEqual(PaymentAllocation.query.filter_by(policy_id=self.policy_id).count(), 0)
+
+    def paid(self):
+        return [(invoice.bill_date.month, invoice.amount_paid, invoice.paid_in_full_on)
+                for invoice in Invoice.query.filter_by(policy_id=self.policy_id, deleted=False)
+                .order_by(Invoice.bill_date)]
+
+    def open_invoices(self, day):
+        return [(invoice.bill_date.month, owed) for invoice, owed in self.pa.get_open_invoices(day)]
+
+    def test_payments_go_to_the_oldest_open_invoices(self):
+        self.pa.make_payment(date_cursor=date(2015, 2, 1), amount=450)
+        self.assertEqual(self.paid(), [(1, 300, date(2015, 2, 1)), (4, 150, None), (7, 0, None), (10, 0, None)])
+        self.assertEqual(self.open_invoices(date(2015, 1, 15)), [(1, 300)])
+        self.assertEqual(self.open_invoices(date(2015, 5, 1)), [(4, 150)])
+
+        # a back-dated payment takes the oldest invoice and pushes the rest along
+        self.pa.make_payment(date_cursor=date(2015, 1, 10), amount=300)
+        self.assertEqual(self.paid(), [(1, 300, date(2015, 1, 10)), (4, 300, date(2015, 2, 1)),
+                                       (7, 150, None), (10, 0, None)])
+        self.assertEqual(self.open_invoices(date(2015, 5, 1)), [])
+        self.assertEqual(verify_allocations([self.policy_id], date(2015, 12, 31)), [])
+
+    def test_targeted_payment_and_voids(self):
+        third = Invoice.query.filter_by(policy_id=self.policy_id, bill_date=date(2015, 7, 1)).one()
+        self.pa.make_payment(date_cursor=date(2015, 1, 5), amount=300, invoice_id=third.id)
+        self.assertEqual(self.paid(), [(1, 0, None), (4, 0, None), (7, 300, date(2015, 1, 5)), (10, 0, None)])
+        # paid, but for July: January's invoice is still open on its cancel date
+        self.assertTrue(self.pa.evaluate_cancel(date(2015, 3, 1)))
+
+        # voiding July's invoice sends the money to the oldest open one
+        self.pa.change_policy('Monthly', date(2015, 6, 1))
+        self.assertEqual(self.paid()[:2], [(1, 300, date(2015, 1, 5)), (4, 0, None)])
+        self.assertEqual(Invoice.query.get(third.id).amount_paid, 0)
+        self.assertEqual(verify_allocations([self.policy_id], date(2015, 12, 31)), [])
+
+    def test_cancellation_matches_the_balance(self):
+        self.pa.make_payment(date_cursor=date(2015, 1, 20), amount=300)
+        self.pa.make_payment(date_cursor=date(2015, 5, 20), amount=200)
+        self.pa.change_policy('Monthly', date(2015, 9, 1))
+        for month in range(1, 13):
+            day = date(2015, month, 1) + relativedelta(months=1, days=-1)
+            found = self.pa.evaluate_cancel(day)
+            expected = self.pa._evaluate_cancel_from_history(day)
+            self.assertEqual((bool(found), found.cancel_date, found.outstanding),
+                             (bool(expected), expected.cancel_date, expected.outstanding))
+            self.assertEqual(found.invoice.id if found else None, expected.invoice.id if expected else None)
+
+    def test_every_reader_agrees_on_a_targeted_payment(self):
+        third = Invoice.query.filter_by(policy_id=self.policy_id, bill_date=date(2015, 7, 1)).one()
+        self.pa.make_payment(date_cursor=date(2015, 1, 5), amount=300, invoice_id=third.id)
+        book = ColumnarBook()
+        days = [date(2015, 1, 31), date(2015, 3, 1), date(2015, 8, 31)]
+        for day in days:
+            expected = self.pa.evaluate_cancel(day)
+            swept = find_policies_to_cancel(day, policy_ids=[self.policy_id])
+            loaded = book.evaluate_cancel(self.policy_id, day)
+            self.assertEqual(swept.get(self.policy_id),
+                             (expected.cancel_date, expected.outstanding) if expected else None)
+            self.assertEqual((bool(loaded), loaded.cancel_date, loaded.outstanding),
+                             (bool(expected), expected.cancel_date, expected.outstanding))
+            self.assertEqual(policy_summaries([self.policy_id], day)[self.policy_id]['cancellation_pending'],
+                             bool(expected))
+        # nothing owed on the balance, but January's invoice is still open
+        self.assertTrue(self.pa.evaluate_cancel(date(2015, 3, 1)))
+        self.assertEqual(self.pa.return_account_balance(date(2015, 3, 1)), 0)
+
+        line = aging_report(date(2015, 3, 1), [self.policy_id])['policies'][0]
+        self.assertEqual((line['days_1_30'], line['credit'], line['balance']), (300, 300, 0))
+
+        response = app.test_client().post('/api/balances', content_type='application/json',
+                                          data=json.dumps({'policies': [self.policy_id], 'date': '2015-03-01'}))
+        self.assertTrue(json.loads(response.data)['policies'][0]['cancellation_pending'])
+
+    def test_verify_reports_and_rebuild_repairs_drift(self):
+        self.pa.make_payment(date_cursor=date(2015, 2, 1), amount=450)
+        allocations = PaymentAllocation.__table__
+        db.session.execute(allocations.update().where(allocations.c.policy_id == self.policy_id).values(amount=1))
+        db.session.commit()
+
+        differences = verify_allocations([self.policy_id], date(2015, 12, 31))
+        self.assertTrue(differences)
+        self.assertTrue(all(policy_id == self.policy_id for policy_id, _ in differences))
+        reallocate([self.policy_id])
+        self.assertEqual(verify_allocations([self.policy_id], date(2015, 12, 31)), [])
+
+
+class TestReadSnapshot(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        cls.insured_id = cls.test_insured.id
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(Contact.query.get(cls.insured_id))
+        db.session.commit()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        configure('test', SNAPSHOT_ENABLED=True, SNAPSHOT_PATH=os.path.join(self.directory, 'accounting.snapshot'))
+        policy = Policy('Snapshot Policy', date(2015, 1, 1), 1200)
+        policy.billing_schedule = 'Quarterly'
+        policy.named_insured = self.insured_id
+        db.session.add(policy)
+        db.session.commit()
+        self.policy_id = policy.id
+        self.pa = PolicyAccounting(self.policy_id)
+
+    def tearDown(self):
+        for model in (PaymentAllocation, Payment, Invoice):
+            for row in model.query.filter_by(policy_id=self.policy_id).all():
+                db.session.delete(row)
+        db.session.delete(Policy.query.get(self.policy_id))
+        db.session.commit()
+        configure('test')
+        shutil.rmtree(self.directory)
+
+    def payments(self):
+        return Payment.query.filter_by(policy_id=self.policy_id).count()
+
+    def test_readers_never_block_writers(self):
+        refresh_snapshot()
+        reading, written = threading.Event(), threading.Event()
+        seen = []
+
+        def reader():
+            with db.reading_snapshot():
+                # a read transaction on the snapshot, open until every row is read
+                rows = db.session.execute("SELECT a.id FROM invoices a, invoices b")
+                rows.fetchone()
+                seen.append(self.payments())
+                reading.set()
+                written.wait(10)
+                rows.fetchall()
+                seen.append(self.payments())
+
+        thread = threading.Thread(target=reader)
+        thread.start()
+        self.assertTrue(reading.wait(10))
+        started = time.time()
+        self.pa.make_payment(date_cursor=date(2015, 2, 1), amount=300)
+        refresh_snapshot()
+        # a writer kept waiting would take SQLITE_BUSY_TIMEOUT_MS (5s)
+        self.assertLess(time.time() - started, 1)
+        written.set()
+        thread.join(10)
+
+        # the reader kept the copy it started with
+        self.assertEqual(seen, [0, 0])
+        self.assertEqual(self.payments(), 1)
+        with db.reading_snapshot() as taken_at:
+            self.assertGreaterEqual(taken_at, started)
+            self.assertEqual(self.payments(), 1)
+
+    def test_writes_go_to_the_database(self):
+        refresh_snapshot()
+        with db.reading_snapshot():
+            self.assertRaises(OperationalError, db.session.execute,
+                              Payment.__table__.delete().where(Payment.__table__.c.policy_id == self.policy_id))
+            db.session.rollback()
+        self.assertIsNone(db.snapshot_taken_at)
+        self.pa.make_payment(date_cursor=date(2015, 2, 1), amount=300)
+        self.assertEqual(self.payments(), 1)
+
+    def test_views_read_the_snapshot(self):
+        client = app.test_client()
+
+        def balance():
+            response = client.post('/api/balances', content_type='application/json',
+                                   data=json.dumps({'policies': [self.policy_id], 'date': '2015-12-31'}))
+            return response.headers.get('X-Snapshot-Age'), json.loads(response.data)['policies'][0]['balance']
+
+        # none taken yet: the database
+        self.assertIsNone(snapshot_age())
+        self.assertEqual(balance(), (None, 1200))
+
+        refresh_snapshot()
+        # the request dropped this thread's session, and self.pa's policy with it
+        PolicyAccounting(self.policy_id).make_payment(date_cursor=date(2015, 2, 1), amount=300)
+        age, owed = balance()
+        self.assertLess(float(age), 60)
+        self.assertEqual(owed, 1200)
+        response = client.get('/%s/2015-12-31' % self.policy_id)
+        self.assertIn('X-Snapshot-Age', response.headers)
+        self.assertIn('1200', response.data)
+
+        refresh_snapshot()
+        self.assertEqual(balance()[1], 900)
+        self.assertIn('900', client.get('/%s/2015-12-31' % self.policy_id).data)
+        exposition = metrics.exposition()
+        self.assertIn('accounting_snapshot_age_seconds ', exposition)
+        self.assertIn('accounting_snapshot_refresh_seconds_count{outcome="ok"}', exposition)
+
+    def test_exports_read_the_snapshot(self):
+        def exported_ids(chunks):
+            rows = list(csv.DictReader(StringIO(''.join(chunks))))
+            return set(int(row['id']) for row in rows if int(row['policy_id']) == self.policy_id)
+
+        refresh_snapshot()
+        self.pa.make_payment(date_cursor=date(2015, 2, 1), amount=300)
+        payment_id = Payment.query.filter_by(policy_id=self.policy_id).one().id
+        with db.reading_snapshot():
+            mark, chunks = export_table('payments')
+        self.assertNotIn(payment_id, exported_ids(chunks))
+        self.assertLess(mark, watermark('payments'))
+        self.assertIn(payment_id, exported_ids(export_table('payments')[1]))
+
+        response = app.test_client().get('/export/payments')
+        self.assertIn('X-Snapshot-Age', response.headers)
+        self.assertNotIn(payment_id, exported_ids([response.data]))
+        self.assertEqual(int(response.headers['X-Watermark']), mark)
+
+
+class TestStartup(unittest.TestCase):
+    def test_engine_runs_without_the_views_or_a_log_file(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        directory = tempfile.mkdtemp()
+        policy_id = Policy.query.first().id
+        code = ("import sys; from datetime import date; from accounting.utils import PolicyReader; "
+                "print 'accounting.views' in sys.modules, PolicyReader(%d).return_account_balance(date(2015, 12, 31))" % policy_id)
+        try:
+            output = subprocess.check_output(
+                [sys.executable, '-c', code], cwd=directory,
+                env=dict(os.environ, PYTHONPATH=root, ACCOUNTING_DATABASE=test_database))
+            balance = PolicyReader(policy_id).return_account_balance(date(2015, 12, 31))
+            self.assertEqual(output.split(), ['False', str(balance)])
+            self.assertEqual(os.listdir(directory), [])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_profiles(self):
+        self.assertEqual(app.config['PROFILE'], 'test')
+        self.assertIsNone(app.config['LOG_FILE'])
+        self.assertEqual(load_settings('batch')['RESPONSE_CACHE_SIZE'], 0)
+        self.assertEqual(load_settings('web', LOG_LEVEL='DEBUG')['LOG_LEVEL'], 'DEBUG')
+        self.assertRaises(ValueError, load_settings, 'nightly')
+        second = create_app()
+        self.assertEqual(second.config['PROFILE'], 'test')
+        self.assertEqual(sorted(rule.endpoint for rule in second.url_map.iter_rules()),
+                         ['get_aging_report', 'get_balances', 'get_export', 'get_forecast', 'get_result', 'index',
+                          'metrics', 'static'])
@@ -4,19 +4,19 @@ from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
 
 from accounting import db
+import archive
+from allocation import open_invoices, overdue_invoice
+from checkpoints import totals_as_of
+from ledger import balance_as_of
+from metrics import instrumented
+from migrations import stamp_db
 from models import Contact, Invoice, Payment, Policy
 
 import logging
 
-logging.basicConfig(level=logging.DEBUG)
-
+# handlers and levels are set up once by accounting.logs
 logger = logging.getLogger(__name__)
 
-handler = logging.FileHandler('accounting.log')
-format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(format)
-logger.addHandler(handler)
-
 """
 #######################################################
 This is the base code for the engineer project.
@@ -24,51 +24,209 @@ This is the base code for the engineer project.
 """
 
 
-class PolicyAccounting(object):
+class CancellationResult(object):
     """
-     Each policy has its own instance of accounting.
+     Outcome of PolicyAccounting.evaluate_cancel. It is truthy when
+     the policy should cancel, so it can be used as a plain flag.
     """
 
-    def __init__(self, policy_id):
-        self.policy = Policy.query.filter_by(id=policy_id).one()
-        self.billing_schedules = {'Annual': 1, 'Two-Pay': 2, 'Quarterly': 4, 'Monthly': 12}
-        self.scheduling_interval = {'Annual': 1, 'Two-Pay': 6, 'Quarterly': 3, 'Monthly': 1}
+    def __init__(self, should_cancel, date_cursor, invoice=None, outstanding=0):
+        self.should_cancel = should_cancel
+        self.date_cursor = date_cursor
+        # the invoice whose cancel date was reached with money still owed
+        self.invoice = invoice
+        self.outstanding = outstanding
+
+    @property
+    def cancel_date(self):
+        return self.invoice.cancel_date if self.invoice else None
+
+    def __nonzero__(self):
+        return self.should_cancel
+
+    def __repr__(self):
+        if not self.should_cancel:
+            return "<CancellationResult should not cancel as of %s>" % self.date_cursor
+        return "<CancellationResult cancel on %s, %d outstanding>" % (self.cancel_date, self.outstanding)
 
-        if not self.policy.invoices:
-            self.make_invoices()
 
+class PolicyReader(object):
+    """
+     Read-only accounting for a policy. It never writes: invoices are
+     not generated and the invoices relationship is never loaded, so it
+     is safe to use from GET requests without taking SQLite's write lock.
+    """
+
+    def __init__(self, policy_id):
+        self.policy = db.session.query(Policy).autoflush(False).filter_by(id=policy_id).one()
+
+    @instrumented
     def return_account_balance(self, date_cursor=None):
+        """
+         Amount still owed on the policy as of date_cursor: everything
+         billed on live (not deleted) invoices minus everything paid.
+         Read from the running-balance ledger in one indexed lookup.
+        """
         if not date_cursor:
             date_cursor = datetime.now().date()
 
-        # get the list of invoices for this policy up to the date passed in
+        if archive.has_archived_totals(self.policy):
+            balance = archive.balance_as_of(self.policy.id, date_cursor)
+        else:
+            balance = balance_as_of(self.policy.id, date_cursor)
+        logger.debug("Policy %s balance as of %s: %d", self.policy.id, date_cursor, balance)
+        return balance
+
+    @instrumented
+    def return_account_totals(self, date_cursor=None):
+        """
+         (billed, paid) on the policy as of date_cursor, read from the
+         nearest month-end checkpoint plus the rows after it.
+        """
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+
+        if archive.has_archived_totals(self.policy):
+            return archive.totals_as_of(self.policy.id, date_cursor)
+        return totals_as_of(self.policy.id, date_cursor)
+
+    def evaluate_cancellation_pending_due_to_non_pay(self, date_cursor=None):
+        """
+         If this function returns true, an invoice
+         on a policy has passed the due date without
+         being paid in full. However, it has not necessarily
+         made it to the cancel_date yet.
+        """
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+
+        return self.evaluate_cancel(date_cursor)
+
+    @instrumented
+    def evaluate_cancel(self, date_cursor=None):
+        """
+         Finds the first invoice whose cancel date came by date_cursor
+         while something billed by then was still unpaid, from the paid
+         in full dates accounting.allocation keeps on the invoices, and
+         reads what was owed that day from the ledger. The returned
+         CancellationResult is truthy when the policy should cancel and
+         carries the invoice that triggered it.
+        """
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+
+        if archive.has_archived_totals(self.policy):
+            return self._evaluate_cancel_from_history(date_cursor)
+
+        invoice = overdue_invoice(self.policy.id, date_cursor)
+        if invoice is None:
+            logger.debug("Policy %s should not cancel as of %s", self.policy.id, date_cursor)
+            return CancellationResult(False, date_cursor)
+
+        outstanding = balance_as_of(self.policy.id, invoice.cancel_date)
+        logger.info("Policy %s should have canceled on %s, %d outstanding",
+                    self.policy.id, invoice.cancel_date, outstanding)
+        return CancellationResult(True, date_cursor, invoice, outstanding)
+
+    def _evaluate_cancel_from_history(self, date_cursor):
+        """
+         evaluate_cancel for policies with archived rows, which keep no
+         allocations. Invoices and payments are fetched once, sorted by
+         date, and walked with running totals, so each cancel date costs
+         no extra queries.
+        """
+        # nothing billed or paid after date_cursor can matter for a cancel date before it
         invoices = Invoice.query.filter_by(policy_id=self.policy.id) \
+            .filter(Invoice.deleted == False) \
             .filter(Invoice.bill_date <= date_cursor) \
             .order_by(Invoice.bill_date) \
             .all()
-
-        # calculate the amount due for this policy up to the date passed in
-        due_now = 0
-        for invoice in invoices:
-            due_now += invoice.amount_due
-
-        logger.debug("Invoices up to %s: %d", date_cursor, len(invoices))
-        logger.debug("Amount due: %d", due_now)
-        # get the list of payments made on this policy up to the date passed in
-        payments = Payment.query.filter_by(policy_id=self.policy.id) \
+        payments = db.session.query(Payment.transaction_date, Payment.amount_paid) \
+            .filter(Payment.policy_id == self.policy.id) \
             .filter(Payment.transaction_date <= date_cursor) \
+            .order_by(Payment.transaction_date) \
             .all()
+        invoices = archive.with_archived_invoices(self.policy.id, date_cursor, invoices, include_deleted=False)
+        payments = archive.with_archived_payments(self.policy.id, date_cursor, payments)
+
+        checkpoints = sorted([invoice for invoice in invoices if invoice.cancel_date <= date_cursor],
+                             key=lambda invoice: (invoice.cancel_date, invoice.bill_date))
+
+        billed = paid = 0
+        next_invoice = next_payment = 0
+        for invoice in checkpoints:
+            # advance both running totals up to this cancel date
+            while next_invoice < len(invoices) and invoices[next_invoice].bill_date <= invoice.cancel_date:
+                billed += invoices[next_invoice].amount_due
+                next_invoice += 1
+            while next_payment < len(payments) and payments[next_payment].transaction_date <= invoice.cancel_date:
+                paid += payments[next_payment].amount_paid
+                next_payment += 1
+
+            if billed - paid > 0:
+                logger.info("Policy %s should have canceled on %s, %d outstanding",
+                            self.policy.id, invoice.cancel_date, billed - paid)
+                return CancellationResult(True, date_cursor, invoice, billed - paid)
+
+        logger.debug("Policy %s should not cancel as of %s", self.policy.id, date_cursor)
+        return CancellationResult(False, date_cursor)
+
+    @instrumented
+    def get_invoices(self, date_cursor):
+        if not date_cursor:
+            date_cursor = datetime.now().date()
 
-        # remove the amount already paid from the amount due
-        for payment in payments:
-            logger.debug("Found payment of: %d", payment.amount_paid)
-            due_now -= payment.amount_paid
+        invoices = Invoice.query.filter_by(policy_id=self.policy.id) \
+            .filter(Invoice.bill_date <= date_cursor) \
+            .order_by(Invoice.bill_date) \
+            .all()
+        if archive.has_archived_invoices(self.policy):
+            invoices = archive.with_archived_invoices(self.policy.id, date_cursor, invoices)
+        return invoices
 
-        logger.debug("Amount due: %d", due_now)
-        # return the amount due for this policy
-        return due_now
+    @instrumented
+    def get_open_invoices(self, date_cursor=None):
+        """
+         (invoice, amount still owed) of the live invoices billed by
+         date_cursor that weren't paid in full by then, oldest first.
+        """
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+
+        return open_invoices(self.policy.id, date_cursor)
+
+
+class PolicyAccounting(PolicyReader):
+    """
+     Each policy has its own instance of accounting.
+    """
+
+    billing_schedules = {'Annual': 1, 'Two-Pay': 2, 'Quarterly': 4, 'Monthly': 12}
+    scheduling_interval = {'Annual': 1, 'Two-Pay': 6, 'Quarterly': 3, 'Monthly': 1}
 
-    def make_payment(self, contact_id=None, date_cursor=None, amount=0):
+    def __init__(self, policy_id, generate_invoices=True):
+        super(PolicyAccounting, self).__init__(policy_id)
+
+        if generate_invoices:
+            self.ensure_invoices()
+
+    def ensure_invoices(self):
+        """
+         Generates the policy's invoices if it has none yet, live or
+         archived. Returns True when invoices were made.
+        """
+        has_invoices = db.session.query(Invoice.id).filter(Invoice.policy_id == self.policy.id).first()
+        if has_invoices or archive.has_archived_invoices(self.policy):
+            return False
+        self.make_invoices()
+        return True
+
+    @instrumented
+    def make_payment(self, contact_id=None, date_cursor=None, amount=0, invoice_id=None):
+        """
+         Records a payment. It pays invoice_id first when given, then the
+         oldest open invoices (see accounting.allocation).
+        """
         if not date_cursor:
             date_cursor = datetime.now().date()
 
@@ -82,7 +240,8 @@ class PolicyAccounting(object):
         payment = Payment(self.policy.id,
                           contact_id,
                           amount,
-                          date_cursor)
+                          date_cursor,
+                          invoice_id)
         db.session.add(payment)
         db.session.commit()
 
@@ -90,42 +249,7 @@ class PolicyAccounting(object):
                      contact_id, amount, date_cursor)
         return payment
 
-    def evaluate_cancellation_pending_due_to_non_pay(self, date_cursor=None):
-        """
-         If this function returns true, an invoice
-         on a policy has passed the due date without
-         being paid in full. However, it has not necessarily
-         made it to the cancel_date yet.
-        """
-        if not date_cursor:
-            date_cursor = datetime.now().date()
-
-        if self.evaluate_cancel(date_cursor):
-            return True
-
-        return False
-
-    def evaluate_cancel(self, date_cursor=None):
-        if not date_cursor:
-            date_cursor = datetime.now().date()
-
-        # gets all the invoices with the cancel date up to the date passed in
-        invoices = Invoice.query.filter_by(policy_id=self.policy.id) \
-            .filter(Invoice.cancel_date <= date_cursor) \
-            .order_by(Invoice.bill_date) \
-            .all()
-
-        # if there is any amount left to pay, tell that the policy should be canceled
-        for invoice in invoices:
-            if not self.return_account_balance(invoice.cancel_date):
-                continue
-            else:
-                print "THIS POLICY SHOULD HAVE CANCELED"
-                return True
-        else:
-            print "THIS POLICY SHOULD NOT CANCEL"
-            return False
-
+    @instrumented
     def make_invoices(self, changing=False, proration=0):
         if not changing:
             for invoice in self.policy.invoices:
@@ -142,18 +266,20 @@ class PolicyAccounting(object):
             invoices_to_create = proration
 
         if self.policy.billing_schedule in self.scheduling_interval:
+            log_rows = logger.isEnabledFor(logging.DEBUG)
             for i in range(0, invoices_to_create):
                 months_after_eff_date = i * self.scheduling_interval[self.policy.billing_schedule]
                 bill_date = self.policy.effective_date + relativedelta(months=months_after_eff_date)
 
-                logger.debug(
-                    "Creating [%s] Invoice => policy_id: %s / bill_date: %s / due_date: %s / cancel_date: %s / amount_due: %s",
-                    self.policy.billing_schedule,
-                    self.policy.id,
-                    bill_date,
-                    bill_date + relativedelta(months=1),
-                    bill_date + relativedelta(months=1, days=14),
-                    self.policy.annual_premium / self.billing_schedules.get(self.policy.billing_schedule))
+                if log_rows:
+                    logger.debug(
+                        "Creating [%s] Invoice => policy_id: %s / bill_date: %s / due_date: %s / cancel_date: %s / amount_due: %s",
+                        self.policy.billing_schedule,
+                        self.policy.id,
+                        bill_date,
+                        bill_date + relativedelta(months=1),
+                        bill_date + relativedelta(months=1, days=14),
+                        self.policy.annual_premium / self.billing_schedules.get(self.policy.billing_schedule))
 
                 invoice = Invoice(self.policy.id,
                                   bill_date,
@@ -171,6 +297,7 @@ class PolicyAccounting(object):
             db.session.add(invoice)
         db.session.commit()
 
+    @instrumented
     def change_policy(self, schedule, date_cursor=None):
         """
         This changes the policy and the dates accordingly to
@@ -200,6 +327,7 @@ class PolicyAccounting(object):
         self.make_invoices(True, proration)
         return self.policy
 
+    @instrumented
     def cancel_policy(self, reason):
         self.policy.status = 'Canceled'
         self.policy.reason = reason
@@ -208,17 +336,6 @@ class PolicyAccounting(object):
         logger.info("Cancelling Policy: %s", self.policy.id)
         return self.policy
 
-    def get_invoices(self, date_cursor):
-        if not date_cursor:
-            date_cursor = datetime.now().date()
-
-        invoices = Invoice.query.filter_by(policy_id=self.policy.id) \
-            .filter(Invoice.bill_date <= date_cursor) \
-            .order_by(Invoice.bill_date) \
-            .all()
-        return invoices
-
-
 ################################
 # The functions below are for the db and 
 # shouldn't need to be edited.
@@ -226,6 +343,7 @@ class PolicyAccounting(object):
 def build_or_refresh_db():
     db.drop_all()
     db.create_all()
+    stamp_db()
     insert_data()
     print "DB Ready!"
 
@@ -1,52 +1,223 @@
 # You will probably need more methods from flask but this one is a good start.
-from flask import render_template
-from utils import PolicyAccounting, db
-from accounting import app
+from datetime import datetime
+from functools import wraps
+from flask import current_app, jsonify, make_response, request
+from utils import PolicyReader, db
+from aging import aging_report, report_csv
+from cache import data_version, etag_for, response_cache
+from export import FORMATS, TABLES, export_table
+from forecast import BY, cash_flow_forecast, forecast_csv
+from metrics import render_template
+from portfolio import policy_summaries
+from snapshot import seconds_since
 from sqlalchemy import orm
 import logging
 
-logging.basicConfig(level=logging.DEBUG)
+# handlers and levels are set up once by accounting.logs
 logger = logging.getLogger(__name__)
 
-handler = logging.FileHandler('accounting.log')
-format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(format)
-logger.addHandler(handler)
 
-
-# Routing for the server.
-@app.route("/", methods=['GET', 'POST'])
 def index():
     # You will need to serve something up here.
     return render_template('index.html', context={})
 
 
-@app.route("/<policy>/<supplied_date>")
+def from_snapshot(view):
+    """
+     Runs a read-only view on the read snapshot, when there is one, with
+     the snapshot's age in an X-Snapshot-Age header.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with db.reading_snapshot() as taken_at:
+            response = current_app.make_response(view(*args, **kwargs))
+        if taken_at is not None:
+            response.headers['X-Snapshot-Age'] = '%.1f' % seconds_since(taken_at)
+        return response
+    return wrapper
+
+
 def get_result(policy, supplied_date):
 
-    errors = {}
+    # read first, from the database or the snapshot: a write made after it
+    # by any process gives a new key
+    version = data_version(int(policy)) if policy.isdigit() else None
+    key = (policy, supplied_date, version)
+    # repeat polls get a 304 without looking anything up, whichever worker
+    # answered them before
+    if version is not None and etag_for(key) in request.if_none_match:
+        response = current_app.response_class(status=304)
+        response.set_etag(etag_for(key))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    entry = response_cache.get(key) if version is not None else None
+    if entry is None:
+        token = response_cache.version(int(policy)) if policy.isdigit() else None
+        errors = {}
+        try:
+            # a lookup must never write, so no invoices are generated here
+            pa = PolicyReader(policy)
+        except orm.exc.NoResultFound:
+            error_text = "No Policy found with Policy id: " + policy
+            errors['error'] = error_text
+            logger.error(error_text)
+            return render_template("error.html", context=errors )
+
+        invoices = pa.get_invoices(supplied_date)
+        balance = pa.return_account_balance(supplied_date)
+        main_dic = {}
+        invoices_list = []
+        log_rows = logger.isEnabledFor(logging.DEBUG)
+        for invoice in invoices:
+            if log_rows:
+                logger.debug("invoice:  bill_date: %s - due_date: %s - cancel_date: %s - amount_due: %s",
+                             invoice.bill_date, invoice.due_date, invoice.cancel_date, invoice.amount_due)
+            invoices_list.append({
+                'bill_date': invoice.bill_date.strftime('%Y-%m-%d'),
+                'due_date': invoice.due_date.strftime('%Y-%m-%d'),
+                'cancel_date': invoice.cancel_date.strftime('%Y-%m-%d'),
+                'amount_due': invoice.amount_due
+            })
+        main_dic['invoices'] = invoices_list
+        main_dic['balance'] = balance
+        main_dic['policy_id'] = policy
+        entry = response_cache.put(pa.policy.id, key, main_dic, token)
+
+    response = make_response(render_template('table.html', context=entry.value))
+    response.set_etag(entry.etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def json_error(message, status=400):
+    logger.error(message)
+    response = jsonify(error=message)
+    response.status_code = status
+    return response
+
+
+def get_balances():
+    """
+     Batch version of get_result for integrations. Expects a JSON body like
+     {"policies": [1, 2, 3], "date": "2015-06-01"} and answers with the
+     balance, invoices and pending-cancellation flag of every policy found.
+    """
+    payload = request.json
+    if not isinstance(payload, dict):
+        return json_error("Expected a JSON object with 'policies' and 'date'")
+
+    policy_ids = payload.get('policies')
+    if not isinstance(policy_ids, list) or not policy_ids:
+        return json_error("'policies' must be a non empty list of policy ids")
+    limit = current_app.config['BALANCE_API_MAX_POLICIES']
+    if len(policy_ids) > limit:
+        return json_error("At most %d policies can be asked for at once, got %d" % (limit, len(policy_ids)),
+                          status=413)
     try:
-        pa = PolicyAccounting(policy)
-    except orm.exc.NoResultFound:
-        error_text = "No Policy found with Policy id: " + policy
-        errors['error'] = error_text
-        logger.error(error_text)
-        return render_template("error.html", context=errors )
-
-    invoices = pa.get_invoices(supplied_date)
-    balance = pa.return_account_balance(supplied_date)
-    main_dic = {}
-    invoices_list = []
-    for invoice in invoices:
-        logger.debug("invoice:  bill_date: %s - due_date: %s - cancel_date: %s - amount_due: %s",
-                     invoice.bill_date, invoice.due_date, invoice.cancel_date, invoice.amount_due)
-        invoices_list.append({
-            'bill_date': invoice.bill_date.strftime('%Y-%m-%d'),
-            'due_date': invoice.due_date.strftime('%Y-%m-%d'),
-            'cancel_date': invoice.cancel_date.strftime('%Y-%m-%d'),
-            'amount_due': invoice.amount_due
-        })
-    main_dic['invoices'] = invoices_list
-    main_dic['balance'] = balance
-    main_dic['policy_id'] = policy
-    return render_template('table.html', context=main_dic)
+        policy_ids = [int(policy_id) for policy_id in policy_ids]
+        date_cursor = datetime.strptime(payload.get('date') or '', '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return json_error("Policy ids must be numbers and 'date' must look like YYYY-MM-DD")
+
+    summaries = policy_summaries(policy_ids, date_cursor)
+    return jsonify(date=date_cursor.strftime('%Y-%m-%d'),
+                   policies=[summaries[policy_id] for policy_id in sorted(summaries)],
+                   missing=sorted(set(policy_ids) - set(summaries)))
+
+
+def get_aging_report():
+    """
+     Receivables aging, rolled up by agent unless ?by=policy, as JSON or,
+     with ?format=csv, as a CSV download. ?date=YYYY-MM-DD defaults to
+     today.
+    """
+    by = request.args.get('by', 'agent')
+    output = request.args.get('format', 'json')
+    if by not in ('agent', 'policy') or output not in ('json', 'csv'):
+        return json_error("'by' must be agent or policy and 'format' json or csv")
+    try:
+        date_cursor = datetime.strptime(request.args.get('date') or datetime.now().strftime('%Y-%m-%d'),
+                                        '%Y-%m-%d').date()
+    except ValueError:
+        return json_error("'date' must look like YYYY-MM-DD")
+
+    report = aging_report(date_cursor)
+    if output == 'csv':
+        response = make_response(report_csv(report, by))
+        response.headers['Content-Type'] = 'text/csv'
+        response.headers['Content-Disposition'] = 'attachment; filename=aging-%s-%s.csv' % (by, report['date'])
+        return response
+    rows = 'agents' if by == 'agent' else 'policies'
+    return jsonify({'date': report['date'], rows: report[rows], 'totals': report['totals']})
+
+
+def get_forecast():
+    """
+     Cash-flow forecast of the receivables per month (or ?by=day) of the
+     ?months=12 from ?date=YYYY-MM-DD (today), by agent and schedule or,
+     with ?rows=periods, in total; as JSON or, with ?format=csv, as a CSV
+     download.
+    """
+    by = request.args.get('by', 'month')
+    rows = request.args.get('rows', 'rows')
+    output = request.args.get('format', 'json')
+    if by not in BY or rows not in ('rows', 'periods') or output not in ('json', 'csv'):
+        return json_error("'by' must be month or day, 'rows' rows or periods and 'format' json or csv")
+    try:
+        date_cursor = datetime.strptime(request.args.get('date') or datetime.now().strftime('%Y-%m-%d'),
+                                        '%Y-%m-%d').date()
+    except ValueError:
+        return json_error("'date' must look like YYYY-MM-DD")
+    try:
+        months = int(request.args.get('months', 12))
+    except ValueError:
+        months = 0
+    if not 0 < months <= 120:
+        return json_error("'months' must be a number from 1 to 120")
+
+    report = cash_flow_forecast(date_cursor, months, by)
+    if output == 'csv':
+        response = make_response(forecast_csv(report, rows))
+        response.headers['Content-Type'] = 'text/csv'
+        response.headers['Content-Disposition'] = 'attachment; filename=forecast-%s-%s.csv' % (by, report['start'])
+        return response
+    return jsonify(dict((name, report[name]) for name in ('start', 'end', 'by', rows, 'totals')))
+
+
+def get_export(table):
+    """
+     Streams an extract of policies, invoices or payments as CSV or, with
+     ?format=jsonl, JSON lines; gzipped with ?gzip=1. ?since=N only sends
+     rows changed after the watermark N. The watermark to pass next time
+     is in the X-Watermark header.
+    """
+    output = request.args.get('format', 'csv')
+    compress = request.args.get('gzip') in ('1', 'true')
+    if table not in TABLES or output not in FORMATS:
+        return json_error("Can export %s as %s" % (', '.join(sorted(TABLES)), ' or '.join(FORMATS)), status=404)
+    try:
+        since = int(request.args['since']) if request.args.get('since') else None
+    except ValueError:
+        return json_error("'since' must be a watermark number")
+
+    # streamed once the view has returned, from the snapshot's engine: the
+    # same copy or a newer one, which the watermark allows for
+    mark, chunks = export_table(table, since, output, compress)
+    filename = '%s.%s%s' % (table, output, '.gz' if compress else '')
+    response = current_app.response_class(chunks, mimetype='application/gzip' if compress else
+                                  {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}[output])
+    response.headers['Content-Disposition'] = 'attachment; filename=%s' % filename
+    response.headers['X-Watermark'] = str(mark)
+    return response
+
+
+# Routing for the server, set up by accounting.create_app(). The read-only
+# views read the snapshot when SNAPSHOT_ENABLED is set.
+def init_app(app):
+    app.add_url_rule("/", 'index', index, methods=['GET', 'POST'])
+    app.add_url_rule("/<policy>/<supplied_date>", 'get_result', from_snapshot(get_result))
+    app.add_url_rule("/api/balances", 'get_balances', from_snapshot(get_balances), methods=['POST'])
+    app.add_url_rule("/reports/aging", 'get_aging_report', from_snapshot(get_aging_report))
+    app.add_url_rule("/reports/forecast", 'get_forecast', from_snapshot(get_forecast))
+    app.add_url_rule("/export/<table>", 'get_export', from_snapshot(get_export))
@@ -0,0 +1,192 @@
+#!/user/bin/env python2.7
+
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime
+from Queue import Empty, Queue
+
+from concurrent.futures import Future
+
+from accounting import db, settings
+from models import Payment, Policy
+
+logger = logging.getLogger(__name__)
+
+"""
+#######################################################
+Group commit for payments and cancellations.
+
+make_payment and cancel_policy commit once per call, which
+on SQLite is one write lock and one sync per row. Callers
+that can wait a few milliseconds submit the same writes to a
+WriteQueue instead: a single writer thread takes up to
+WRITE_QUEUE_MAX_BATCH of them, waiting at most
+WRITE_QUEUE_MAX_DELAY_MS for more to arrive, flushes them
+one by one and commits them together. Every caller gets a
+Future that resolves once the commit holding its row is done.
+
+A row that fails (unknown policy, a constraint) only fails
+its own future: the batch is rolled back and written again
+without it.
+#######################################################
+"""
+
+
+class _Write(object):
+    __slots__ = ('stage', 'args', 'future')
+
+    def __init__(self, stage, args):
+        self.stage = stage
+        self.args = args
+        self.future = Future()
+
+
+def stage_payment(policy_id, contact_id, date_cursor, amount):
+    """
+     Same payment make_payment makes, flushed but not committed.
+     Returns its id.
+    """
+    policy = Policy.query.get(policy_id)
+    if policy is None:
+        raise ValueError("No Policy found with Policy id: %s" % policy_id)
+    payment = Payment(policy_id, contact_id or policy.named_insured, amount, date_cursor or datetime.now().date())
+    db.session.add(payment)
+    db.session.flush()
+    return payment.id
+
+
+def stage_cancellation(policy_id, reason):
+    """
+     Same change cancel_policy makes, flushed but not committed.
+     Returns the policy id.
+    """
+    policy = Policy.query.get(policy_id)
+    if policy is None:
+        raise ValueError("No Policy found with Policy id: %s" % policy_id)
+    policy.status = u'Canceled'
+    policy.reason = reason
+    policy.date_changed = datetime.now().date()
+    db.session.flush()
+    return policy_id
+
+
+class WriteQueue(object):
+
+    _stop = object()
+
+    def __init__(self, max_batch=100, max_delay=0.005):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = Queue()
+        self.thread = None
+        self.batches = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='accounting-write-queue')
+                self.thread.daemon = True
+                self.thread.start()
+        return self
+
+    def stop(self):
+        """
+         Writes out everything submitted so far and stops the writer.
+        """
+        with self.lock:
+            if self.thread is not None:
+                self.queue.put(self._stop)
+                self.thread.join()
+                self.thread = None
+
+    def submit(self, stage, *args):
+        """
+         Queues stage(*args) and returns a Future of its return value.
+         stage makes its changes on db.session and must not commit.
+        """
+        write = _Write(stage, args)
+        self.queue.put(write)
+        return write.future
+
+    def submit_payment(self, policy_id, contact_id=None, date_cursor=None, amount=0):
+        return self.submit(stage_payment, policy_id, contact_id, date_cursor, amount)
+
+    def submit_cancellation(self, policy_id, reason):
+        return self.submit(stage_cancellation, policy_id, reason)
+
+    def _run(self):
+        try:
+            stopping = False
+            while not stopping:
+                write = self.queue.get()
+                if write is self._stop:
+                    break
+                batch = [write]
+                deadline = time.time() + self.max_delay
+                while len(batch) < self.max_batch:
+                    try:
+                        write = self.queue.get(timeout=max(deadline - time.time(), 0))
+                    except Empty:
+                        break
+                    if write is self._stop:
+                        stopping = True
+                        break
+                    batch.append(write)
+                self.write_batch(batch)
+        finally:
+            db.session.remove()
+
+    def write_batch(self, batch):
+        """
+         Stages every write of batch and commits them in one transaction,
+         leaving out and failing the ones that raise.
+        """
+        pending = [write for write in batch if write.future.set_running_or_notify_cancel()]
+        while pending:
+            results = []
+            failed = None
+            try:
+                for write in pending:
+                    failed = write
+                    results.append(write.stage(*write.args))
+                failed = None
+                db.session.commit()
+            except Exception as error:
+                db.session.rollback()
+                if failed is None:
+                    # the commit itself failed: nothing to tell the rows apart
+                    logger.error("Write batch of %d failed to commit: %s", len(pending), error)
+                    for write in pending:
+                        write.future.set_exception(error)
+                    return
+                logger.warning("Write %s%r failed, retrying its batch without it: %s",
+                               failed.stage.__name__, failed.args, error)
+                failed.future.set_exception(error)
+                pending.remove(failed)
+                continue
+
+            self.batches += 1
+            for write, result in zip(pending, results):
+                write.future.set_result(result)
+            return
+
+
+_write_queue = None
+_write_queue_lock = threading.Lock()
+
+
+def get_write_queue():
+    """
+     The process-wide WriteQueue, started on first use with the
+     WRITE_QUEUE_* settings.
+    """
+    global _write_queue
+    with _write_queue_lock:
+        if _write_queue is None:
+            _write_queue = WriteQueue(settings['WRITE_QUEUE_MAX_BATCH'],
+                                      settings['WRITE_QUEUE_MAX_DELAY_MS'] / 1000.0).start()
+            atexit.register(_write_queue.stop)
+        return _write_queue
@@ -0,0 +1,613 @@
+#!/usr/bin/env python
+"""
+Command line entry point for the batch jobs that run outside of the
+Flask server. Every command accepts --database to work on another
+SQLite file than accounting.sqlite, and --config web|batch|test to pick
+the settings profile of accounting/config.py. With SNAPSHOT_ENABLED, the
+aging, forecast and export commands read the snapshot that snapshot
+refresh makes.
+
+    ./manage.py migrate
+    ./manage.py sweep --date 2015-06-30 [--apply] [--reason "Non-payment"]
+    ./manage.py ledger verify|rebuild [--policy ID ...]
+    ./manage.py allocations verify|rebuild [--policy ID ...] [--date 2015-06-30]
+    ./manage.py export invoices [--since WATERMARK] [--format csv|jsonl] [--gzip] [--output invoices.csv.gz]
+    ./manage.py ingest-payments payments.csv [--chunk-size 5000] [--rejects rejects.csv]
+    ./manage.py checkpoints refresh [--through 2015-06-30] [--policy ID ...]
+    ./manage.py snapshot refresh|status [--every 60]
+    ./manage.py aging [--date 2015-06-30] [--by agent|policy] [--format csv|json] [--output aging.csv] [--check 100]
+    ./manage.py forecast [--date 2015-06-01] [--months 12] [--by month|day] [--rows rows|periods] [--format csv|json]
+        [--output forecast.csv] [--check 100]
+    ./manage.py onboard [--policy ID ...] [--chunk-size 1000]
+    ./manage.py reschedule Monthly --date 2015-06-01 (--policy ID ... | --from Quarterly) [--chunk-size 1000]
+    ./manage.py batch balances|cancellations|invoices|reschedule [--date 2015-06-30] [--workers 4] [--shards 16]
+        [--chunk-size 500] [--checkpoint DIR] [--schedule Monthly] [--policy ID ...] [--output balances.csv]
+    ./manage.py archive [--before 2015-01-01] [--policy ID ...] [--batch-size 1000] [--sample 200] [--date 2015-06-30]
+    ./manage.py serve [--bind 127.0.0.1:8000] [--workers 4] [--threads 1]
+    ./manage.py loadtest [--url http://127.0.0.1:8000] [--readers 8] [--writers 1] [--duration 10]
+    ./manage.py generate scratch.sqlite --policies 1k|100k|1m|N [--seed 0]
+    ./manage.py --database scratch.sqlite bench run [--sample 200] [--output results.json]
+    ./manage.py bench compare before.json after.json
+    ./manage.py bench balance-api [--date 2015-06-30] [--policy ID ...]
+    ./manage.py bench logging [--date 2015-06-30] [--sample 200]
+    ./manage.py bench writes [--sample 2000] [--threads 8]
+    ./manage.py bench columnar [--date 2015-06-30] [--sample 200]
+    ./manage.py bench batch [--operation balances] [--workers 1 --workers 2 --workers 4]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError("dates must look like YYYY-MM-DD, got %r" % value)
+
+
+def migrate(args):
+    from accounting.migrations import upgrade_db
+
+    applied = upgrade_db()
+    for name in applied:
+        print "Applied %s" % name
+    if not applied:
+        print "Database is up to date."
+
+
+def sweep(args):
+    from accounting.portfolio import run_cancellation_sweep
+
+    summary = run_cancellation_sweep(args.date, apply=args.apply, reason=args.reason)
+    print "Sweep as of %s" % summary['date']
+    print "  policies due to cancel: %d" % summary['to_cancel']
+    print "  outstanding amount:     %d" % summary['outstanding']
+    print "  policies canceled:      %d" % summary['canceled']
+    print "  evaluate: %.3fs / apply: %.3fs / total: %.3fs" % (
+        summary['timings']['evaluate'], summary['timings']['apply'], summary['timings']['total'])
+    if args.verbose:
+        for policy_id, (cancel_date, outstanding) in sorted(summary['policies'].items()):
+            print "  policy %s: %d outstanding at %s" % (policy_id, outstanding, cancel_date)
+
+
+def ledger(args):
+    from accounting.ledger import rebuild_ledger, verify_ledger
+
+    if args.action == 'rebuild':
+        print "Rebuilt %d ledger rows." % rebuild_ledger(args.policy)
+        return 0
+
+    differences = verify_ledger(args.policy)
+    for policy_id, message in differences:
+        print "policy %s: %s" % (policy_id, message)
+    if differences:
+        print "%d difference(s) found, run ./manage.py ledger rebuild to fix them." % len(differences)
+        return 1
+    print "Ledger matches invoices and payments."
+    return 0
+
+
+def allocations(args):
+    from accounting.allocation import reallocate, verify_allocations
+
+    if args.action == 'rebuild':
+        counts = reallocate(args.policy)
+        print "Wrote %d allocations, removed %d, updated %d invoices." % (
+            counts['inserted'], counts['deleted'], counts['invoices'])
+        return 0
+
+    differences = verify_allocations(args.policy, args.date)
+    for policy_id, message in differences:
+        print "policy %s: %s" % (policy_id, message)
+    if differences:
+        print "%d difference(s) found, run ./manage.py allocations rebuild to fix them." % len(differences)
+        return 1
+    print "Allocations match invoices, payments and balances."
+    return 0
+
+
+def checkpoints(args):
+    from accounting.checkpoints import refresh_checkpoints
+
+    print "Wrote %d balance checkpoints." % refresh_checkpoints(args.policy, args.through)
+
+
+def snapshot(args):
+    from accounting.snapshot import refresh_snapshot, snapshot_age, snapshot_file
+
+    if args.action == 'status':
+        age = snapshot_age()
+        print "%s: %s" % (snapshot_file(), "missing" if age is None else "taken %.1fs ago" % age)
+        return 0 if age is not None else 1
+    while True:
+        seconds = refresh_snapshot()
+        print "Refreshed %s in %.2fs." % (snapshot_file(), seconds)
+        if not args.every:
+            return 0
+        sys.stdout.flush()
+        time.sleep(max(0, args.every - seconds))
+
+
+def aging(args):
+    from accounting.aging import aging_report, check_aging, report_csv
+
+    report = aging_report(args.date)
+    if args.format == 'csv':
+        text = report_csv(report, args.by)
+    else:
+        rows = 'agents' if args.by == 'agent' else 'policies'
+        text = json.dumps({'date': report['date'], rows: report[rows], 'totals': report['totals']},
+                          indent=2, sort_keys=True) + '\n'
+    if args.output:
+        with open(args.output, 'wb') as stream:
+            stream.write(text)
+    else:
+        sys.stdout.write(text)
+
+    if args.check:
+        mismatches = check_aging(report, args.check)
+        for policy_id, aged, balance in mismatches:
+            sys.stderr.write("policy %s: aged %d, balance %d\n" % (policy_id, aged, balance))
+        sys.stderr.write("Checked %d policies against return_account_balance: %d mismatch(es)\n" % (
+            min(args.check, len(report['policies'])), len(mismatches)))
+        return 1 if mismatches else 0
+    return 0
+
+
+def forecast(args):
+    from accounting.forecast import cash_flow_forecast, check_forecast, forecast_csv
+
+    report = cash_flow_forecast(args.date, args.months, args.by)
+    if args.format == 'csv':
+        text = forecast_csv(report, args.rows)
+    else:
+        text = json.dumps(dict((name, report[name]) for name in ('start', 'end', 'by', args.rows, 'totals')),
+                          indent=2, sort_keys=True) + '\n'
+    if args.output:
+        with open(args.output, 'wb') as stream:
+            stream.write(text)
+    else:
+        sys.stdout.write(text)
+    sys.stderr.write("Forecast %d policies in %.2fs\n" % (report['policies'], report['seconds']))
+
+    if args.check:
+        mismatches = check_forecast(args.date, args.months, args.by, args.check)
+        for policy_id, forecast, expected in mismatches:
+            sys.stderr.write("policy %s: forecast %d, expected %d\n" % (policy_id, forecast, expected))
+        sys.stderr.write("Checked %d policies against their invoices and schedules: %d mismatch(es)\n" % (
+            min(args.check, report['policies']), len(mismatches)))
+        return 1 if mismatches else 0
+    return 0
+
+
+def export(args):
+    from accounting.export import export_table, export_to_file
+
+    if args.output:
+        watermark, written = export_to_file(args.output, args.table, args.since, args.format, args.gzip)
+    else:
+        watermark, chunks = export_table(args.table, args.since, args.format, args.gzip)
+        written = 0
+        for chunk in chunks:
+            sys.stdout.write(chunk)
+            written += len(chunk)
+    sys.stderr.write("Exported %s (%d bytes), watermark %d\n" % (args.table, written, watermark))
+
+
+def ingest_payments(args):
+    import csv
+    from accounting.ingest import ingest_file
+
+    on_reject = None
+    rejects = None
+    if args.rejects:
+        rejects = open(args.rejects, 'wb')
+        writer = csv.writer(rejects)
+        writer.writerow(['line', 'reason', 'record'])
+        on_reject = lambda line_number, record, reason: writer.writerow([line_number, reason, repr(record)])
+
+    try:
+        summary = ingest_file(args.path, args.format, args.chunk_size, on_reject)
+    finally:
+        if rejects:
+            rejects.close()
+
+    print "Read %d records in %.3fs (%.0f/s)" % (
+        summary['read'], summary['seconds'], summary['read'] / max(summary['seconds'], 1e-6))
+    print "  inserted: %d in %d chunk(s)" % (summary['inserted'], summary['chunks'])
+    print "  rejected: %d" % summary['rejected']
+    for line_number, reason in summary['rejects']:
+        print "    line %d: %s" % (line_number, reason)
+    return 1 if summary['rejected'] else 0
+
+
+def onboard(args):
+    from accounting.onboarding import onboard_policies
+
+    def progress(done, total):
+        print "  %d / %d policies" % (done, total)
+
+    summary = onboard_policies(args.policy, args.chunk_size, progress)
+    print "Created %d invoices for %d policies in %.3fs" % (
+        summary['invoices'], summary['policies'], summary['seconds'])
+
+
+def reschedule(args):
+    from accounting.reschedule import policies_on_schedule, reschedule_policies
+
+    def progress(done, total):
+        print "  %d / %d policies" % (done, total)
+
+    policy_ids = list(args.policy or [])
+    if args.current:
+        policy_ids.extend(policies_on_schedule(args.current))
+    summary = reschedule_policies(policy_ids, args.schedule, args.date, args.chunk_size, progress)
+    print "Moved %d of %d policies to %s in %.3fs: %d invoices voided, %d created" % (
+        summary['changed'], summary['policies'], args.schedule, summary['seconds'], summary['voided'],
+        summary['invoices'])
+    for policy_id, reason in summary['skipped']:
+        print "  skipped policy %s: %s" % (policy_id, reason)
+
+
+def batch(args):
+    from accounting.batch import run_batch
+
+    def progress(done, total):
+        sys.stderr.write("  %d / %d policies\n" % (done, total))
+
+    output = open(args.output, 'wb') if args.output else sys.stdout
+    try:
+        summary = run_batch(args.operation, output, args.date, args.workers, args.shards, args.chunk_size,
+                            args.checkpoint, args.policy, args.schedule, progress)
+    finally:
+        if args.output:
+            output.close()
+    sys.stderr.write("%(operation)s over %(policies)d policies in %(shards)d shards with %(workers)d workers: "
+                     "%(rows)d rows in %(seconds).3fs (%(per_second).0f policies/s)\n" % summary)
+    if summary['resumed_shards']:
+        sys.stderr.write("  resumed %d shards from %s\n" % (summary['resumed_shards'], args.checkpoint))
+
+
+ARCHIVE_LATENCY_OPERATIONS = ['return_account_balance', 'evaluate_cancel', 'get_result']
+
+
+def archive(args):
+    from accounting.archive import SIZED_TABLES, archive_rows
+    from accounting.benchmarks import run_benchmarks
+
+    def progress(done, total):
+        print "  %d / %d rows and policies" % (done, total)
+
+    def latency():
+        if not args.sample:
+            return None
+        return run_benchmarks(args.sample, args.seed, args.date, ARCHIVE_LATENCY_OPERATIONS)['operations']
+
+    latency_before = latency()
+    summary = archive_rows(args.before, args.batch_size, progress, args.policy)
+    latency_after = latency()
+
+    print "Archived %d voided invoices and %d closed policies (%d invoices, %d payments) in %.3fs" % (
+        summary['voided_invoices'], summary['policies'], summary['invoices'], summary['payments'],
+        summary['seconds'])
+    print "  %-20s %21s %21s" % ('table', 'rows', 'MB')
+    for name in SIZED_TABLES:
+        before, after = summary['sizes']['before'][name], summary['sizes']['after'][name]
+        megabytes = lambda size: '%.1f' % (size / 2.0 ** 20) if size is not None else '-'
+        print "  %-20s %9d -> %9d %9s -> %9s" % (name, before['rows'], after['rows'],
+                                                   megabytes(before['bytes']), megabytes(after['bytes']))
+    if latency_before:
+        print "  %-24s %21s %21s" % ('sample of %d' % args.sample, 'p50 ms', 'p99 ms')
+        for name in ARCHIVE_LATENCY_OPERATIONS:
+            before, after = latency_before[name], latency_after[name]
+            print "  %-24s %9.3f -> %7.3f %9.3f -> %7.3f" % (name, before['p50_ms'], after['p50_ms'],
+                                                              before['p99_ms'], after['p99_ms'])
+
+
+def serve(args):
+    from accounting.server import serve
+
+    serve(args.bind, args.workers, args.threads)
+
+
+def loadtest(args):
+    from accounting.loadtest import run_load_test
+
+    result = run_load_test(args.url, args.readers, args.writers, args.duration, args.date, args.seed)
+    print "%d readers and %d writers for %.1fs" % (result['readers'], result['writers'], result['seconds'])
+    print "  %-13s %9s %9s %9s %9s %7s" % ('operation', 'req/s', 'p50 ms', 'p99 ms', 'max ms', 'errors')
+    for name in ('get_result', 'make_payment'):
+        metrics = result[name]
+        if metrics['requests']:
+            print "  %-13s %9.1f %9.3f %9.3f %9.3f %7d" % (name, metrics['per_second'], metrics['p50_ms'],
+                                                          metrics['p99_ms'], metrics['max_ms'], metrics['errors'])
+        else:
+            print "  %-13s %9s %9s %9s %9s %7d" % (name, '-', '-', '-', '-', metrics['errors'])
+    return 1 if result['get_result']['errors'] or result['make_payment']['errors'] else 0
+
+
+def generate(args):
+    from accounting.synthetic import generate_portfolio, parse_scale
+
+    def progress(done, total):
+        print "  %d / %d policies" % (done, total)
+
+    summary = generate_portfolio(args.path, parse_scale(args.policies), seed=args.seed,
+                                 overwrite=args.force, progress=progress)
+    print "Wrote %d policies, %d contacts, %d invoices and %d payments to %s in %.1fs" % (
+        summary['policies'], summary['contacts'], summary['invoices'], summary['payments'],
+        args.path, summary['seconds'])
+
+
+def bench(args):
+    if args.which == 'compare':
+        from accounting.benchmarks import compare_results
+
+        if len(args.files) != 2:
+            print "bench compare needs two result files"
+            return 2
+        before, after = [json.load(open(path)) for path in args.files]
+        for line in compare_results(before, after):
+            print line
+        return 0
+
+    if args.which == 'balance-api':
+        from accounting.benchmarks import compare_balance_api
+
+        result = compare_balance_api(args.policy, args.date)
+        print "%d policies" % result['policies']
+        for name in ('get_result', 'api_balances'):
+            print "  %-13s %8.3fs %6d statements" % (name, result[name]['seconds'], result[name]['statements'])
+        return 0
+
+    if args.which == 'logging':
+        from accounting.benchmarks import LOGGING_MODES, compare_logging
+
+        results = compare_logging(args.sample, args.seed, args.date)
+        print "  %-6s %9s %9s %9s %9s" % ('mode', 'p50 ms', 'p90 ms', 'p99 ms', 'drain s')
+        for mode, _ in LOGGING_MODES:
+            metrics = results[mode]
+            print "  %-6s %9.3f %9.3f %9.3f %9.3f" % (mode, metrics['p50_ms'], metrics['p90_ms'], metrics['p99_ms'],
+                                                      metrics['drain_seconds'])
+        return 0
+
+    if args.which == 'writes':
+        from accounting.benchmarks import compare_write_paths
+
+        results = compare_write_paths(args.sample, args.threads, args.date)
+        print "%(payments)d payments from %(threads)d threads" % results
+        for name in ('per_call', 'queued'):
+            print "  %-9s %8.3fs %9.1f payments/s" % (name, results[name]['seconds'], results[name]['per_second'])
+        print "  %d group commits" % results['queued']['batches']
+        return 0
+
+    if args.which == 'columnar':
+        from accounting.benchmarks import compare_columnar
+
+        results = compare_columnar(args.sample, args.seed, args.date)
+        memory = results['memory']
+        print "Loaded %d policies, %d invoices and %d payments in %.3fs" % (
+            memory['policies'], memory['invoices'], memory['payments'], results['load_seconds'])
+        print "  %.1f MB held, %.1f MB per million invoices" % (
+            memory['bytes'] / 2.0 ** 20, memory['mb_per_million_invoices'])
+        print "  %-23s %14s %11s" % ('sample of %d' % results['sample'], 'PolicyReader', 'columnar')
+        for name in ('return_account_balance', 'evaluate_cancel', 'get_invoices'):
+            print "  %-23s %11.3f ms %8.3f ms" % (name, results[name]['policy_reader_ms'],
+                                                 results[name]['columnar_ms'])
+        for name, policy_id in results['mismatches']:
+            print "  %s differs on policy %s" % (name, policy_id)
+        return 1 if results['mismatches'] else 0
+
+    if args.which == 'batch':
+        from accounting.benchmarks import compare_batch_workers
+
+        operation = (args.operation or ['balances'])[0]
+        results = compare_batch_workers(operation, args.workers or [1, 2, 4], args.date, args.sample, args.seed)
+        print "%s over %d policies, %d CPUs" % (operation, results['policies'], results['cpus'])
+        print "  %7s %9s %12s %8s" % ('workers', 'seconds', 'policies/s', 'speedup')
+        for run in results['runs']:
+            print "  %7d %9.3f %12.1f %7.2fx" % (run['workers'], run['seconds'], run['per_second'], run['speedup'])
+        return 0
+
+    from accounting.benchmarks import OPERATIONS, run_benchmarks
+
+    results = run_benchmarks(args.sample, args.seed, args.date, args.operation or OPERATIONS)
+    print "%(policies)d policies, %(invoices)d invoices, %(payments)d payments, sample of %(sample)d" % \
+        results['meta']
+    print "  %-24s %9s %9s %9s %9s %10s" % ('operation', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'statements')
+    for operation in OPERATIONS:
+        if operation in results['operations']:
+            metrics = results['operations'][operation]
+            print "  %-24s %9.3f %9.3f %9.3f %9.3f %10.1f" % (
+                operation, metrics['p50_ms'], metrics['p90_ms'], metrics['p99_ms'], metrics['max_ms'],
+                metrics['statements'])
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+        print "Saved results to %s" % args.output
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Accounting batch jobs.")
+    parser.add_argument('--database', help="SQLite file to work on instead of accounting.sqlite")
+    parser.add_argument('--config', choices=['web', 'batch', 'test'],
+                        help="settings profile of accounting/config.py, by default web for serve, loadtest and "
+                             "bench and batch for the others")
+    commands = parser.add_subparsers()
+
+    command = commands.add_parser('migrate', help="bring an existing database up to the current schema")
+    command.set_defaults(func=migrate, migrated=False)
+
+    command = commands.add_parser('sweep', help="find (and optionally cancel) policies past their cancel date")
+    command.add_argument('--date', type=parse_date, default=None, help="as-of date, defaults to today")
+    command.add_argument('--apply', action='store_true', help="cancel the policies that are found")
+    command.add_argument('--reason', default=u'Non-payment', help="cancellation reason stored on the policy")
+    command.add_argument('-v', '--verbose', action='store_true', help="list every policy found")
+    command.set_defaults(func=sweep)
+
+    command = commands.add_parser('ledger', help="check or recompute the running-balance ledger")
+    command.add_argument('action', choices=['verify', 'rebuild'])
+    command.add_argument('--policy', type=int, action='append', help="limit to these policy ids")
+    command.set_defaults(func=ledger)
+
+    command = commands.add_parser('allocations', help="check or recompute how payments are applied to invoices")
+    command.add_argument('action', choices=['verify', 'rebuild'])
+    command.add_argument('--policy', type=int, action='append', help="limit to these policy ids")
+    command.add_argument('--date', type=parse_date, default=None,
+                         help="date to compare cancellations on, defaults to today")
+    command.set_defaults(func=allocations)
+
+    command = commands.add_parser('checkpoints', help="add the month-end balance checkpoints that are missing")
+    command.add_argument('action', choices=['refresh'])
+    command.add_argument('--through', type=parse_date, default=None,
+                         help="last month-end to checkpoint, defaults to the one before today")
+    command.add_argument('--policy', type=int, action='append', help="limit to these policy ids")
+    command.set_defaults(func=checkpoints)
+
+    command = commands.add_parser('snapshot', help="copy the database into the read snapshot, or show its age")
+    command.add_argument('action', choices=['refresh', 'status'])
+    command.add_argument('--every', type=float, default=0, metavar='SECONDS',
+                         help="keep refreshing it this often instead of once")
+    command.set_defaults(func=snapshot)
+
+    command = commands.add_parser('aging', help="receivables aging by agent or policy")
+    command.add_argument('--date', type=parse_date, default=None, help="as-of date, defaults to today")
+    command.add_argument('--by', choices=['agent', 'policy'], default='agent')
+    command.add_argument('--format', choices=['csv', 'json'], default='csv')
+    command.add_argument('--output', help="write the report to this file instead of stdout")
+    command.add_argument('--check', type=int, default=0, metavar='N',
+                         help="compare N sampled policies with return_account_balance")
+    command.set_defaults(func=aging, reads_snapshot=True)
+
+    command = commands.add_parser('forecast', help="cash-flow forecast of the receivables by period")
+    command.add_argument('--date', type=parse_date, default=None, help="start of the forecast, defaults to today")
+    command.add_argument('--months', type=int, default=12, help="months forecast")
+    command.add_argument('--by', choices=['month', 'day'], default='month', help="length of a period")
+    command.add_argument('--rows', choices=['rows', 'periods'], default='rows',
+                         help="periods by agent and schedule, or totals per period")
+    command.add_argument('--format', choices=['csv', 'json'], default='csv')
+    command.add_argument('--output', help="write the report to this file instead of stdout")
+    command.add_argument('--check', type=int, default=0, metavar='N',
+                         help="compare N sampled policies with their invoices and schedules")
+    command.set_defaults(func=forecast, reads_snapshot=True)
+
+    command = commands.add_parser('export', help="stream a full or incremental extract of a table")
+    command.add_argument('table', choices=['policies', 'invoices', 'payments'])
+    command.add_argument('--since', type=int, default=None, metavar='WATERMARK',
+                         help="only rows changed after the watermark a previous export printed")
+    command.add_argument('--format', choices=['csv', 'jsonl'], default='csv')
+    command.add_argument('--gzip', action='store_true', help="gzip the extract")
+    command.add_argument('--output', help="write the extract to this file instead of stdout")
+    command.set_defaults(func=export, reads_snapshot=True)
+
+    command = commands.add_parser('ingest-payments', help="bulk load payments from a CSV or JSON lines file")
+    command.add_argument('path')
+    command.add_argument('--format', choices=['csv', 'jsonl'], help="defaults to the file extension")
+    command.add_argument('--chunk-size', type=int, default=5000, help="payments committed per transaction")
+    command.add_argument('--rejects', help="write rejected rows to this CSV file")
+    command.set_defaults(func=ingest_payments)
+
+    command = commands.add_parser('onboard', help="generate invoices for every policy that has none")
+    command.add_argument('--policy', type=int, action='append', help="limit to these policy ids")
+    command.add_argument('--chunk-size', type=int, default=1000, help="policies committed per transaction")
+    command.set_defaults(func=onboard)
+
+    command = commands.add_parser('reschedule', help="move many policies to another billing schedule")
+    command.add_argument('schedule', choices=['Annual', 'Two-Pay', 'Quarterly', 'Monthly'])
+    command.add_argument('--date', type=parse_date, default=None, help="as-of date, defaults to today")
+    command.add_argument('--policy', type=int, action='append', help="policy ids to move")
+    command.add_argument('--from', dest='current', choices=['Annual', 'Two-Pay', 'Quarterly', 'Monthly'],
+                         help="move every active policy on this schedule")
+    command.add_argument('--chunk-size', type=int, default=1000, help="policies committed per transaction")
+    command.set_defaults(func=reschedule)
+
+    command = commands.add_parser('batch', help="run an accounting operation over every policy in parallel")
+    command.add_argument('operation', choices=['balances', 'cancellations', 'invoices', 'reschedule'])
+    command.add_argument('--date', type=parse_date, default=None, help="as-of date, defaults to today")
+    command.add_argument('--workers', type=int, help="worker processes, defaults to BATCH_WORKERS")
+    command.add_argument('--shards', type=int, help="shards of the policy ids, defaults to BATCH_SHARDS")
+    command.add_argument('--chunk-size', type=int, help="policies per checkpoint, defaults to BATCH_CHUNK_SIZE")
+    command.add_argument('--checkpoint', help="directory to keep progress in, to resume an interrupted run")
+    command.add_argument('--schedule', choices=['Annual', 'Two-Pay', 'Quarterly', 'Monthly'],
+                         help="new billing schedule for reschedule")
+    command.add_argument('--policy', type=int, action='append', help="limit to these policy ids")
+    command.add_argument('--output', help="write the CSV here instead of stdout")
+    command.set_defaults(func=batch)
+
+    command = commands.add_parser('archive', help="move voided invoices and settled closed policies out of the "
+                                                  "live tables")
+    command.add_argument('--before', type=parse_date, default=None,
+                         help="archive closed policies with no activity since, defaults to ARCHIVE_AFTER_DAYS ago")
+    command.add_argument('--policy', type=int, action='append', help="limit to these policy ids")
+    command.add_argument('--batch-size', type=int, help="invoices or policies per transaction")
+    command.add_argument('--sample', type=int, default=200, help="policies timed before and after, 0 to skip")
+    command.add_argument('--seed', type=int, default=0, help="seed used to pick the sample")
+    command.add_argument('--date', type=parse_date, default=None, help="as-of date of the timed lookups")
+    command.set_defaults(func=archive)
+
+    command = commands.add_parser('serve', help="run the app under a pre-fork multi-worker server")
+    command.add_argument('--bind', help="host:port, defaults to SERVER_BIND")
+    command.add_argument('--workers', type=int, help="worker processes, defaults to SERVER_WORKERS")
+    command.add_argument('--threads', type=int, help="threads per worker, defaults to SERVER_THREADS")
+    command.set_defaults(func=serve, profile='web')
+
+    command = commands.add_parser('loadtest', help="mixed lookups and payments against a running server")
+    command.add_argument('--url', default='http://127.0.0.1:8000')
+    command.add_argument('--readers', type=int, default=8, help="threads requesting get_result")
+    command.add_argument('--writers', type=int, default=1, help="threads making payments")
+    command.add_argument('--duration', type=float, default=10, help="seconds to run for")
+    command.add_argument('--date', type=parse_date, default=None, help="as-of date, defaults to today")
+    command.add_argument('--seed', type=int, default=0)
+    command.set_defaults(func=loadtest, profile='web')
+
+    command = commands.add_parser('generate', help="write a synthetic book of policies to a new SQLite file")
+    command.add_argument('path')
+    command.add_argument('--policies', default='1k', help="1k, 100k, 1m or a number of policies")
+    command.add_argument('--seed', type=int, default=0)
+    command.add_argument('--force', action='store_true', help="overwrite path if it exists")
+    command.set_defaults(func=generate, migrated=False)
+
+    command = commands.add_parser('bench', help="measure the accounting engine")
+    command.add_argument('which', choices=['run', 'compare', 'balance-api', 'logging', 'writes', 'columnar', 'batch'])
+    command.add_argument('files', nargs='*', help="the two result files to compare")
+    command.add_argument('--date', type=parse_date, default=None, help="as-of date, defaults to today")
+    command.add_argument('--policy', type=int, action='append', help="limit to these policy ids")
+    command.add_argument('--sample', type=int, default=200, help="policies timed per operation")
+    command.add_argument('--threads', type=int, default=8, help="concurrent writers for bench writes")
+    command.add_argument('--workers', type=int, action='append', help="worker counts for bench batch")
+    command.add_argument('--seed', type=int, default=0, help="seed used to pick the sample")
+    command.add_argument('--operation', action='append', help="only time these operations")
+    command.add_argument('--output', help="save the results as JSON")
+    command.set_defaults(func=bench, profile='web')
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.database:
+        # read by accounting.config, so it has to be set before accounting is imported
+        os.environ['ACCOUNTING_DATABASE'] = args.database
+    from accounting import configure, db
+    from accounting.migrations import check_db
+
+    configure(args.config or getattr(args, 'profile', 'batch'))
+    # every other command reads the models' columns
+    if getattr(args, 'migrated', True):
+        try:
+            check_db()
+        except RuntimeError as error:
+            return str(error)
+    if getattr(args, 'reads_snapshot', False):
+        with db.reading_snapshot():
+            return args.func(args)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
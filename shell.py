@@ -2,7 +2,9 @@
 from accounting import *
 from accounting.models import *
 from accounting.utils import *
-from flask import *
+
+# the web app is left out; create_app() builds it when wanted
+configure('batch')
 
 try:
     from IPython import embed